@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+
+from . import ExportOptions
+from .MeshExporter import extract_mesh_data
+from .ModelCompressor import save_model
+from .ModelExporter import export_model, mesh_instances
+
+QueuedMeshes = 4  # Extracted meshes waiting to be encoded, bounds the memory they hold
+StepBudget = 0.05  # Seconds of blender data reading per step, so the UI stays responsive
+_PollInterval = 0.1
+
+_Done = object()  # Put in the queue after the last extracted mesh
+
+
+class ExportCancelled(RuntimeError):
+    pass
+
+
+class BackgroundExport(object):
+    """
+    Runs an export without blocking blender. Blender data can only be read on the main thread, so the main thread
+    snapshots the materials, transforms and instances and reads the images when the export starts, then extracts the
+    mesh arrays one mesh at a time in step, which a modal operator calls on a timer. A worker thread encodes the
+    textures and packs the atlases, then encodes the extracted meshes and writes the archive as they come in, so
+    extracting the next mesh overlaps with encoding and compressing the last ones.
+
+    Meshes are extracted as the export goes, so edits made to a mesh before it is extracted end up in the export.
+    Cancelling leaves the archive at the file path as it was.
+    """
+
+    def __init__(self, context, config):
+        """
+        Snapshots everything but the mesh arrays, call on the main thread. The images are read, but encoding them and
+        packing the atlases is left to the worker
+
+        :param context: Blender context
+        :param config: The configuration of the export, with the ExportOptions.FilePathKey and archive options the
+                       operator sets
+        """
+        self.config = config
+        self.error = None
+        self.cancelled = False
+        self.encoded = 0  # Meshes encoded and handed to the archive
+        self.encoding = None  # Name of the object whose mesh is being encoded, or 'textures'
+        self._cancel = threading.Event()
+        self._queue = queue.Queue()  # Never full, step stops extracting at QueuedMeshes instead
+        instances = mesh_instances(context, config)
+        self._pending = list(instances.items())
+        self.total = len(self._pending)
+        self._extracted = 0
+        if not self._pending:
+            self._queue.put(_Done)
+
+        deferred = []
+        encoded_data = export_model(context, config, extracted_meshes=self._extracted_meshes(), instances=instances,
+                                    deferred=deferred)
+        self._thread = threading.Thread(target=self._run, args=(encoded_data, deferred), name='BackgroundExport')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # -- Main thread --
+
+    def step(self, budget=StepBudget):
+        """
+        Extracts the next meshes on the main thread, for up to budget seconds or until the queue of meshes waiting to be
+        encoded is full
+
+        :param budget: Seconds to spend reading blender data
+        """
+        start = time.perf_counter()
+        while self._pending and not self._cancel.is_set() and self._queue.qsize() < QueuedMeshes:
+            if self.finished():
+                return  # The worker failed, nothing is encoding the meshes anymore
+            mesh_name, objs = self._pending.pop(0)
+            try:
+                arrays = extract_mesh_data(objs[0], self.config[ExportOptions.MeshKey])
+            except Exception as e:
+                # The worker raises it, so the archive is aborted the same way as any other failed export
+                arrays = e
+            self._queue.put((mesh_name, objs[0].name, arrays))
+            self._extracted += 1
+            if not self._pending:
+                self._queue.put(_Done)
+            if time.perf_counter() - start > budget:
+                break
+
+    def cancel(self):
+        """
+        Stops extracting and encoding meshes, the worker deletes the partially written archive
+        """
+        self._cancel.set()
+
+    def finished(self):
+        return not self._thread.is_alive()
+
+    def progress(self):
+        """
+        :return: tuple of (fraction of the export done, text describing what is being done)
+        """
+        if self._cancel.is_set():
+            return 1.0, 'Cancelling export...'
+        if self.total == 0:
+            return 1.0 if self.finished() else 0.0, 'Saving...'
+        # Extracting is quick next to encoding and compressing, so it counts for a tenth of each mesh
+        fraction = (0.1 * self._extracted + 0.9 * self.encoded) / self.total
+        if self.encoded >= self.total:
+            return fraction, 'Saving archive...'
+        return min(fraction, 1.0), 'Encoding %s (%d/%d), Esc to cancel' % (self.encoding or '...', self.encoded + 1,
+                                                                           self.total)
+
+    # -- Worker thread --
+
+    def _extracted_meshes(self):
+        """
+        :return: Generator of the (mesh datablock name, object name, arrays) the main thread extracted, in order
+        """
+        while True:
+            try:
+                item = self._queue.get(timeout=_PollInterval)
+            except queue.Empty:
+                item = None
+            if self._cancel.is_set():
+                raise ExportCancelled('Export cancelled')
+            if item is None:
+                continue
+            if item is _Done:
+                return
+
+            mesh_name, obj_name, arrays = item
+            if isinstance(arrays, Exception):
+                raise arrays
+            self.encoding = obj_name
+            yield mesh_name, obj_name, arrays
+            self.encoded += 1
+
+    def _run(self, encoded_data, deferred):
+        config = self.config
+        try:
+            self.encoding = 'textures'
+            for encode in deferred:
+                if self._cancel.is_set():
+                    raise ExportCancelled('Export cancelled')
+                encode()
+            self.encoding = None
+            save_model(encoded_data, config[ExportOptions.FilePathKey], config[ExportOptions.UpdateArchiveKey],
+                       config[ExportOptions.CompressionWorkersKey] or None, config[ExportOptions.CompressionKey],
+                       config[ExportOptions.CompressionReportKey], config[ExportOptions.BufferFilterKey],
+                       config[ExportOptions.ArchiveLayoutKey], config[ExportOptions.PackAlignmentKey],
+                       config[ExportOptions.MaterialLibraryKey])
+        except ExportCancelled:
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
@@ -0,0 +1,146 @@
+import lzma
+
+import numpy as np
+
+# Filter descriptor keys
+FilterIdKey = 'id'
+FilterElementSizeKey = 'element_size'  # Bytes per element the byte planes are taken over
+FilterTypeKey = 'type'  # Little-endian unsigned integer type the deltas are taken in, 'u8', 'u16' or 'u32'
+FilterComponentsKey = 'components'  # Components per element, each component is delta coded against its own previous
+
+# Filter ids. Every filter is reversible and keeps the length of the buffer, the loader undoes the filter named in the
+# buffer's manifest link before using the buffer
+FilterShuffle = 'shuffle'  # Byte planes: the first byte of every element, then the second byte of every element...
+FilterDelta = 'delta'  # Wrapping difference to the previous element, then byte planes
+FilterDeltaZigzag = 'delta_zigzag'  # Delta, with the differences zigzagged (0, -1, 1, -2... -> 0, 1, 2, 3...) so the
+                                    # small negative ones don't turn into large unsigned ones, then byte planes
+
+PickSampleLength = 256 * 1024  # Bytes of each buffer pick_filter compresses to compare the filters
+
+_unsigned_dtypes = {
+    'u8': np.dtype('u1'),
+    'u16': np.dtype('<u2'),
+    'u32': np.dtype('<u4')
+}
+
+
+def shuffle_filter(element_size):
+    """
+    :param element_size: Bytes per element, usually the size of one float of a float stream
+    :return: Filter descriptor splitting the buffer into byte planes
+    """
+    return {FilterIdKey: FilterShuffle, FilterElementSizeKey: element_size}
+
+
+def delta_filter(int_type, components=1, zigzag=False):
+    """
+    :param int_type: Unsigned integer type of the stream, see FilterTypeKey
+    :param components: Integers per element, e.g. 4 for padded quantized positions
+    :param zigzag: If the differences should be zigzagged, for streams that go down about as much as they go up
+    :return: Filter descriptor delta coding the buffer, then splitting it into byte planes
+    """
+    return {FilterIdKey: FilterDeltaZigzag if zigzag else FilterDelta, FilterTypeKey: int_type,
+            FilterComponentsKey: components, FilterElementSizeKey: _unsigned_dtypes[int_type].itemsize}
+
+
+def _shuffle(data, element_size):
+    planes = np.frombuffer(data, dtype=np.uint8)
+    if element_size <= 1 or len(planes) % element_size != 0:
+        return planes.tobytes()
+    return planes.reshape(-1, element_size).T.tobytes()
+
+
+def _unshuffle(data, element_size):
+    planes = np.frombuffer(data, dtype=np.uint8)
+    if element_size <= 1 or len(planes) % element_size != 0:
+        return planes.tobytes()
+    return planes.reshape(element_size, -1).T.tobytes()
+
+
+def _signed(dtype):
+    return np.dtype(dtype.str.replace('u', 'i'))
+
+
+def _split_elements(data, descriptor):
+    """
+    :return: tuple of (elements array (count x components) of the stream's type, trailing bytes that aren't a whole
+             element). Trailing bytes are left as they are by the delta filters.
+    """
+    dtype = _unsigned_dtypes[descriptor[FilterTypeKey]]
+    components = descriptor[FilterComponentsKey]
+    whole = len(data) - len(data) % (dtype.itemsize * components)
+    return np.frombuffer(data, dtype=dtype, count=whole // dtype.itemsize).reshape(-1, components), data[whole:]
+
+
+def _delta(data, descriptor):
+    values, tail = _split_elements(data, descriptor)
+    deltas = values.copy()
+    # Unsigned subtraction wraps, so every difference fits in the stream's type
+    np.subtract(values[1:], values[:-1], out=deltas[1:])
+
+    if descriptor[FilterIdKey] == FilterDeltaZigzag:
+        signed = deltas.view(_signed(deltas.dtype))
+        bits = deltas.dtype.itemsize * 8
+        deltas = ((signed << 1) ^ (signed >> (bits - 1))).view(deltas.dtype)
+    return deltas.tobytes() + tail
+
+
+def _undelta(data, descriptor):
+    deltas, tail = _split_elements(data, descriptor)
+
+    if descriptor[FilterIdKey] == FilterDeltaZigzag:
+        deltas = (deltas >> 1) ^ (np.zeros_like(deltas) - (deltas & 1))
+    # The running sum wraps the same way the differences did
+    return np.cumsum(deltas, axis=0, dtype=deltas.dtype).tobytes() + tail
+
+
+def apply_filter(data, descriptor):
+    """
+    :param data: bytes of the buffer
+    :param descriptor: Filter descriptor from one of the filter functions, or None for no filter
+    :return: The filtered bytes, the same length as data
+    """
+    if descriptor is None:
+        return data
+    if descriptor[FilterIdKey] in (FilterDelta, FilterDeltaZigzag):
+        data = _delta(data, descriptor)
+    elif descriptor[FilterIdKey] != FilterShuffle:
+        raise RuntimeError("Unknown buffer filter '%s'" % str(descriptor[FilterIdKey]))
+    return _shuffle(data, descriptor[FilterElementSizeKey])
+
+
+def undo_filter(data, descriptor):
+    """
+    :param data: bytes of the filtered buffer
+    :param descriptor: The filter descriptor the buffer was filtered with, or None if it wasn't filtered
+    :return: The original bytes of the buffer
+    """
+    if descriptor is None:
+        return data
+    if descriptor[FilterIdKey] not in (FilterShuffle, FilterDelta, FilterDeltaZigzag):
+        raise RuntimeError("Unknown buffer filter '%s'" % str(descriptor[FilterIdKey]))
+    data = _unshuffle(data, descriptor[FilterElementSizeKey])
+    if descriptor[FilterIdKey] != FilterShuffle:
+        data = _undelta(data, descriptor)
+    return data
+
+
+def pick_filter(data, candidates):
+    """
+    Compresses the start of the buffer with each candidate filter, and with no filter, to find the filter that suits
+    its data. How well a filter works depends on the mesh, e.g. byte planes help noisy float streams but hurt the very
+    regular ones, where LZMA already finds the repeated floats.
+
+    :param data: bytes of the buffer
+    :param candidates: list of filter descriptors to try, None entries are skipped
+    :return: The candidate that compressed smallest, or None if no filter compressed smaller than the raw bytes
+    """
+    sample = data[:PickSampleLength]
+    best, best_length = None, len(lzma.compress(sample, preset=0))
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        length = len(lzma.compress(apply_filter(sample, candidate), preset=0))
+        if length < best_length:
+            best, best_length = candidate, length
+    return best
@@ -0,0 +1,299 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+import zipfile
+
+import numpy as np
+
+DefaultCacheSizeMB = 512
+_CacheDirName = 'turn_tactics_export_cache'
+_CacheExt = '.npz'
+_DescriptorName = 'descriptor'  # Entry in the .npz of the json that rebuilds the value around the arrays
+
+# Modules whose code decides what the cached data looks like. Entries made by different code never match
+_encoder_modules = ('MeshExporter.py', 'MeshOptimizer.py', 'VertexFormats.py', 'MaterialExporter.py',
+                    'TextureExporter.py')
+
+# Stats keys
+CacheHitsKey = 'hits'
+CacheMissesKey = 'misses'
+CacheEvictionsKey = 'evictions'
+CacheEntriesKey = 'entries'
+CacheBytesKey = 'bytes'
+
+
+def new_hash():
+    """
+    :return: New hashlib hasher, the one used for cache keys and content hashes
+    """
+    # blake2b is the fastest hashlib has, but blender 2.79 ships python 3.5 which doesn't have it yet
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(digest_size=20)
+    return hashlib.sha1()
+
+
+def update_hash(hasher, part):
+    """
+    Hashes the content of the part given, so equal content gives equal hashes
+
+    :param hasher: From new_hash()
+    :param part: numpy array, string, number, None, or tuple/list of those
+    """
+    if isinstance(part, np.ndarray):
+        # The dtype and shape are part of the content, the same bytes can be a different mesh
+        hasher.update(('%s%s' % (part.dtype.str, part.shape)).encode('utf-8'))
+        hasher.update(np.ascontiguousarray(part).data)
+    elif isinstance(part, (tuple, list)):
+        hasher.update(b'(')
+        for item in part:
+            update_hash(hasher, item)
+        hasher.update(b')')
+    else:
+        hasher.update(repr(part).encode('utf-8'))
+    hasher.update(b'\0')
+
+
+def _user_cache_dir():
+    """
+    :return: The cache directory of the current user, only they can write entries to it
+    """
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    elif sys.platform == 'darwin':
+        base = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, _CacheDirName)
+
+
+DefaultCacheDir = _user_cache_dir()
+
+
+def _check_owner(directory):
+    """
+    Refuses a cache directory another user owns, they could swap the entries the export reads back
+    """
+    if not hasattr(os, 'getuid'):
+        return  # Windows, the profile directories are already private to the user
+    owner = os.stat(directory).st_uid
+    if owner != os.getuid():
+        raise RuntimeError('Encode cache directory %s is owned by another user (uid %d)' % (directory, owner))
+
+
+def _to_descriptor(value, arrays):
+    """
+    Splits a value into json and the arrays it holds, so the entries are stored without pickle
+
+    :param value: dicts, lists, tuples, strings, numbers, None, bytes and numpy arrays nested in each other
+    :param arrays: list the arrays are appended to, the descriptor refers to them by index
+    :return: json serializable descriptor of the value
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (np.ndarray, np.generic)):
+        if value.dtype.hasobject:
+            raise TypeError('Cannot cache a numpy array of python objects')
+        arrays.append(np.asarray(value))
+        return {'array': len(arrays) - 1, 'scalar': isinstance(value, np.generic)}
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        arrays.append(np.frombuffer(bytes(value), dtype=np.uint8))
+        return {'bytes': len(arrays) - 1}
+    if isinstance(value, dict):
+        # As pairs, the keys aren't always strings and json objects don't keep them apart from the tags
+        return {'dict': [[_to_descriptor(k, arrays), _to_descriptor(v, arrays)] for k, v in value.items()]}
+    if isinstance(value, tuple):
+        return {'tuple': [_to_descriptor(item, arrays) for item in value]}
+    if isinstance(value, list):
+        return [_to_descriptor(item, arrays) for item in value]
+    raise TypeError('Cannot cache a value of type %s' % type(value).__name__)
+
+
+def _from_descriptor(descriptor, arrays):
+    """
+    :param descriptor: From _to_descriptor
+    :param arrays: The arrays it refers to
+    :return: The value the descriptor was made from
+    """
+    if isinstance(descriptor, list):
+        return [_from_descriptor(item, arrays) for item in descriptor]
+    if not isinstance(descriptor, dict):
+        return descriptor
+    if 'array' in descriptor:
+        array = arrays[descriptor['array']]
+        return array[()] if descriptor['scalar'] else array
+    if 'bytes' in descriptor:
+        return arrays[descriptor['bytes']].tobytes()
+    if 'tuple' in descriptor:
+        return tuple(_from_descriptor(item, arrays) for item in descriptor['tuple'])
+    return dict((_from_descriptor(k, arrays), _from_descriptor(v, arrays)) for k, v in descriptor['dict'])
+
+
+def _dump_entry(value):
+    """
+    :return: bytes of the .npz file holding the value
+    """
+    arrays = []
+    descriptor = json.dumps(_to_descriptor(value, arrays)).encode('utf-8')
+    members = dict(('a%d' % i, array) for i, array in enumerate(arrays))
+    members[_DescriptorName] = np.frombuffer(descriptor, dtype=np.uint8)
+    data = io.BytesIO()
+    np.savez(data, **members)
+    return data.getvalue()
+
+
+def _load_entry(f):
+    """
+    :param f: Open .npz file from _dump_entry
+    :return: The value stored in it
+    """
+    with np.load(f, allow_pickle=False) as npz:
+        descriptor = json.loads(npz[_DescriptorName].tobytes().decode('utf-8'))
+        arrays = [npz['a%d' % i] for i in range(len(npz.files) - 1)]
+    return _from_descriptor(descriptor, arrays)
+
+
+def _code_fingerprint():
+    """
+    :return: Hash of the source of the encoder modules, so a cache made by an older version of the addon is not used
+    """
+    hasher = new_hash()
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in _encoder_modules:
+        with open(os.path.join(addon_dir, module), 'rb') as f:
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+class EncodeCache(object):
+    """
+    On disk cache of encoded data, keyed by a hash of the data it was encoded from and the options it was encoded with.
+    Each entry is one .npz file of the arrays in the value plus a json descriptor of the rest, never a pickle, so a
+    planted entry can't run code. The least recently used entries are deleted once the cache grows over its size limit.
+    The file modification time is the last use of an entry, so it carries over between exports.
+    """
+
+    def __init__(self, directory=DefaultCacheDir, max_size_mb=DefaultCacheSizeMB):
+        """
+        :param directory: Where to keep the cache files, created private to the user if missing. Must be owned by the
+        current user
+        :param max_size_mb: Most megabytes of entries to keep
+        """
+        self.directory = directory
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._code = _code_fingerprint()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+            os.chmod(directory, 0o700)  # The mode given to makedirs is masked by the umask
+        _check_owner(directory)
+
+        # key -> [last use, size in bytes]
+        self._entries = {}
+        for file_name in os.listdir(directory):
+            if file_name.endswith(_CacheExt):
+                stat = os.stat(os.path.join(directory, file_name))
+                self._entries[file_name[:-len(_CacheExt)]] = [stat.st_mtime, stat.st_size]
+
+    def key(self, *parts):
+        """
+        Hashes the content given into a cache key
+
+        :param parts: numpy arrays, strings, numbers, None, or tuples/lists of those
+        :return: hex digest to look up entries with
+        """
+        hasher = new_hash()
+        hasher.update(self._code.encode('utf-8'))
+        for part in parts:
+            update_hash(hasher, part)
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _CacheExt)
+
+    def get(self, key):
+        """
+        :param key: Key from key()
+        :return: The cached value, or None if there is no entry for the key
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                value = _load_entry(f)
+        except (OSError, ValueError, KeyError, IndexError, zipfile.BadZipFile):
+            # Deleted or corrupt entries are misses, they get rewritten
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        now = time.time()
+        os.utime(self._path(key), (now, now))
+        self._entries[key][0] = now
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Stores the value for the key given, then evicts the least recently used entries while the cache is too big
+
+        :param key: Key from key()
+        :param value: Value to cache, dicts, lists, tuples, strings, numbers, None, bytes and numpy arrays
+        """
+        data = _dump_entry(value)
+        if len(data) > self.max_bytes:
+            return
+
+        # Write to a temporary file first, so an interrupted export never leaves a partial entry behind
+        temp_path = self._path(key) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self._path(key))
+        self._entries[key] = [time.time(), len(data)]
+        self._evict()
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        if total <= self.max_bytes:
+            return
+
+        for key in sorted(self._entries, key=lambda k: self._entries[k][0]):
+            total -= self._entries[key][1]
+            self._remove(key)
+            self.evictions += 1
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        """
+        :return: dict with the hits, misses and evictions so far, and the entries and bytes in the cache
+        """
+        return {
+            CacheHitsKey: self.hits,
+            CacheMissesKey: self.misses,
+            CacheEvictionsKey: self.evictions,
+            CacheEntriesKey: len(self._entries),
+            CacheBytesKey: sum(size for _, size in self._entries.values())
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print('Encode cache: %d hits, %d misses, %d evictions, %d entries (%.1f MB) in %s' % (
+            stats[CacheHitsKey], stats[CacheMissesKey], stats[CacheEvictionsKey], stats[CacheEntriesKey],
+            stats[CacheBytesKey] / (1024.0 * 1024.0), self.directory))
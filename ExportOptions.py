@@ -8,19 +8,123 @@ MeshVertsAndUVs = 'Vertices_UVs' # Export vertices and UVs
 MeshNormals = 'Normals' # Export Normals
 MeshNormalsAndUVs = 'Normals_UVs' # Export normals and uvs
 MeshUVs = 'UVs' # Export Uvs
+WeldToleranceKey = 'weld_tolerance'
+WeldToleranceDefault = 0.0001 # Corners whose position, normal and UV are each closer than this share a vertex
+
+# Mesh optimization config options
+OptimizeKey = 'mesh_optimize'
+OptimizeNone = 'No_Optimize' # Keep the triangles in the order blender stores them
+OptimizeVertexCache = 'Vertex_Cache' # Reorder triangles for the vertex cache, and vertices for fetch locality
+OptimizeOverdraw = 'Vertex_Cache_Overdraw' # Also sort clusters of triangles to reduce overdraw
+
+# Index buffer config options
+IndexFormatKey = 'index_format'
+IndexSplit16 = 'Split_16' # 16-bit indices, meshes with too many vertices get split into submeshes
+IndexAuto = 'Auto' # 16-bit indices when the mesh has few enough vertices, 32-bit otherwise
+Index32 = '32' # Always 32-bit indices
+
+# Vertex attribute format config options
+PositionFormatKey = 'position_format'
+PositionFloat = 'Float' # 3 float32s
+PositionUnorm16 = 'Unorm16' # 4 unorm16s over the mesh bounding box, the 4th is padding
+NormalFormatKey = 'normal_format'
+NormalFloat = 'Float' # 3 float32s
+NormalOct16 = 'Oct16' # 2 snorm16s, octahedral encoded
+NormalOct8 = 'Oct8' # 2 snorm8s, octahedral encoded
+UVFormatKey = 'uv_format'
+UVFloat = 'Float' # 2 float32s
+UVHalf = 'Half' # 2 float16s
+UVUnorm16 = 'Unorm16' # 2 unorm16s over the UV bounding box
+
+# Vertex buffer layout config options
+LayoutKey = 'vertex_layout'
+LayoutSeparate = 'Separate' # One buffer per attribute
+LayoutInterleaved = 'Interleaved' # One buffer with the attributes of each vertex next to each other
+LayoutInterleavedPositions = 'Interleaved_Positions' # Interleaved, plus a separate position buffer for depth passes
+
+# Encode cache config options
+CacheDirKey = 'cache_dir' # Directory of the cache of encoded data kept between exports, None to not use the cache
+CacheSizeKey = 'cache_size_mb'
+CacheSizeDefault = 512 # Megabytes of encoded data to keep before evicting the least recently used
 
 # Material config options
 MaterialKey = 'material_export'
 MaterialAll = 'All' # Export all material data, and link it to the meshes in the model
 MaterialNoExport = 'No_Export' # Do not export any material data
 MaterialLink = 'Link_Only' # Link the meshes in the model only
+MaterialLibraryKey = 'material_library' # Shared library archive to save the materials to, None keeps them in the .model
+MaterialLibraryExt = '.matlib'
+
+# Color ramp config options
+RampEncodingKey = 'ramp_encoding'
+RampSampled = 'Sampled' # 100 evenly spaced samples
+RampAdaptive = 'Adaptive' # The fewest breakpoints, with their positions, that stay within the ramp tolerance
+# Most any color channel (0-1) of an adaptive ramp can differ from blender's, except right at a constant ramp's steps
+RampToleranceKey = 'ramp_tolerance'
+RampToleranceDefault = 0.002 # About half a step of an 8-bit color channel
+RampToleranceMin = 0.0001 # Curved ramps are sampled to at least this, tighter takes too many samples to be worth it
+
+# Texture config options
+TextureFormatKey = 'texture_format'
+TextureNoExport = 'No_Export' # Do not export the image textures of the materials
+TextureRGBA8 = 'RGBA8' # Uncompressed 8-bit RGBA, every mip level
+TextureBC = 'BC' # Block compressed, BC1 (DXT1) for opaque images and BC3 (DXT5) for images with alpha
+TextureMaxSizeKey = 'texture_max_size' # Largest width or height of an exported texture, larger images are scaled down
+TextureMaxSizeDefault = 2048
+
+# Texture atlas config options
+AtlasKey = 'texture_atlas'
+AtlasOff = 'Off'
+AtlasSmall = 'Small_Textures' # Pack the small textures of single texture materials into atlases, moving the mesh UVs
+AtlasTextureSizeKey = 'atlas_texture_size' # Largest width or height of a texture to pack into an atlas
+AtlasTextureSizeDefault = 128
+AtlasSizeKey = 'atlas_size' # Width and height of each atlas, a power of two
+AtlasSizeDefault = 1024
+AtlasPaddingKey = 'atlas_padding' # Pixels of gutter around each texture, atlases keep log2(padding) + 1 mip levels
+AtlasPaddingDefault = 4
 
 # Animation config options
 AnimationKey = 'animation_export'
 AnimationAll = 'All'
 AnimationNoExport = 'No_Export'
 
+# Archive compression config options
+CompressionKey = 'compression'
+CompressionStore = 'Store' # No compression, fastest to export and load
+CompressionFastLoad = 'Fast_Load' # Deflate, fast to decompress in-engine
+CompressionBalanced = 'Balanced' # LZMA
+CompressionDistribution = 'Distribution' # Strongest LZMA, for release builds
+CompressionZstd = 'Zstd' # Zstandard, needs python 3.14+ (zipfile.ZIP_ZSTANDARD)
+CompressionReportKey = 'compression_report' # Print the size and decode time of each member type for every preset
+
+# Buffer filter config options, reversible filters run on the binary buffers before they are compressed
+BufferFilterKey = 'buffer_filter'
+BufferFilterNone = 'None'
+# Byte planes for float positions, delta for float uvs and quantized streams, delta+zigzag for indices. Float normals
+# aren't filtered, and a filter that compresses worse than none is dropped
+BufferFilterStandard = 'Standard'
+BufferFilterAuto = 'Auto' # Tries the filters on each buffer and keeps the one that compresses best
+
+# Archive layout config options
+ArchiveLayoutKey = 'archive_layout'
+ArchiveMembers = 'Members' # Each buffer is its own compressed member
+ArchivePacked = 'Packed' # Every buffer is packed into one stored member, aligned so it can be memory mapped
+ArchivePackedCompressed = 'Packed_Compressed' # Every buffer is packed into one member, compressed
+PackAlignmentKey = 'pack_alignment' # Byte alignment of each buffer in the packed member
+PackAlignmentDefault = 256 # Meets the offset alignment of any GPU buffer binding, 16 is enough for vertex/index data
+
+# Profiling config options
+ProfileKey = 'profile'
+ProfileOff = 'Off'
+ProfileStages = 'Stages' # Times each stage per object, counts vertices, triangles and bytes
+ProfileMemory = 'Memory' # Stages, and the peak memory of each stage with tracemalloc. Slows the export down
+ProfileFunctions = 'Functions' # Stages, and every function call with cProfile. Slows the export down
+
 # Other export config options
 FilePathKey = 'file_path'
+UpdateArchiveKey = 'update_archive' # Copy unchanged members from the existing archive instead of compressing them
+CompressionWorkersKey = 'compression_workers' # Threads compressing archive members, 0 for one per core
+EncodeProcessesKey = 'encode_processes' # Processes encoding meshes, 1 encodes on the main thread, 0 for one per core
+StreamExportKey = 'stream_export' # Encode each mesh while the archive is written, instead of all of them up front
 EmitMetadataKey = 'emit_metadata'
 SelectedOnlyKey = 'use_selected_only'
\ No newline at end of file
@@ -0,0 +1,348 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from . import ExportOptions
+
+try:
+    import resource
+except ImportError:
+    # Not on windows, the peak resident memory isn't reported there
+    resource = None
+
+ProfileReportExt = '.profile.json'  # Written next to the .model
+ProfileStatsExt = '.prof'  # cProfile stats, for pstats or snakeviz
+
+# Report keys
+ReportModeKey = 'mode'
+ReportTotalKey = 'total_seconds'
+ReportStagesKey = 'stages'
+ReportObjectsKey = 'objects'
+ReportCountersKey = 'counters'
+ReportPeakTracedKey = 'peak_traced_bytes'
+ReportPeakRSSKey = 'peak_rss_bytes'
+ReportStatsKey = 'cprofile_stats'
+StageCallsKey = 'calls'
+StageSecondsKey = 'seconds'
+StagePeakKey = 'peak_bytes'
+
+_PathSeparator = '/'
+
+
+class _NoStage(object):
+    """
+    What stage returns while nothing is profiled, entering and leaving it does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_no_stage = _NoStage()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name, obj):
+        self._profiler = profiler
+        self._name = name
+        self._obj = obj
+
+    def __enter__(self):
+        self._profiler._enter(self._name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler._exit(self._obj)
+        return False
+
+
+class ExportProfiler(object):
+    """
+    Records how long each stage of an export takes, in total and per object, along with counters like the vertices and
+    bytes each object produced.
+
+    Stages nest, a stage entered inside another is recorded under its path, ex. export_model/encode_mesh/weld. Each
+    thread nests its stages separately. With the memory mode, the peak memory allocated in each stage is traced too,
+    and with the functions mode every function call is profiled with cProfile. tracemalloc traces every thread, so the
+    peak of a stage includes what the compression threads allocated while it ran.
+    """
+
+    def __init__(self, mode=ExportOptions.ProfileStages):
+        """
+        :param mode: What to record, see ExportOptions.ProfileKey
+        """
+        self.mode = mode
+        self.total_time = None
+        self.peak_traced = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stages = OrderedDict()  # Stage path -> [calls, seconds, peak bytes]
+        self._objects = OrderedDict()  # Object name -> stage path -> seconds
+        self._counters = OrderedDict()  # Object name (None for the whole export) -> counter name -> value
+        self._trace_stages = False
+        self._cprofile = None
+        self._start = None
+
+    def start(self):
+        if self.mode == ExportOptions.ProfileMemory:
+            tracemalloc.start()
+            # Stages can only have their own peak with reset_peak (python 3.9+), only the export's peak without it
+            self._trace_stages = hasattr(tracemalloc, 'reset_peak')
+        elif self.mode == ExportOptions.ProfileFunctions:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._start = time.perf_counter()
+
+    def stop(self):
+        self.total_time = time.perf_counter() - self._start
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self.mode == ExportOptions.ProfileMemory:
+            self.peak_traced = max(self.peak_traced or 0, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    # -- Recording --
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def stage(self, name, obj=None):
+        """
+        :param name: Name of the stage
+        :param obj: Name of the object (or mesh, material...) the stage works on, if any
+        :return: Context manager timing the stage
+        """
+        return _Stage(self, name, obj)
+
+    def _enter(self, name):
+        stack = self._stack()
+        path = stack[-1][0] + _PathSeparator + name if stack else name
+        if self._trace_stages:
+            # The peak so far belongs to every stage entered, before it is reset for the new stage
+            _, peak = tracemalloc.get_traced_memory()
+            for entry in stack:
+                entry[2] = max(entry[2], peak)
+            self.peak_traced = max(self.peak_traced or 0, peak)
+            tracemalloc.reset_peak()
+        with self._lock:
+            # Stages are listed in the order they were first entered, parents before the stages inside them
+            self._stages.setdefault(path, [0, 0.0, None])
+        stack.append([path, time.perf_counter(), 0])
+
+    def _exit(self, obj):
+        elapsed = time.perf_counter()
+        stack = self._stack()
+        path, start, peak = stack.pop()
+        elapsed -= start
+        if self._trace_stages:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            self.peak_traced = max(self.peak_traced or 0, peak)
+            if stack:
+                stack[-1][2] = max(stack[-1][2], peak)
+        self.add_time(path, elapsed, obj, peak if self._trace_stages else None)
+
+    def add_time(self, path, seconds, obj=None, peak=None):
+        """
+        Adds time spent outside of a stage context, ex. summed up on worker threads
+
+        :param path: Full path of the stage
+        :param seconds: Seconds to add
+        :param obj: Name of the object the time was spent on, if any
+        :param peak: Peak bytes allocated in the stage, if traced
+        """
+        with self._lock:
+            record = self._stages.setdefault(path, [0, 0.0, None])
+            record[0] += 1
+            record[1] += seconds
+            if peak is not None:
+                record[2] = max(record[2] or 0, peak)
+            if obj is not None:
+                times = self._objects.setdefault(obj, OrderedDict())
+                times[path] = times.get(path, 0.0) + seconds
+
+    def count(self, name, value, obj=None):
+        """
+        Adds value to a counter, for the whole export and for the object given
+
+        :param name: Name of the counter, ex. vertices_out
+        :param value: Number to add
+        :param obj: Name of the object the value belongs to, if any
+        """
+        with self._lock:
+            for key in (None, obj) if obj is not None else (None,):
+                counters = self._counters.setdefault(key, OrderedDict())
+                counters[name] = counters.get(name, 0) + value
+
+    # -- Reporting --
+
+    def _peak_rss(self):
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # Kilobytes on linux
+
+    def _cprofile_stats(self, limit):
+        if self._cprofile is None:
+            return None
+        stream = io.StringIO()
+        pstats.Stats(self._cprofile, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def report(self):
+        """
+        :return: dict of the stages, per object times and counters, see the Report keys
+        """
+        with self._lock:
+            stages = OrderedDict((path, {StageCallsKey: calls, StageSecondsKey: seconds, StagePeakKey: peak})
+                                 for path, (calls, seconds, peak) in self._stages.items())
+            objects = OrderedDict()
+            for obj in list(self._objects) + [obj for obj in self._counters if obj not in self._objects]:
+                if obj is not None:
+                    objects[obj] = {ReportStagesKey: OrderedDict(self._objects.get(obj, {})),
+                                    ReportCountersKey: OrderedDict(self._counters.get(obj, {}))}
+            counters = OrderedDict(self._counters.get(None, {}))
+        return OrderedDict([
+            (ReportModeKey, self.mode),
+            (ReportTotalKey, self.total_time),
+            (ReportStagesKey, stages),
+            (ReportObjectsKey, objects),
+            (ReportCountersKey, counters),
+            (ReportPeakTracedKey, self.peak_traced),
+            (ReportPeakRSSKey, self._peak_rss())
+        ])
+
+    def print_summary(self, top_objects=10):
+        """
+        Prints the time of each stage, the objects that took the longest and the counters
+
+        :param top_objects: How many of the slowest objects to print
+        """
+        report = self.report()
+        total = report[ReportTotalKey] or 0.0
+        print('Export profile (%s), %.4fs:' % (self.mode, total))
+        for path, stage in report[ReportStagesKey].items():
+            depth = path.count(_PathSeparator)
+            line = '  %-40s %6d calls %10.4fs %5.1f%%' % ('  ' * depth + path.rsplit(_PathSeparator, 1)[-1],
+                                                         stage[StageCallsKey], stage[StageSecondsKey],
+                                                         100.0 * stage[StageSecondsKey] / max(total, 1e-9))
+            if stage[StagePeakKey] is not None:
+                line += ' peak %9.1f MB' % (stage[StagePeakKey] / 1048576.0)
+            print(line)
+
+        # Only the outermost stage of each object counts, the stages inside it are part of its time
+        object_times = []
+        for obj, values in report[ReportObjectsKey].items():
+            paths = values[ReportStagesKey]
+            object_times.append((sum(seconds for path, seconds in paths.items()
+                                     if not any(path.startswith(other + _PathSeparator) for other in paths)), obj))
+        if object_times:
+            print('  Slowest objects:')
+            for seconds, obj in sorted(object_times, reverse=True)[:top_objects]:
+                print('    %-38s %10.4fs' % (obj, seconds))
+
+        if report[ReportCountersKey]:
+            print('  Counters:')
+            for name, value in report[ReportCountersKey].items():
+                print('    %-38s %14s' % (name, value))
+        if report[ReportPeakTracedKey] is not None:
+            print('  Peak traced memory %.1f MB' % (report[ReportPeakTracedKey] / 1048576.0))
+        if report[ReportPeakRSSKey] is not None:
+            print('  Peak resident memory %.1f MB' % (report[ReportPeakRSSKey] / 1048576.0))
+
+        stats = self._cprofile_stats(20)
+        if stats is not None:
+            print(stats)
+
+    def write_report(self, model_filepath):
+        """
+        Writes the report as json next to the .model, and the cProfile stats when functions were profiled
+
+        :param model_filepath: Path of the exported .model
+        :return: Path of the json report
+        """
+        base = os.path.splitext(model_filepath)[0]
+        report = self.report()
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(base + ProfileStatsExt)
+            report[ReportStatsKey] = base + ProfileStatsExt
+
+        filepath = base + ProfileReportExt
+        with open(filepath, 'w') as f:
+            json.dump(report, f, indent=2)
+        return filepath
+
+
+# The profiler of the export running, None while nothing is profiled. The exporters record into it through stage and
+# count, which cost one global lookup when profiling is off
+_active = None
+
+
+def start_profiling(mode=ExportOptions.ProfileStages):
+    """
+    :param mode: What to record, see ExportOptions.ProfileKey
+    :return: The ExportProfiler recording, or None if the mode is off
+    """
+    global _active
+    if mode == ExportOptions.ProfileOff:
+        return None
+    _active = ExportProfiler(mode)
+    _active.start()
+    return _active
+
+
+def stop_profiling():
+    """
+    :return: The ExportProfiler that was recording, stopped. None if nothing was profiled
+    """
+    global _active
+    profiler, _active = _active, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+def stage(name, obj=None):
+    """
+    :param name: Name of the stage
+    :param obj: Name of the object the stage works on, if any
+    :return: Context manager timing the stage while profiling, one that does nothing otherwise
+    """
+    if _active is None:
+        return _no_stage
+    return _active.stage(name, obj)
+
+
+def count(name, value, obj=None):
+    """
+    Adds value to a counter while profiling, see ExportProfiler.count
+    """
+    if _active is not None:
+        _active.count(name, value, obj)
+
+
+def add_time(path, seconds, obj=None):
+    """
+    Adds time to a stage while profiling, see ExportProfiler.add_time
+    """
+    if _active is not None:
+        _active.add_time(path, seconds, obj)
+
+
+def profiling():
+    """
+    :return: If an export is being profiled
+    """
+    return _active is not None
@@ -1,18 +1,27 @@
 import colorsys
 
 import bpy
+import numpy as np
 
-from . import ExportOptions
+from . import ExportOptions, ExportProfiler
 
 ShadowPropKey = 'shadow'
 SpecularPropKey = 'specular'
 DiffusePropKey = 'diffuse'
 AmbientPropKey = 'ambient'
+TexturesPropKey = 'textures'
 
 DiffusePassKey = 'diffuse'
 SpecularPassKey = 'specular'
 AmbientPassKey = 'ambient'
 ShadowPassKey = 'shadow'
+
+_RampSamples = 100  # Evenly spaced samples of a sampled ramp
+_RampInitialSamples = 17  # Evenly spaced samples adaptive sampling starts from, along with the ramp elements
+_RampMinInterval = 1e-7  # Adaptive sampling doesn't split intervals shorter than this, only steps in a ramp get here
+_RampDecimals = 6  # Adaptive ramps are rounded to well under their tolerance, so they are shorter as JSON
+_RampPositionDecimals = 8  # Positions keep enough decimals to hold the two sides of a step _RampMinInterval apart
+
 _diffuse_shader_lu = {
     'LAMBERT': 'lambert',
     'OREN_NAYAR': 'oren_nayar',
@@ -29,6 +38,14 @@ _specular_shader_lu = {
     'WARDISO': 'ward_anisotropic'
 }
 
+# Texture slot flag -> (what the texture is used for, slot property of how much it affects it)
+_texture_uses = (
+    ('use_map_color_diffuse', 'diffuse', 'diffuse_color_factor'),
+    ('use_map_color_spec', 'specular', 'specular_color_factor'),
+    ('use_map_normal', 'normal', 'normal_factor'),
+    ('use_map_alpha', 'alpha', 'alpha_factor')
+)
+
 _engine_blend_op = {
     'MIX': 'mix',  # Blends elements by dst = src*srcFactor + dst*(1-srcFactor),
     'ADD': 'add',  # dst = src*srcFactor + dst
@@ -154,10 +171,12 @@ def _get_color_ramp_elements(ramp, resolution):
     :return: Engine formatted color ramp
     """
     points = []
-    for step in range(resolution):
-        pos = float(step) / float(resolution)
-        color = ramp.evaluate(pos)
-        points.append([color[0], color[1], color[2], color[3]])
+    with ExportProfiler.stage('sample_ramp'):
+        for step in range(resolution):
+            pos = float(step) / float(resolution)
+            color = ramp.evaluate(pos)
+            points.append([color[0], color[1], color[2], color[3]])
+    ExportProfiler.count('ramp_samples', resolution)
 
     # Convert all points to RGB if they aren't already
     if ramp.color_mode == 'HSV' or ramp.color_mode == 'HSL':
@@ -177,13 +196,171 @@ def _get_color_ramp_elements(ramp, resolution):
     raise RuntimeError("Invalid color mode %s for ramp" % str(ramp.color_mode))
 
 
-def _get_color_prop(mat, for_stage):
+def _hsv_to_rgb(h, s, v):
+    """
+    colorsys.hsv_to_rgb of arrays of hues, saturations and values
+
+    :return: (n x 3) array of the RGB colors
+    """
+    sector = np.floor(h * 6.0)
+    f = h * 6.0 - sector
+    sector = sector.astype(np.int64) % 6
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    return np.stack([np.choose(sector, [v, q, p, p, t, v]), np.choose(sector, [t, v, v, q, p, p]),
+                     np.choose(sector, [p, p, t, v, v, q])], axis=1)
+
+
+def _hls_channel(m1, m2, hue):
+    hue = hue % 1.0
+    return np.select([hue < 1.0 / 6.0, hue < 0.5, hue < 2.0 / 3.0],
+                     [m1 + (m2 - m1) * hue * 6.0, m2, m1 + (m2 - m1) * (2.0 / 3.0 - hue) * 6.0], m1)
+
+
+def _hls_to_rgb(h, l, s):
+    """
+    colorsys.hls_to_rgb of arrays of hues, lightnesses and saturations
+
+    :return: (n x 3) array of the RGB colors
+    """
+    m2 = np.where(l <= 0.5, l * (1.0 + s), l + s - l * s)
+    m1 = 2.0 * l - m2
+    return np.stack([_hls_channel(m1, m2, h + 1.0 / 3.0), _hls_channel(m1, m2, h), _hls_channel(m1, m2, h - 1.0 / 3.0)],
+                    axis=1)
+
+
+def _ramp_colors_to_rgb(colors, color_mode):
+    """
+    Converts the colors sampled from a ramp to RGB, the same way _get_color_ramp_elements does
+
+    :param colors: (n x 4) array of the colors sampled, in the color mode of the ramp
+    :param color_mode: The color mode of the ramp
+    :return: (n x 4) array of RGBA colors
+    """
+    if color_mode == 'RGB':
+        return colors
+    elif color_mode == 'HSV':
+        rgb = _hsv_to_rgb(colors[:, 0], colors[:, 1], colors[:, 2])
+    elif color_mode == 'HSL':
+        rgb = _hls_to_rgb(colors[:, 0], colors[:, 2], colors[:, 1])
+    else:
+        raise RuntimeError("Invalid color mode %s for ramp" % str(color_mode))
+    return np.concatenate([rgb, colors[:, 3:4]], axis=1)  # Pick up Alpha from original colors
+
+
+def _simplify_ramp(positions, colors, tolerance):
+    """
+    Picks the fewest points of the ramp that, linearly interpolated, stay within tolerance of every other point
+    (Ramer-Douglas-Peucker, with the largest difference of any channel as the distance)
+
+    :param positions: Sorted array of the positions of the points, from 0 to 1
+    :param colors: (n x 4) array of the colors at the positions
+    :param tolerance: Most a channel of a point dropped can differ from the interpolated ramp
+    :return: Sorted array of the indices of the points kept, always the first and last
+    """
+    keep = np.zeros(len(positions), dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, len(positions) - 1)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+        t = (positions[start + 1:end] - positions[start]) / max(positions[end] - positions[start], 1e-12)
+        interpolated = colors[start] + t[:, np.newaxis] * (colors[end] - colors[start])
+        error = np.abs(colors[start + 1:end] - interpolated).max(axis=1)
+        worst = int(np.argmax(error))
+        if error[worst] > tolerance:
+            split = start + 1 + worst
+            keep[split] = True
+            segments += [(start, split), (split, end)]
+    return np.flatnonzero(keep)
+
+
+def _evaluate_ramp(ramp, positions):
+    """
+    :return: (n x 4) array of the RGBA colors of the ramp at the positions given
+    """
+    with ExportProfiler.stage('sample_ramp'):
+        colors = np.array([tuple(ramp.evaluate(position))[:4] for position in positions], dtype=np.float64)
+    ExportProfiler.count('ramp_samples', len(positions))
+    return _ramp_colors_to_rgb(colors, ramp.color_mode)
+
+
+def _sample_ramp(ramp, tolerance):
+    """
+    Samples the ramp densely only where it isn't linear. Each interval between samples is split at its middle until the
+    color there is within a quarter of the tolerance of the interpolated one. Where the ramp curves smoothly, or has a
+    kink (ex. where an HSV ramp crosses into another hue sector), no point of the interval is off by more than twice
+    its middle, so the samples linearly interpolated stay within half the tolerance of the ramp. Only a step in the
+    ramp (constant interpolation) can't be, its interval stops splitting once it is _RampMinInterval long. The elements
+    are always sampled, the ramp can have a kink at each of them.
+
+    :param tolerance: Most any channel may differ from the ramp, at least ExportOptions.RampToleranceMin
+    :return: tuple of (sorted array of the positions sampled, (n x 4) array of the RGBA colors at them)
+    """
+    tolerance = max(tolerance, ExportOptions.RampToleranceMin)
+    element_positions = np.clip([element.position for element in ramp.elements], 0.0, 1.0)
+    positions = np.union1d(np.linspace(0.0, 1.0, _RampInitialSamples), element_positions)
+    colors = _evaluate_ramp(ramp, positions.tolist())
+    split = np.ones(len(positions) - 1, dtype=bool)  # If the interval starting at each sample should be split
+
+    while True:
+        starts = np.flatnonzero(split & (np.diff(positions) > _RampMinInterval))
+        if len(starts) == 0:
+            return positions, colors
+        middles = (positions[starts] + positions[starts + 1]) * 0.5
+        middle_colors = _evaluate_ramp(ramp, middles.tolist())
+        off = np.abs(middle_colors - (colors[starts] + colors[starts + 1]) * 0.5).max(axis=1) > tolerance * 0.25
+
+        # Both halves of an interval whose middle was off get split again
+        split = np.zeros(len(positions) + len(middles), dtype=bool)
+        split[starts] = off
+        split[len(positions):] = off
+        order = np.argsort(np.concatenate([positions, middles]), kind='mergesort')
+        positions = np.concatenate([positions, middles])[order]
+        colors = np.concatenate([colors, middle_colors])[order]
+        split = split[order][:-1]
+
+
+def _get_adaptive_ramp(ramp, tolerance):
+    """
+    Converts the blender ramp to the fewest breakpoints that, linearly interpolated in engine, stay within tolerance of
+    the ramp, except right at a step of a constant ramp. Linear RGB ramps are read from their elements, which are their
+    breakpoints. Other ramps are sampled where they bend, to within half the tolerance (see _sample_ramp), and
+    simplified with the other half.
+
+    :param ramp: The color ramp to convert
+    :param tolerance: Most any channel may differ from the ramp, see ExportOptions.RampToleranceKey
+    :return: tuple of (list of the breakpoint positions, list of the RGBA colors at them)
+    """
+    simplify_tolerance = tolerance
+    if ramp.interpolation == 'LINEAR' and ramp.color_mode == 'RGB':
+        # Blender holds the first and last colors out to the ends of the ramp
+        elements = sorted((element.position, tuple(element.color)) for element in ramp.elements)
+        positions = np.array([0.0] + [position for position, _ in elements] + [1.0], dtype=np.float64)
+        colors = np.array([elements[0][1]] + [color for _, color in elements] + [elements[-1][1]],
+                          dtype=np.float64)[:, :4]
+    else:
+        positions, colors = _sample_ramp(ramp, tolerance)
+        simplify_tolerance = tolerance * 0.5
+
+    with ExportProfiler.stage('simplify_ramp'):
+        kept = _simplify_ramp(positions, colors, simplify_tolerance)
+    ExportProfiler.count('ramp_breakpoints', len(kept))
+    return np.round(positions[kept], _RampPositionDecimals).tolist(), np.round(colors[kept], _RampDecimals).tolist()
+
+
+def _get_color_prop(mat, for_stage, ramp_encoding=ExportOptions.RampAdaptive,
+                    ramp_tolerance=ExportOptions.RampToleranceDefault):
     """
     Returns the color property for the stage given. This will either be an engine-formatted ramp color scheme
     or just a static color. If an improper stage is given, an exception will be raised
 
     :param mat: The material to process
     :param for_stage: For which stage to process it.
+    :param ramp_encoding: How to encode color ramps, see ExportOptions.RampEncodingKey
+    :param ramp_tolerance: Most an adaptive ramp may differ from blender's, see ExportOptions.RampToleranceKey
     :return: dict containing engine configuration of the color type.
     """
     color_type = _get_color_type(mat, for_stage)
@@ -194,14 +371,107 @@ def _get_color_prop(mat, for_stage):
             'color': [mat.diffuse_color[0], mat.diffuse_color[1], mat.diffuse_color[2]]
         }
     elif color_type == 'ramp':
-        return {
+        color_prop = {
             'ramp_blend_op': _engine_blend_op[mat.diffuse_ramp_blend],
-            'blend_factor': mat.diffuse_ramp_factor,
-            'colors': _get_color_ramp_elements(mat.diffuse_ramp, 100)
+            'blend_factor': mat.diffuse_ramp_factor
         }
+        # Adaptive ramps have the position of each color, sampled ramps are evenly spaced
+        if ramp_encoding == ExportOptions.RampAdaptive:
+            color_prop['positions'], color_prop['colors'] = _get_adaptive_ramp(mat.diffuse_ramp, ramp_tolerance)
+        else:
+            color_prop['colors'] = _get_color_ramp_elements(mat.diffuse_ramp, _RampSamples)
+        return color_prop
+
+
+def _ramp_fingerprint(ramp):
+    return (ramp.color_mode, ramp.interpolation, ramp.hue_interpolation,
+            tuple((element.position, tuple(element.color)) for element in ramp.elements))
+
+
+def _image_texture_slots(mat):
+    """
+    :return: list of the enabled texture slots of the material with an image used for anything in _texture_uses
+    """
+    slots = []
+    for i, slot in enumerate(mat.texture_slots):
+        if slot is None or slot.texture is None or not mat.use_textures[i]:
+            continue
+        if slot.texture.type != 'IMAGE' or slot.texture.image is None:
+            continue
+        if any(getattr(slot, flag) for flag, _, _ in _texture_uses):
+            slots.append(slot)
+    return slots
+
+
+def _texture_slots_fingerprint(mat):
+    return tuple((slot.texture.image.name, slot.texture_coords, slot.blend_type, tuple(slot.offset), tuple(slot.scale),
+                  tuple((getattr(slot, flag), getattr(slot, factor)) for flag, _, factor in _texture_uses))
+                 for slot in _image_texture_slots(mat))
 
 
-def encode_material_data(obj, context, export_opt):
+def material_fingerprint(obj):
+    """
+    Reads every material property encode_material_data uses, without sampling the color ramps. Materials with the same
+    fingerprint encode the same, so it can key a cache of encoded materials.
+
+    :param obj: Object to pull active material from
+    :return: tuple of the material properties
+    """
+    mat = obj.data.materials[0]
+    uses_ramp = mat.use_diffuse_ramp or mat.use_specular_ramp
+    return (mat.name, mat.type, mat.diffuse_shader, mat.specular_shader, mat.use_diffuse_ramp, mat.use_specular_ramp,
+            tuple(mat.diffuse_color), mat.diffuse_intensity, mat.roughness, mat.diffuse_toon_size,
+            mat.diffuse_toon_smooth, mat.darkness, mat.diffuse_fresnel, mat.diffuse_fresnel_factor,
+            mat.specular_intensity, mat.specular_hardness, mat.specular_ior, mat.specular_toon_size,
+            mat.specular_toon_smooth, mat.specular_slope, mat.diffuse_ramp_blend, mat.diffuse_ramp_factor,
+            _ramp_fingerprint(mat.diffuse_ramp) if uses_ramp else None, mat.use_cast_shadows,
+            mat.use_cast_shadows_only, mat.use_cast_buffer_shadows, mat.use_shadows, mat.use_transparent_shadows,
+            mat.use_only_shadow, mat.shadow_buffer_bias, mat.ambient, _texture_slots_fingerprint(mat))
+
+
+def is_atlas_candidate(mat):
+    """
+    :return: If the material's texture could be packed into an atlas. The meshes using it have their UVs moved into the
+             texture's region, so the material can only have one image texture, mapped straight onto the UVs
+    """
+    slots = _image_texture_slots(mat)
+    if len(slots) != 1:
+        return False
+    slot = slots[0]
+    return slot.texture_coords == 'UV' and tuple(slot.offset) == (0.0, 0.0, 0.0) and \
+        tuple(slot.scale) == (1.0, 1.0, 1.0)
+
+
+def encode_material_textures(obj, textures, atlas=False):
+    """
+    Encodes the image textures of the active material on the object, each image once however many materials use it. The
+    texture data is kept by the registry, the material links to it.
+
+    :param obj: Object to pull active material from
+    :param textures: TextureExporter.TextureRegistry the images are encoded into
+    :param atlas: If the texture may be packed into an atlas, see is_atlas_candidate
+    :return: list of the texture links of the material, in texture slot order
+    """
+    mat = obj.data.materials[0]
+    links = []
+    with ExportProfiler.stage('textures', mat.name):
+        for slot in _image_texture_slots(mat):
+            # Normal maps are data, everything else is a color and filtered in linear light
+            texture_id = textures.texture_id(slot.texture.image, not slot.use_map_normal, atlas)
+            links.append({
+                'texture': texture_id,
+                'location': '%s.tex.bin' % texture_id,
+                'uses': dict((use, getattr(slot, factor)) for flag, use, factor in _texture_uses
+                             if getattr(slot, flag)),
+                'blend_op': _engine_blend_op[slot.blend_type],
+                'offset': list(slot.offset),
+                'scale': list(slot.scale)
+            })
+    return links
+
+
+def encode_material_data(obj, context, export_opt, ramp_encoding=ExportOptions.RampAdaptive,
+                         ramp_tolerance=ExportOptions.RampToleranceDefault):
     """
     Encodes the active material on the object into a game-engine format
 
@@ -209,9 +479,10 @@ def encode_material_data(obj, context, export_opt):
     :param context: Blender context that the object came from
     :param export_opt: If set to link_only will only export the name of the material, otherwise will export whole material
                         and link it.
+    :param ramp_encoding: How to encode color ramps, see ExportOptions.RampEncodingKey
+    :param ramp_tolerance: Most an adaptive ramp may differ from blender's, see ExportOptions.RampToleranceKey
     :return: dict with material encoded in engine format
     """
-    # TODO: Export textures us
     print(obj.name)
 
     mat = obj.data.materials[0]
@@ -227,14 +498,14 @@ def encode_material_data(obj, context, export_opt):
     eng_mat[DiffusePropKey] = {}
     eng_mat[DiffusePropKey]['type'] = _diffuse_shader_lu[mat.diffuse_shader]
     eng_mat[DiffusePropKey]['color_type'] = _get_color_type(mat, DiffusePassKey)
-    eng_mat[DiffusePropKey]['color_props'] = _get_color_prop(mat, DiffusePassKey)
+    eng_mat[DiffusePropKey]['color_props'] = _get_color_prop(mat, DiffusePassKey, ramp_encoding, ramp_tolerance)
     eng_mat[DiffusePropKey]['shader_config'] = _get_diffuse_shader_config(mat)
 
     # Specular props
     eng_mat[SpecularPropKey] = {}
     eng_mat[SpecularPropKey]['type'] = _specular_shader_lu[mat.specular_shader]
     eng_mat[SpecularPropKey]['color_type'] = _get_color_type(mat, SpecularPassKey)
-    eng_mat[SpecularPropKey]['color_props'] = _get_color_prop(mat, SpecularPassKey)
+    eng_mat[SpecularPropKey]['color_props'] = _get_color_prop(mat, SpecularPassKey, ramp_encoding, ramp_tolerance)
     eng_mat[SpecularPropKey]['shader_config'] = _get_specular_shader_config(mat)
 
     # Shadow Props
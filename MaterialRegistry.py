@@ -0,0 +1,191 @@
+import functools
+from collections import OrderedDict
+
+from . import ExportOptions, ExportProfiler
+from .EncodeCache import new_hash, update_hash
+from .MaterialExporter import encode_material_data, encode_material_textures, material_fingerprint, \
+    is_atlas_candidate, TexturesPropKey
+from .MeshExporter import uv_bounds
+from .TextureAtlas import RegionAtlasKey
+
+
+def material_content_hash(fingerprint, export_opt):
+    """
+    :param fingerprint: The material fingerprint, see MaterialExporter.material_fingerprint
+    :param export_opt: The material export option
+    :return: hex digest of what the material encodes to. Exported materials with different names but the same
+             properties hash the same, engine materials are only their name so it is part of their hash
+    """
+    hasher = new_hash()
+    update_hash(hasher, export_opt)
+    update_hash(hasher, fingerprint if export_opt == ExportOptions.MaterialLink else fingerprint[1:])
+    return hasher.hexdigest()
+
+
+class MaterialRegistry(object):
+    """
+    The materials of one export, each encoded once however many objects use it. Materials are looked up by datablock
+    name first, so a material used by many objects is only read from blender once, then by content hash, so copies of a
+    material (ex. Material and Material.001) are encoded and written once too.
+
+    Each unique material gets an id, the name of the first datablock found with its content, which the object
+    manifests link to.
+
+    With a texture atlas, the textures of materials whose meshes can have their UVs moved are packed into it once every
+    material is encoded. Their texture links then point into the atlas, and mesh_regions has the region of each mesh.
+    """
+
+    def __init__(self, context, export_opt, cache=None, ramp_encoding=ExportOptions.RampAdaptive,
+                 ramp_tolerance=ExportOptions.RampToleranceDefault, textures=None):
+        """
+        :param context: Blender context
+        :param export_opt: The material export option, see ExportOptions.MaterialKey
+        :param cache: EncodeCache, or None to always encode
+        :param ramp_encoding: How to encode color ramps, see ExportOptions.RampEncodingKey
+        :param ramp_tolerance: Most an adaptive ramp may differ from blender's, see ExportOptions.RampToleranceKey
+        :param textures: TextureExporter.TextureRegistry to encode the image textures of the materials into, None
+                         doesn't export textures
+        """
+        self.context = context
+        self.export_opt = export_opt
+        self.cache = cache
+        self.ramp_opts = (ramp_encoding, ramp_tolerance)
+        self.textures = textures
+        self.materials = OrderedDict()  # Material id -> encoded material, in the order they were first used
+        self.hashes = {}  # Material id -> content hash
+        self.reused = 0  # Objects whose material was already encoded
+        self.mesh_regions = {}  # Mesh datablock name -> the atlas region its UVs go in, see TextureAtlas
+        self._ids_by_datablock = {}
+        self._ids_by_content = {}
+        self._atlased = []  # Ids of the materials whose texture may be packed into the atlas
+
+    def _uses_atlas(self):
+        return self.textures is not None and self.textures.atlas is not None and \
+            self.export_opt != ExportOptions.MaterialLink
+
+    def material_id(self, obj, atlas=False):
+        """
+        Encodes the material of the object, unless it (or a material with the same content) already was
+
+        :param obj: Object to pull the active material from
+        :param atlas: If the material's texture may be packed into the atlas, see atlas_materials
+        :return: The id of the object's material in materials
+        """
+        mat_name = obj.data.materials[0].name
+        material_id = self._ids_by_datablock.get(mat_name)
+        if material_id is not None:
+            self.reused += 1
+            return material_id
+
+        # A copy of an atlased material whose meshes can't use the atlas is a material of its own
+        fingerprint = material_fingerprint(obj)
+        content = (material_content_hash(fingerprint, self.export_opt), atlas)
+        material_id = self._ids_by_content.get(content)
+        if material_id is not None:
+            self.reused += 1
+        else:
+            material_id = mat_name
+            encoded = self._encode(obj, fingerprint)
+            # The textures are encoded apart from the material, so images shared by materials are only encoded once
+            if self.textures is not None and self.export_opt != ExportOptions.MaterialLink:
+                encoded = dict(encoded)
+                encoded[TexturesPropKey] = encode_material_textures(obj, self.textures, atlas)
+            if atlas:
+                self._atlased.append(material_id)
+            self.materials[material_id] = encoded
+            self.hashes[material_id] = content[0]
+            self._ids_by_content[content] = material_id
+        self._ids_by_datablock[mat_name] = material_id
+        return material_id
+
+    def atlas_materials(self, objs):
+        """
+        :param objs: The mesh objects exported
+        :return: set of the names of the materials whose texture can be packed into the atlas. Their texture has to be
+                 mapped straight onto the UVs, and every mesh using them has to have its UVs inside the texture
+        """
+        if not self._uses_atlas():
+            return set()
+        candidates = {}
+        checked = set()
+        for obj in objs:
+            mat = obj.data.materials[0]
+            if candidates.get(mat.name, True) is False:
+                continue
+            if mat.name not in candidates:
+                candidates[mat.name] = is_atlas_candidate(mat)
+            if candidates[mat.name] and obj.data.name not in checked:
+                checked.add(obj.data.name)
+                candidates[mat.name] = self.textures.atlas.uvs_fit(uv_bounds(obj))
+        return set(name for name, candidate in candidates.items() if candidate)
+
+    def _link_atlas(self, object_meshes, object_materials):
+        """
+        Packs the atlas, and points the texture links of the atlased materials at their region of it
+
+        :param object_meshes: list of (object name, mesh datablock name) of the mesh objects exported
+        :param object_materials: OrderedDict of object name -> the id of its material
+        """
+        with ExportProfiler.stage('atlas'):
+            regions = self.textures.pack_atlases()
+        material_regions = {}
+        for material_id in self._atlased:
+            link = self.materials[material_id][TexturesPropKey][0]
+            region = regions.get(link['texture'])
+            if region is None:
+                continue  # Too large for the atlas, it is a texture of its own
+            link['texture'] = region[RegionAtlasKey]
+            link['location'] = '%s.tex.bin' % region[RegionAtlasKey]
+            link['atlas_region'] = region
+            material_regions[material_id] = region
+        for obj_name, mesh_name in object_meshes:
+            region = material_regions.get(object_materials[obj_name])
+            if region is not None:
+                self.mesh_regions[mesh_name] = region
+
+    def encode_textures(self, object_meshes, object_materials):
+        """
+        Encodes the images the materials read, then packs the atlas and fills in mesh_regions. Doesn't read blender
+        data, so it can run off the main thread
+
+        :param object_meshes: list of (object name, mesh datablock name) of the mesh objects exported
+        :param object_materials: OrderedDict of object name -> the id of its material, from encode_objects
+        """
+        if self.textures is None:
+            return
+        self.textures.encode_pending()
+        if self._uses_atlas():
+            self._link_atlas(object_meshes, object_materials)
+
+    def _encode(self, obj, fingerprint):
+        with ExportProfiler.stage('encode_material', obj.name):
+            if self.cache is None:
+                return encode_material_data(obj, self.context, self.export_opt, *self.ramp_opts)
+
+            key = self.cache.key('material', fingerprint, self.export_opt, self.ramp_opts)
+            encoded = self.cache.get(key)
+            if encoded is None:
+                encoded = encode_material_data(obj, self.context, self.export_opt, *self.ramp_opts)
+                self.cache.put(key, encoded)
+            return encoded
+
+    def encode_objects(self, objs, deferred=None):
+        """
+        :param objs: The mesh objects exported
+        :param deferred: list to append the texture encoding and atlas packing to, as a function of no arguments,
+                         instead of running them. They don't read blender data, see encode_textures. None runs them now
+        :return: OrderedDict of object name -> the id of its material
+        """
+        atlased = self.atlas_materials(objs)
+        object_materials = OrderedDict((obj.name, self.material_id(obj, obj.data.materials[0].name in atlased))
+                                       for obj in objs)
+        object_meshes = [(obj.name, obj.data.name) for obj in objs]
+        if deferred is None:
+            self.encode_textures(object_meshes, object_materials)
+        else:
+            deferred.append(functools.partial(self.encode_textures, object_meshes, object_materials))
+        ExportProfiler.count('materials_unique', len(self.materials))
+        ExportProfiler.count('materials_reused', self.reused)
+        print('%d materials for %d objects, %d encoded' % (len(self._ids_by_datablock), len(object_materials),
+                                                          len(self.materials)))
+        return object_materials
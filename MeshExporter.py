@@ -1,9 +1,15 @@
-import struct
-
-import bmesh
 import numpy as np
 
-from . import ExportOptions
+try:
+    import bmesh
+except ImportError:
+    # Outside of blender, ex. in the worker processes of ParallelEncoder, only the encoding functions can be used
+    bmesh = None
+
+from . import ExportOptions, ExportProfiler
+from .VertexFormats import encode_positions, encode_normals, encode_uvs, component_dtype, TypeKey, ComponentsKey, \
+    EncodingKey, MaxErrorKey, ErrorMetricKey
+from .MeshOptimizer import optimize_mesh, VertexCacheStepKey, OverdrawStepKey, VertexFetchStepKey
 
 EncodedVertsKey = 'verts'
 EncodedNormalsKey = 'normals'
@@ -11,7 +17,18 @@ EncodedUVsKey = 'uvs'
 EncodedIndicesKey = 'indices'
 EncodedVertsLengthKey = 'length'
 EncodedTrianglesCount = 'number_triangles'
-Epsilon = 0.0001
+EncodedDedupStatsKey = 'dedup'
+EncodedOptimizeStatsKey = 'optimization'
+EncodedIndexFormatKey = 'index_format'
+EncodedSubmeshesKey = 'submeshes'
+EncodedVertexFormatsKey = 'vertex_formats'
+EncodedInterleavedKey = 'interleaved'
+EncodedVertexFormatKey = 'vertex_format'
+MaxSubmeshVertices = 65535  # 0xFFFF is left free, engines use it as the primitive restart index
+_index_formats = {
+    'u16': '<u2',  # Little-endian uint16
+    'u32': '<u4'  # Little-endian uint32
+}
 _export_verts_lu = {
     ExportOptions.MeshAll: True,
     ExportOptions.MeshNoExport: False,
@@ -58,81 +75,280 @@ def _prepare_mesh_for_export(mesh_obj):
     return bmesh_obj
 
 
-def _convert_bmesh(bmesh_obj, export_uvs, uv_layer):
+def _convert_bmesh(bmesh_obj, export_norms, export_uvs, uv_layer):
     """
-    Converts the bmesh to an intermediate format for conversion into engine format
+    Reads the triangulated bmesh into the same arrays as _extract_mesh_arrays, with the loops numbered face by face.
+    bmesh has no split normals, so flat shaded faces use the face normal and smooth faces use the vertex normals.
+
     :param bmesh_obj: The bmesh object to convert
+    :param export_norms: If we should export normals from this object
     :param export_uvs: If we should export UVs from this object
     :param uv_layer: The UV layer to export.
-    :return:
-    """
-    # Initialize intermediate format
-    index_trans = []
-    norms = []
-    verts = []
-    uvs = [None for _ in range(len(bmesh_obj.verts))]
-    trans_lists = [[] for _ in range(len(bmesh_obj.verts))]
-
-    # Initialize norms and verts to vertices in the model
-    for vert in bmesh_obj.verts:
-        norm = np.array([vert.normal.x, vert.normal.y, vert.normal.z])
-        v = np.array([vert.co.x, vert.co.y, vert.co.z])
-        verts.append(v)
-        norms.append(norm)
-
-    for face in bmesh_obj.faces:
-        for loop, vert in zip(face.loops, face.verts):
-            # If we are exporting UV's
-            if export_uvs:
-                # See if the uv doesnt exist
-                uv = np.array([loop[uv_layer].uv.x, loop[uv_layer].uv.y])
-
-                # If there is no UV recorded yet, just set the current index to this one
-                if uvs[vert.index] is None:
-                    uvs[vert.index] = uv
-                else:
-                    exst = uvs[vert.index]
-                    s = sum([abs(x - y) for (x, y) in zip(exst, uv)])
-                    if s > Epsilon:
-                        # We need to check the trans_list for a possible similar UV
-                        common_uvs = [(i, uvs[i]) for i in trans_lists[vert.index]]
-                        diffs = [(other[0], np.sum(np.absolute(uv - other[1]))) for other in common_uvs]
-                        matching = list(filter(lambda x: x[1] < Epsilon, diffs))
-
-                        if len(matching) > 0:
-                            ind, _ = matching[0]
-                            index_trans.append(ind)
-                        else:
-                            # Copy UV, vert, norm into new index
-                            newTrans = len(verts)
-                            verts.append(verts[vert.index])
-                            norms.append(norms[vert.index])
-                            uvs.append(uv)
-                            trans_lists[vert.index].append(newTrans)
-            else:
-                # Just add to index_trans list
-                index_trans.append(vert.index)
-
-    return index_trans, norms, uvs, verts
-
-
-def encode_mesh_data(bl_obj, export_opt):
-    """
-    Encodes the various mesh data elements (Verts/Normals/UVs) into bytearray structures. Will also return list of
-    indices to be used in engine
+    :return: tuple of (positions, loop_normals, loop_verts, loop_uvs, tri_loops)
+    """
+    positions = np.array([(vert.co.x, vert.co.y, vert.co.z) for vert in bmesh_obj.verts],
+                         dtype=np.float32).reshape(-1, 3)
 
-    :param bl_obj: The blender object to
-    :param export_opt: The export option chosen
-    :return: Dictionary with all of the data encoded for the given export_opt
+    loops = [loop for face in bmesh_obj.faces for loop in face.loops]
+    loop_verts = np.array([loop.vert.index for loop in loops], dtype=np.uint32)
+
+    loop_normals = None
+    if export_norms:
+        loop_normals = np.array([(loop.vert.normal if face.smooth else face.normal)[:]
+                                 for face in bmesh_obj.faces for loop in face.loops], dtype=np.float32).reshape(-1, 3)
+
+    loop_uvs = None
+    if export_uvs:
+        loop_uvs = np.array([(loop[uv_layer].uv.x, loop[uv_layer].uv.y) for loop in loops],
+                            dtype=np.float32).reshape(-1, 2)
+
+    tri_loops = np.arange(len(loops), dtype=np.uint32).reshape(-1, 3)
+    return positions, loop_normals, loop_verts, loop_uvs, tri_loops
+
+
+def _convex_quads(positions, loop_verts, quad_starts):
     """
-    print('Exporting %s mesh data' % bl_obj.name)
+    :param positions: float32 array (verts x 3) of the vertex positions
+    :param loop_verts: uint32 array of the vertex index of each loop
+    :param quad_starts: int32 array of the first loop of each quad
+    :return: bool array of if each quad is convex, so both of its diagonals are inside it. Every corner has to turn the
+             same way as the quad's (newell) normal. Concave quads and bowties don't, and neither do degenerate quads,
+             those are left to bmesh too
+    """
+    corners = positions[loop_verts[quad_starts[:, None] + np.arange(4, dtype=np.int32)]]
+    edges = np.roll(corners, -1, axis=1) - corners
+    turns = np.cross(np.roll(edges, 1, axis=1), edges)
+    return np.all(np.einsum('qkc,qc->qk', turns, turns.sum(axis=1)) > 0.0, axis=1)
 
-    # Prep mesh for export
-    bmesh_obj = _prepare_mesh_for_export(bl_obj.data)
 
-    export_verts = _export_verts_lu[export_opt]
-    export_uvs = _export_uvs_lu[export_opt]
-    export_norms = _export_norms_lu[export_opt]
+def _triangulate_polygons(mesh, positions, loop_verts):
+    """
+    Fan triangulates the polygons of the mesh given, for blender versions without the loop triangle api (2.79). A fan
+    only splits tris and convex quads the way bmesh would, so None is returned if the mesh has any n-gons or concave
+    quads, and the mesh is triangulated with bmesh instead.
+
+    :param mesh: The blender mesh to triangulate
+    :param positions: float32 array (verts x 3) of the vertex positions
+    :param loop_verts: uint32 array of the vertex index of each loop
+    :return: uint32 array (triangles x 3) of loop indices, or None if the mesh can't be fan triangulated
+    """
+    poly_count = len(mesh.polygons)
+    loop_starts = np.empty(poly_count, dtype=np.int32)
+    loop_totals = np.empty(poly_count, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', loop_starts)
+    mesh.polygons.foreach_get('loop_total', loop_totals)
+
+    if poly_count > 0 and loop_totals.max() > 4:
+        return None
+    if not np.all(_convex_quads(positions, loop_verts, loop_starts[loop_totals == 4])):
+        return None
+
+    # A polygon with n loops becomes the triangles (0, k, k + 1) for k in 1..n-2
+    tri_counts = loop_totals - 2
+    firsts = np.repeat(loop_starts, tri_counts)
+    fan = np.arange(firsts.size, dtype=np.int32) - np.repeat(np.cumsum(tri_counts) - tri_counts, tri_counts) + 1
+    return np.stack((firsts, firsts + fan, firsts + fan + 1), axis=1).astype(np.uint32)
+
+
+def _get_loop_triangles(mesh, positions, loop_verts):
+    """
+    Gets the triangulation of the mesh as loop indices, using the loop triangles of the mesh when blender has them.
+
+    :param mesh: The blender mesh to triangulate
+    :param positions: float32 array (verts x 3) of the vertex positions
+    :param loop_verts: uint32 array of the vertex index of each loop
+    :return: uint32 array (triangles x 3) of loop indices, or None if the mesh can't be triangulated without bmesh
+    """
+    if not hasattr(mesh, 'calc_loop_triangles'):
+        return _triangulate_polygons(mesh, positions, loop_verts)
+
+    mesh.calc_loop_triangles()
+    tri_loops = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('loops', tri_loops)
+    return tri_loops.view(np.uint32).reshape(-1, 3)
+
+
+def _get_loop_normals(mesh):
+    """
+    Gets the split (per loop) normals of the mesh, so hard edges and flat shading keep their own normals.
+
+    :param mesh: The blender mesh to read
+    :return: float32 array (loops x 3) of the normal of each loop
+    """
+    loop_normals = np.empty((len(mesh.loops), 3), dtype=np.float32)
+    if hasattr(mesh, 'corner_normals'):
+        # Blender 4.1+ always keeps the split normals up to date
+        mesh.corner_normals.foreach_get('vector', loop_normals.ravel())
+    else:
+        mesh.calc_normals_split()
+        mesh.loops.foreach_get('normal', loop_normals.ravel())
+    return loop_normals
+
+
+def _extract_mesh_arrays(mesh, export_norms, export_uvs):
+    """
+    Reads the mesh data straight out of the blender mesh into preallocated arrays with foreach_get, without building a
+    bmesh.
+
+    :param mesh: The blender mesh to read
+    :param export_norms: If we should read the split normals
+    :param export_uvs: If we should read the active UV layer
+    :return: tuple of (positions, loop_normals, loop_verts, loop_uvs, tri_loops), or None if the mesh needs the bmesh
+             path
+    """
+    positions = np.empty((len(mesh.vertices), 3), dtype=np.float32)
+    mesh.vertices.foreach_get('co', positions.ravel())
+
+    loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', loop_verts)
+    loop_verts = loop_verts.view(np.uint32)
+
+    with ExportProfiler.stage('triangulate'):
+        tri_loops = _get_loop_triangles(mesh, positions, loop_verts)
+    if tri_loops is None:
+        return None
+
+    loop_normals = _get_loop_normals(mesh) if export_norms else None
+
+    loop_uvs = None
+    if export_uvs:
+        loop_uvs = np.empty((len(mesh.loops), 2), dtype=np.float32)
+        mesh.uv_layers.active.data.foreach_get('uv', loop_uvs.ravel())
+
+    return positions, loop_normals, loop_verts, loop_uvs, tri_loops
+
+
+def _grid_width(values, weld_tolerance):
+    """
+    :param values: float32 array (loops x components) of attribute values
+    :param weld_tolerance: Grid spacing, see _quantize
+    :return: Bytes each grid point of the values takes, 4 unless the values are huge next to the tolerance
+    """
+    if weld_tolerance <= 0.0 or len(values) == 0:
+        return 4
+    # float32 rounding can push a grid point a little past the bound, so leave a bit of room
+    bound = max(-float(values.min()), float(values.max())) / weld_tolerance + 1.0
+    return 4 if bound < 2 ** 30 else 8
+
+
+def _quantize(values, weld_tolerance, width=4):
+    """
+    Snaps the attribute values given onto a grid with a spacing of weld_tolerance, values that snap to the same point
+    get welded. The grid points are stored big-endian with their sign bit flipped, so their bytes sort in the same
+    order as the grid points do.
+
+    :param values: float32 array (loops x components) of attribute values
+    :param weld_tolerance: Grid spacing, a tolerance of 0 only welds identical values
+    :param width: Bytes of each grid point, see _grid_width
+    :return: Big-endian unsigned array (loops x components) of the grid point of each value
+    """
+    signed = np.dtype('>i%d' % width)
+    if weld_tolerance <= 0.0:
+        # Adding 0 turns -0.0 into 0.0 so the bit patterns of equal values match
+        grid = (values + np.float32(0.0)).view(np.int32).astype(signed)
+    else:
+        grid = values / np.float32(weld_tolerance)
+        grid += np.float32(0.5)
+        grid = np.floor(grid, out=grid).astype(signed)
+    grid = grid.view('>u%d' % width)
+    grid ^= np.array(1 << (8 * width - 1), dtype=grid.dtype)
+    return grid
+
+
+def _weld_loops(keys):
+    """
+    Welds the loops that have the same key together into one vertex. Each key is one row of bytes, so the keys are
+    sorted as a single compact array, one O(n log n) pass over all of the loops no matter how many seams a vertex has.
+
+    :param keys: uint8 array (loops x key bytes), the loops to weld. The rows are compared 4 bytes at a time, so the
+                 key size has to be a multiple of 4
+    :return: tuple of (remap, first). remap is the welded vertex index of each loop, and first is the index of the first
+             loop welded into each vertex
+    """
+    if len(keys) == 0:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.intp)
+
+    order = np.argsort(keys.view(np.dtype((np.void, keys.shape[1]))).ravel(), kind='stable')
+    # Only the sorted keys are kept, the caller doesn't hold on to the unsorted ones
+    keys = keys[order].view(np.uint32)
+    starts = np.empty(len(keys), dtype=bool)
+    starts[0] = True
+    np.any(keys[1:] != keys[:-1], axis=1, out=starts[1:])
+    del keys
+
+    # The sort is stable, so the start of each run is the first loop with that key
+    remap = np.empty(len(order), dtype=np.uint32)
+    remap[order] = np.cumsum(starts, dtype=np.uint32) - 1
+    return remap, order[starts]
+
+
+def _loop_keys(key_parts, weld_tolerance):
+    """
+    Packs the grid points of each loop into one row of bytes, one part at a time so only one part is quantized at once
+
+    :param key_parts: list of (values, bytes per component) to key on. Values are float32 arrays (loops x components)
+                      of attributes, or uint32 arrays (loops x 1) of vertex indices with None bytes, which are keyed on
+                      as they are
+    :param weld_tolerance: Grid spacing, see _quantize
+    :return: uint8 array (loops x key bytes) of the key of each loop
+    """
+    keys = np.empty((len(key_parts[0][0]), sum(values.shape[1] * (width or 4) for values, width in key_parts)),
+                    dtype=np.uint8)
+    column = 0
+    for values, width in key_parts:
+        part = values.astype('>u4') if width is None else _quantize(values, weld_tolerance, width)
+        keys[:, column:column + part.shape[1] * part.itemsize] = part.view(np.uint8)
+        column += part.shape[1] * part.itemsize
+    return keys
+
+
+def _build_indexed_buffers(positions, loop_normals, loop_verts, loop_uvs, tri_loops, export_verts, weld_tolerance):
+    """
+    Builds the smallest vertex buffer and an index buffer for the triangles of the mesh. Every triangle corner (loop) is
+    keyed on its full (position, split normal, uv) tuple, and the loops with the same key share one vertex.
+
+    :param positions: float32 array (verts x 3) of the vertex positions
+    :param loop_normals: float32 array (loops x 3) of the split normal of each loop, None if not exporting normals
+    :param loop_verts: uint32 array of the vertex index of each loop
+    :param loop_uvs: float32 array (loops x 2) of the UV of each loop, None if not exporting UVs
+    :param tri_loops: uint32 array (triangles x 3) of loop indices
+    :param export_verts: If the positions are exported. If they aren't, loops are also keyed on their vertex so the
+                         buffers still line up with the mesh topology
+    :param weld_tolerance: How close the attributes of two loops have to be to share a vertex
+    :return: tuple of (index_trans, norms, uvs, verts) arrays, with None for norms/uvs if they aren't exported
+    """
+    used_loops = tri_loops.ravel()
+    loop_positions = positions[loop_verts[used_loops]]
+
+    # list of (values, bytes per component) to key on, see _loop_keys
+    key_parts = [(loop_positions, _grid_width(loop_positions, weld_tolerance))]
+    if not export_verts:
+        key_parts.append((loop_verts[used_loops, None], None))
+    if loop_normals is not None:
+        loop_normals = loop_normals[used_loops]
+        key_parts.append((loop_normals, _grid_width(loop_normals, weld_tolerance)))
+    if loop_uvs is not None:
+        loop_uvs = loop_uvs[used_loops]
+        key_parts.append((loop_uvs, _grid_width(loop_uvs, weld_tolerance)))
+
+    index_trans, first = _weld_loops(_loop_keys(key_parts, weld_tolerance))
+
+    norms = loop_normals[first] if loop_normals is not None else None
+    uvs = loop_uvs[first] if loop_uvs is not None else None
+    return index_trans, norms, uvs, loop_positions[first]
+
+
+def _extract_mesh_arrays_with_bmesh(mesh, export_norms, export_uvs):
+    """
+    Reads the mesh data through a triangulated bmesh. This is the fallback for meshes that _extract_mesh_arrays can't
+    triangulate.
+
+    :param mesh: The blender mesh to read
+    :param export_norms: If we should read the normals
+    :param export_uvs: If we should read the active UV layer
+    :return: tuple of (positions, loop_normals, loop_verts, loop_uvs, tri_loops)
+    """
+    bmesh_obj = _prepare_mesh_for_export(mesh)
 
     # Validate mesh options
     uv_layer = bmesh_obj.loops.layers.uv.active
@@ -141,34 +357,356 @@ def encode_mesh_data(bl_obj, export_opt):
         del bmesh_obj
         raise RuntimeError('Cannot encode mesh without UV when export_opt specifies to export UVs')
 
-    index_trans, norms, uvs, verts = _convert_bmesh(bmesh_obj, export_uvs, uv_layer)
+    arrays = _convert_bmesh(bmesh_obj, export_norms, export_uvs, uv_layer)
 
     bmesh_obj.free()
     del bmesh_obj
 
-    # Encode all of the mesh data into LE binary format
-    enc_vert = bytearray(len(verts) * 12) if export_verts else None
-    enc_norm = bytearray(len(norms) * 12) if export_norms else None
-    enc_uv = bytearray(len(uvs) * 8) if export_uvs else None
-    enc_ind = bytearray(len(index_trans) * 4)
-
-    for i in range(len(verts)):
-        if export_verts:
-            struct.pack_into("<fff", enc_vert, i * 12, verts[i][0], verts[i][1], verts[i][2])
-        if export_norms:
-            struct.pack_into("<fff", enc_norm, i * 12, norms[i][0], verts[i][1], verts[i][2])
-        if export_uvs:
-            struct.pack_into("<ff", enc_uv, i * 8, uvs[i][0], uvs[i][1])
-
-    for i in range(len(index_trans)):
-        struct.pack_into("<I", enc_ind, i * 4, index_trans[i])
+    return arrays
 
-    # Create dict to store all of the data to encode
+
+def _partition_triangles(index_trans, max_vertices):
+    """
+    Splits the triangles into consecutive ranges that each use at most max_vertices vertices. Each range is made as long
+    as it can be, so the triangle order (and any vertex cache optimization) is kept.
+
+    :param index_trans: uint32 array of the triangle list indices
+    :param max_vertices: Most vertices a range of triangles can use
+    :return: list of (first triangle, end triangle) ranges
+    """
+    tri_count = len(index_trans) // 3
+
+    # Position of the previous use of the same vertex for every index, -1 for the first use
+    order = np.argsort(index_trans, kind='stable')
+    repeats = index_trans[order[1:]] == index_trans[order[:-1]]
+    previous_use = np.full(len(index_trans), -1, dtype=np.int64)
+    previous_use[order[1:][repeats]] = order[:-1][repeats]
+
+    # Bounds the work done per range, a range that fits the whole window just ends at the end of the window
+    window = 3 * max_vertices
+
+    ranges = []
+    start = 0
+    while start < tri_count:
+        end = min(tri_count, start + window)
+        # An index uses a new vertex for the range if the vertex wasn't used since the range started
+        new_vertices = np.cumsum(previous_use[start * 3:end * 3] < start * 3)
+        fits = np.searchsorted(new_vertices[2::3], max_vertices, side='right')
+        ranges.append((start, start + fits))
+        start += fits
+    return ranges
+
+
+def _split_submeshes(index_trans, norms, uvs, verts, max_vertices=MaxSubmeshVertices):
+    """
+    Splits the mesh into submeshes with at most max_vertices vertices, so every submesh can use 16-bit indices. Each
+    submesh gets its own range of the vertex buffer, vertices shared by submeshes are copied into each of them.
+
+    :param index_trans: uint32 array of the triangle list indices
+    :param norms: float32 array (verts x 3) of normals, or None
+    :param uvs: float32 array (verts x 2) of uvs, or None
+    :param verts: float32 array (verts x 3) of positions
+    :param max_vertices: Most vertices a submesh can have
+    :return: tuple of (index_trans, norms, uvs, verts, submeshes). The indices are relative to the first vertex of their
+             submesh, and submeshes is a list of dicts with the index and vertex range of each submesh
+    """
+    if len(verts) <= max_vertices:
+        return index_trans, norms, uvs, verts, [_submesh_range(0, len(index_trans), 0, len(verts), 'u16')]
+
+    local_indices = []
+    vertex_sources = []
+    submeshes = []
+    vertex_offset = 0
+    for start, end in _partition_triangles(index_trans, max_vertices):
+        used, local = np.unique(index_trans[start * 3:end * 3], return_inverse=True)
+        local_indices.append(local.astype(np.uint32))
+        vertex_sources.append(used)
+        submeshes.append(_submesh_range(start * 3, (end - start) * 3, vertex_offset, len(used), 'u16'))
+        vertex_offset += len(used)
+
+    sources = np.concatenate(vertex_sources)
+    return (np.concatenate(local_indices), norms[sources] if norms is not None else None,
+            uvs[sources] if uvs is not None else None, verts[sources], submeshes)
+
+
+def _submesh_range(index_offset, index_count, vertex_offset, vertex_count, index_format):
     return {
-        EncodedVertsLengthKey: int(len(verts) / 3),
-        EncodedTrianglesCount: int(len(index_trans) / 3),
-        EncodedVertsKey: enc_vert,
-        EncodedNormalsKey: enc_norm,
-        EncodedUVsKey: enc_uv,
-        EncodedIndicesKey: enc_ind
+        'index_offset': int(index_offset),
+        'index_count': int(index_count),
+        'vertex_offset': int(vertex_offset),
+        'vertex_count': int(vertex_count),
+        'index_format': index_format
+    }
+
+
+def _choose_index_format(index_trans, norms, uvs, verts, index_opt):
+    """
+    Picks the index width for the mesh, splitting it into submeshes when needed. See ExportOptions.IndexFormatKey
+
+    :return: tuple of (index_trans, norms, uvs, verts, index_format, submeshes)
+    """
+    fits_16 = len(verts) <= MaxSubmeshVertices
+    if index_opt == ExportOptions.IndexSplit16:
+        index_trans, norms, uvs, verts, submeshes = _split_submeshes(index_trans, norms, uvs, verts)
+        return index_trans, norms, uvs, verts, 'u16', submeshes
+
+    index_format = 'u16' if fits_16 and index_opt == ExportOptions.IndexAuto else 'u32'
+    return index_trans, norms, uvs, verts, index_format, [_submesh_range(0, len(index_trans), 0, len(verts),
+                                                                         index_format)]
+
+
+def _encode_buffer(arr, buffer_format):
+    """
+    Encodes the whole array given into a binary buffer with one conversion, no per-element python work.
+
+    :param arr: The array to encode
+    :param buffer_format: numpy dtype string of the buffer elements, ex. '<f4' for little-endian float32
+    :return: bytes of the encoded array
+    """
+    return np.ascontiguousarray(arr, dtype=buffer_format).tobytes()
+
+
+def _encode_attributes(norms, uvs, verts, export_verts, export_norms, export_uvs, position_format, normal_format,
+                       uv_format):
+    """
+    Encodes each exported attribute with the format chosen for it, see VertexFormats
+
+    :return: list of (attribute key, encoded array, attribute descriptor), in the order the attributes are interleaved
+    """
+    attributes = []
+    if export_verts:
+        attributes.append((EncodedVertsKey,) + encode_positions(verts, position_format))
+    if export_norms:
+        attributes.append((EncodedNormalsKey,) + encode_normals(norms, normal_format))
+    if export_uvs:
+        attributes.append((EncodedUVsKey,) + encode_uvs(uvs, uv_format))
+    return attributes
+
+
+def _interleave(attributes, vertex_count):
+    """
+    Interleaves the encoded attributes into one vertex buffer through a structured dtype, so each attribute is copied in
+    with one array assignment. Every attribute starts on a 4 byte boundary.
+
+    :param attributes: list of (attribute key, encoded array, attribute descriptor) from _encode_attributes
+    :param vertex_count: Number of vertices in the buffer
+    :return: tuple of (bytes, vertex format). The vertex format has the stride of a vertex, and the byte offset and
+             attribute descriptor of each attribute
+    """
+    names, formats, offsets = [], [], []
+    vertex_format = {}
+    stride = 0
+    for key, _, descriptor in attributes:
+        names.append(key)
+        formats.append((component_dtype(descriptor), (descriptor[ComponentsKey],)))
+        offsets.append(stride)
+        vertex_format[key] = dict(descriptor, offset=stride)
+        size = component_dtype(descriptor).itemsize * descriptor[ComponentsKey]
+        stride += size + (-size % 4)
+
+    vertices = np.zeros(vertex_count, dtype=np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                                                      'itemsize': stride}))
+    for key, encoded, _ in attributes:
+        vertices[key] = encoded
+    return vertices.tobytes(), {'stride': stride, 'attributes': vertex_format}
+
+
+def _encode_buffers(index_trans, norms, uvs, verts, export_verts, export_norms, export_uvs, index_format='u32',
+                    position_format=ExportOptions.PositionFloat, normal_format=ExportOptions.NormalFloat,
+                    uv_format=ExportOptions.UVFloat, layout=ExportOptions.LayoutSeparate):
+    """
+    Encodes the converted mesh arrays into LE binary format
+
+    :param layout: Which vertex buffers to write, see ExportOptions.LayoutKey
+    :return: dict with the encoded buffers (None for the ones that aren't written), the attribute descriptor of each
+             exported attribute, and the vertex format of the interleaved buffer
+    """
+    attributes = _encode_attributes(norms, uvs, verts, export_verts, export_norms, export_uvs, position_format,
+                                    normal_format, uv_format)
+
+    encoded = {
+        EncodedVertsKey: None,
+        EncodedNormalsKey: None,
+        EncodedUVsKey: None,
+        EncodedInterleavedKey: None,
+        EncodedVertexFormatKey: None,
+        EncodedVertexFormatsKey: {EncodedVertsKey: None, EncodedNormalsKey: None, EncodedUVsKey: None},
+        EncodedIndicesKey: _encode_buffer(index_trans, _index_formats[index_format])
+    }
+    for key, attribute, descriptor in attributes:
+        encoded[EncodedVertexFormatsKey][key] = descriptor
+        # Position only passes (shadows, depth prepass) still get their own position stream
+        if layout == ExportOptions.LayoutSeparate or (layout == ExportOptions.LayoutInterleavedPositions and
+                                                      key == EncodedVertsKey):
+            encoded[key] = _encode_buffer(attribute, component_dtype(descriptor))
+
+    if layout != ExportOptions.LayoutSeparate:
+        encoded[EncodedInterleavedKey], encoded[EncodedVertexFormatKey] = _interleave(attributes, len(verts))
+    return encoded
+
+
+def _print_optimize_report(name, report):
+    """
+    Prints the ACMR/ATVR before and after each triangle reordering step of the mesh optimization, and the vertex fetch
+    overfetch before and after the vertex reordering
+    """
+    for step in (VertexCacheStepKey, OverdrawStepKey):
+        if step in report:
+            print('  %s %s: ACMR %.3f -> %.3f, ATVR %.3f -> %.3f' % (name, step, report[step]['acmr_before'],
+                                                                   report[step]['acmr_after'],
+                                                                   report[step]['atvr_before'],
+                                                                   report[step]['atvr_after']))
+    fetch = report[VertexFetchStepKey]
+    print('  %s %s: overfetch %.3f -> %.3f' % (name, VertexFetchStepKey, fetch['overfetch_before'],
+                                                fetch['overfetch_after']))
+
+
+def _print_format_report(name, formats):
+    """
+    Prints the encoding and largest error of each exported attribute
+    """
+    for attribute in (EncodedVertsKey, EncodedNormalsKey, EncodedUVsKey):
+        descriptor = formats[attribute]
+        if descriptor is not None:
+            print('  %s %s: %s x%d (%s), max error %g %s' % (name, attribute, descriptor[TypeKey],
+                                                           descriptor[ComponentsKey], descriptor[EncodingKey],
+                                                           descriptor[MaxErrorKey], descriptor[ErrorMetricKey]))
+
+
+def uv_bounds(bl_obj):
+    """
+    :param bl_obj: The blender object to read
+    :return: tuple of (min uv, max uv) arrays of the active UV layer of the object's mesh, None if it has no UVs
+    """
+    uv_layer = bl_obj.data.uv_layers.active
+    if uv_layer is None or len(uv_layer.data) == 0:
+        return None
+    loop_uvs = np.empty((len(uv_layer.data), 2), dtype=np.float32)
+    uv_layer.data.foreach_get('uv', loop_uvs.ravel())
+    return loop_uvs.min(axis=0), loop_uvs.max(axis=0)
+
+
+def transform_uvs(arrays, uv_transform):
+    """
+    Moves the UVs of extracted mesh arrays with the affine transform uv * scale + offset, ex. into the region of a
+    texture atlas
+
+    :param arrays: tuple of arrays from extract_mesh_data
+    :param uv_transform: tuple of ((u scale, v scale), (u offset, v offset)), None leaves the UVs as they are
+    :return: tuple of the arrays, with the transformed loop_uvs
+    """
+    positions, loop_normals, loop_verts, loop_uvs, tri_loops = arrays
+    if uv_transform is None or loop_uvs is None:
+        return arrays
+    scale, offset = np.asarray(uv_transform, dtype=np.float32)
+    return positions, loop_normals, loop_verts, loop_uvs * scale + offset, tri_loops
+
+
+def extract_mesh_data(bl_obj, export_opt, uv_transform=None):
+    """
+    Reads the mesh data the export option needs out of the blender object, without encoding any of it. Uses bulk array
+    reads, falling back to a triangulated bmesh for meshes that need it.
+
+    :param bl_obj: The blender object to read
+    :param export_opt: The export option chosen
+    :param uv_transform: Affine transform to move the UVs with, see transform_uvs
+    :return: tuple of (positions, loop_normals, loop_verts, loop_uvs, tri_loops) arrays, with None for normals/uvs if
+             they aren't exported
+    """
+    export_uvs = _export_uvs_lu[export_opt]
+    export_norms = _export_norms_lu[export_opt]
+
+    mesh = bl_obj.data
+    if export_uvs and mesh.uv_layers.active is None:
+        raise RuntimeError('Cannot encode mesh without UV when export_opt specifies to export UVs')
+
+    with ExportProfiler.stage('extract', bl_obj.name):
+        arrays = _extract_mesh_arrays(mesh, export_norms, export_uvs)
+        if arrays is None:
+            with ExportProfiler.stage('bmesh'):
+                arrays = _extract_mesh_arrays_with_bmesh(mesh, export_norms, export_uvs)
+    ExportProfiler.count('vertices_in', len(arrays[0]), bl_obj.name)
+    ExportProfiler.count('loops_in', len(arrays[2]), bl_obj.name)
+    return transform_uvs(arrays, uv_transform)
+
+
+def encode_mesh_arrays(name, arrays, export_opt, weld_tolerance=ExportOptions.WeldToleranceDefault,
+                       optimize_opt=ExportOptions.OptimizeNone, index_opt=ExportOptions.IndexSplit16,
+                       position_format=ExportOptions.PositionFloat, normal_format=ExportOptions.NormalFloat,
+                       uv_format=ExportOptions.UVFloat, layout=ExportOptions.LayoutSeparate):
+    """
+    Encodes the mesh arrays from extract_mesh_data. See encode_mesh_data for the options
+
+    :param name: Name of the mesh, for the export log
+    :param arrays: tuple of arrays from extract_mesh_data
+    :return: Dictionary with all of the data encoded for the given export_opt
+    """
+    export_verts = _export_verts_lu[export_opt]
+    export_uvs = _export_uvs_lu[export_opt]
+    export_norms = _export_norms_lu[export_opt]
+
+    with ExportProfiler.stage('weld', name):
+        index_trans, norms, uvs, verts = _build_indexed_buffers(*arrays, export_verts=export_verts,
+                                                                weld_tolerance=weld_tolerance)
+
+    # Reorder the triangles and vertices for the GPU caches
+    optimize_report = None
+    if optimize_opt != ExportOptions.OptimizeNone:
+        reduce_overdraw = optimize_opt == ExportOptions.OptimizeOverdraw
+        with ExportProfiler.stage('optimize', name):
+            index_trans, vertex_order, optimize_report = optimize_mesh(index_trans, verts, reduce_overdraw)
+        verts = verts[vertex_order]
+        norms = norms[vertex_order] if export_norms else None
+        uvs = uvs[vertex_order] if export_uvs else None
+        _print_optimize_report(name, optimize_report)
+
+    dedup_stats = {
+        'input_loops': len(index_trans),
+        'output_vertices': len(verts)
     }
+    with ExportProfiler.stage('index_format', name):
+        index_trans, norms, uvs, verts, index_format, submeshes = _choose_index_format(index_trans, norms, uvs,
+                                                                                       verts, index_opt)
+
+    # Encode all of the mesh data into LE binary format
+    with ExportProfiler.stage('encode_buffers', name):
+        encoded = _encode_buffers(index_trans, norms, uvs, verts, export_verts, export_norms, export_uvs,
+                                  index_format, position_format, normal_format, uv_format, layout)
+    ExportProfiler.count('vertices_out', len(verts), name)
+    ExportProfiler.count('triangles', len(index_trans) // 3, name)
+    _print_format_report(name, encoded[EncodedVertexFormatsKey])
+
+    # Create dict to store all of the data to encode
+    encoded.update({
+        EncodedVertsLengthKey: len(verts),
+        EncodedTrianglesCount: len(index_trans) // 3,
+        EncodedIndexFormatKey: index_format,
+        EncodedSubmeshesKey: submeshes,
+        EncodedDedupStatsKey: dedup_stats,
+        EncodedOptimizeStatsKey: optimize_report
+    })
+    return encoded
+
+
+def encode_mesh_data(bl_obj, export_opt, weld_tolerance=ExportOptions.WeldToleranceDefault,
+                     optimize_opt=ExportOptions.OptimizeNone, index_opt=ExportOptions.IndexSplit16,
+                     position_format=ExportOptions.PositionFloat, normal_format=ExportOptions.NormalFloat,
+                     uv_format=ExportOptions.UVFloat, layout=ExportOptions.LayoutSeparate):
+    """
+    Encodes the various mesh data elements (Verts/Normals/UVs) into bytes. Will also return list of indices to be used
+    in engine
+
+    :param bl_obj: The blender object to
+    :param export_opt: The export option chosen
+    :param weld_tolerance: How close the attributes of two triangle corners have to be for them to share a vertex
+    :param optimize_opt: How to reorder the triangles and vertices for rendering, see ExportOptions.OptimizeKey
+    :param index_opt: Which index width to use, see ExportOptions.IndexFormatKey
+    :param position_format: How to encode the positions, see ExportOptions.PositionFormatKey
+    :param normal_format: How to encode the normals, see ExportOptions.NormalFormatKey
+    :param uv_format: How to encode the UVs, see ExportOptions.UVFormatKey
+    :param layout: Separate attribute streams and/or an interleaved vertex buffer, see ExportOptions.LayoutKey
+    :return: Dictionary with all of the data encoded for the given export_opt
+    """
+    print('Exporting %s mesh data' % bl_obj.name)
+    return encode_mesh_arrays(bl_obj.name, extract_mesh_data(bl_obj, export_opt), export_opt, weld_tolerance,
+                              optimize_opt, index_opt, position_format, normal_format, uv_format, layout)
@@ -0,0 +1,260 @@
+import numpy as np
+
+DefaultCacheSize = 16  # Post-transform cache entries assumed when reordering triangles
+DefaultClusterFactor = 1.5  # Clusters can end once their ACMR is under this factor of the mesh's best possible ACMR
+FetchLineVertices = 2  # Vertices in a 64 byte memory line, at 32 bytes for a float position, normal and UV
+FetchCacheLines = 16  # Memory lines kept by the simulated vertex fetch cache
+
+# Report keys
+CacheSizeKey = 'cache_size'
+ClusterCountKey = 'clusters'
+VertexCacheStepKey = 'vertex_cache'
+OverdrawStepKey = 'overdraw'
+VertexFetchStepKey = 'vertex_fetch'
+
+
+def cache_miss_count(indices, cache_size=DefaultCacheSize):
+    """
+    Simulates a FIFO post-transform vertex cache over the index buffer given.
+
+    A vertex is still in a FIFO cache if fewer than cache_size misses have happened since it was loaded, so only the
+    miss count at load time is tracked per vertex instead of the cache contents.
+
+    :param indices: uint32 array of the triangle list indices
+    :param cache_size: Entries in the simulated cache
+    :return: Number of cache misses (vertex shader invocations)
+    """
+    if len(indices) == 0:
+        return 0
+
+    loaded_at = [-cache_size] * (int(indices.max()) + 1)
+    misses = 0
+    for v in indices.tolist():
+        if misses - loaded_at[v] >= cache_size:
+            loaded_at[v] = misses
+            misses += 1
+    return misses
+
+
+def _cache_stats(indices, vertex_count, cache_size):
+    """
+    :return: dict with the ACMR (misses per triangle) and ATVR (misses per vertex) of the index buffer given
+    """
+    misses = cache_miss_count(indices, cache_size)
+    return {
+        'acmr': misses / float(max(len(indices) // 3, 1)),
+        'atvr': misses / float(max(vertex_count, 1))
+    }
+
+
+def _fetch_stats(indices, vertex_count):
+    """
+    Simulates the vertex fetches of the index buffer given through a small FIFO cache of memory lines.
+
+    :return: dict with the overfetch of the index buffer, the lines loaded over the lines in the vertex buffer. 1.0 is
+             every line loaded once
+    """
+    misses = cache_miss_count(indices // FetchLineVertices, FetchCacheLines)
+    return {'overfetch': misses / float(max(-(-vertex_count // FetchLineVertices), 1))}
+
+
+def _step_report(before, after):
+    """
+    :return: dict with each stat before and after the step, ex. acmr_before and acmr_after
+    """
+    report = {}
+    for stat in sorted(before):
+        report['%s_before' % stat] = before[stat]
+        report['%s_after' % stat] = after[stat]
+    return report
+
+
+def _tipsify(indices, vertex_count, cache_size, cluster_acmr):
+    """
+    Reorders the triangles for vertex cache locality with Tipsify (Sander, Nehab and Barczak, "Fast triangle reordering
+    for vertex locality and reduced overdraw", 2007). Runs in linear time, the triangles around a fanning vertex are
+    emitted and the next fanning vertex is picked from the vertices still in the cache.
+
+    The output is also split into clusters for the overdraw pass. A cluster always ends when the fan hits a dead end,
+    and can end whenever the running ACMR of the cluster is under cluster_acmr. The overdraw pass moves the clusters
+    around, so a cluster's ACMR is counted as if it started with an empty cache.
+
+    :param indices: uint32 array of the triangle list indices
+    :param vertex_count: Number of vertices the indices reference
+    :param cache_size: Entries in the vertex cache to optimize for
+    :param cluster_acmr: ACMR a cluster needs to reach before it can be ended early
+    :return: tuple of (triangle order, cluster start offsets into the triangle order)
+    """
+    tri_count = len(indices) // 3
+    if tri_count == 0:
+        return np.empty(0, dtype=np.intp), [0]
+
+    # Triangles using each vertex, as offsets into a vertex sorted list of the triangle corners
+    use_counts = np.bincount(indices, minlength=vertex_count)
+    offsets = np.zeros(vertex_count + 1, dtype=np.int64)
+    np.cumsum(use_counts, out=offsets[1:])
+    adjacency = (np.argsort(indices, kind='stable') // 3).tolist()
+    offsets = offsets.tolist()
+
+    tris = indices.reshape(-1, 3).tolist()
+    live = use_counts.tolist()
+    cache_time = [0] * vertex_count
+    loaded_in_cluster = [-1] * vertex_count
+    emitted = bytearray(tri_count)
+    dead_ends = []
+    order = []
+    clusters = [0]
+    cluster_misses = 0
+    cluster_tris = 0
+    stamp = cache_size + 1
+    cursor = 0
+    fan = int(indices[0])
+    emit = order.append
+    push_dead_end = dead_ends.append
+
+    while fan >= 0:
+        candidates = []
+        for t in adjacency[offsets[fan]:offsets[fan + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = 1
+            emit(t)
+            cluster_tris += 1
+            tri = tris[t]
+            candidates.extend(tri)
+            for v in tri:
+                push_dead_end(v)
+                live[v] -= 1
+                if stamp - cache_time[v] > cache_size:
+                    cache_time[v] = stamp
+                    stamp += 1
+                    cluster_misses += 1
+                    loaded_in_cluster[v] = len(clusters)
+                elif loaded_in_cluster[v] != len(clusters):
+                    cluster_misses += 1
+                    loaded_in_cluster[v] = len(clusters)
+
+        # Prefer the vertex that has been in the cache the longest, as long as its fan stays in the cache
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if stamp - cache_time[v] + 2 * live[v] <= cache_size:
+                    priority = stamp - cache_time[v]
+                if priority > best:
+                    best = priority
+                    fan = v
+
+        if fan == -1:
+            # Dead end, continue from a recently used vertex or the next vertex with triangles left
+            while dead_ends and fan == -1:
+                v = dead_ends.pop()
+                if live[v] > 0:
+                    fan = v
+            while fan == -1 and cursor < vertex_count:
+                if live[cursor] > 0:
+                    fan = cursor
+                cursor += 1
+            end_cluster = True
+        else:
+            end_cluster = cluster_misses <= cluster_acmr * cluster_tris
+
+        if end_cluster and cluster_tris > 0 and fan >= 0:
+            clusters.append(len(order))
+            cluster_misses = 0
+            cluster_tris = 0
+
+    return np.array(order, dtype=np.intp), clusters
+
+
+def _sort_clusters_for_overdraw(triangles, positions, clusters):
+    """
+    Sorts the clusters of triangles so the ones most likely to occlude the rest of the mesh are drawn first. Clusters
+    facing away from the mesh centroid are on the outside of the mesh, so they are sorted by the dot product of their
+    average normal with their offset from the centroid.
+
+    :param triangles: uint32 array (triangles x 3) of the triangles, in cluster order
+    :param positions: float32 array (verts x 3) of the vertex positions
+    :param clusters: Start offsets of the clusters into triangles
+    :return: The triangle order that draws the clusters sorted
+    """
+    corners = positions[triangles].astype(np.float64)
+    # Cross product length is twice the area, so these are area weighted
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    centroids = corners.mean(axis=1)
+
+    starts = np.array(clusters, dtype=np.intp)
+    sizes = np.diff(np.append(starts, len(triangles)))
+    cluster_normals = np.add.reduceat(normals, starts, axis=0)
+    cluster_centroids = np.add.reduceat(centroids, starts, axis=0) / sizes[:, None]
+
+    lengths = np.linalg.norm(cluster_normals, axis=1)
+    lengths[lengths == 0.0] = 1.0
+    occlusion = np.einsum('ij,ij->i', cluster_centroids - centroids.mean(axis=0), cluster_normals / lengths[:, None])
+
+    cluster_rank = np.empty(len(starts), dtype=np.intp)
+    cluster_rank[np.argsort(-occlusion, kind='stable')] = np.arange(len(starts))
+    return np.argsort(np.repeat(cluster_rank, sizes), kind='stable')
+
+
+def _first_use_order(indices, vertex_count):
+    """
+    :return: The vertices ordered by when they are first used by the index buffer given, unused vertices go last
+    """
+    first_use = np.full(vertex_count, len(indices), dtype=np.int64)
+    used, first = np.unique(indices, return_index=True)
+    first_use[used] = first
+    return np.argsort(first_use, kind='stable')
+
+
+def optimize_mesh(indices, positions, reduce_overdraw=False, cache_size=DefaultCacheSize,
+                  cluster_factor=DefaultClusterFactor):
+    """
+    Reorders the triangles of an indexed mesh for the GPU. The triangles are reordered for post-transform vertex cache
+    hits, optionally sorted in clusters to reduce overdraw, then the vertices are reordered in the order they are first
+    used so vertex fetches are close together in memory, unless that loads more memory lines than the order they are
+    in already.
+
+    :param indices: uint32 array of the triangle list indices
+    :param positions: float32 array (verts x 3) of the vertex positions, only used to reduce overdraw
+    :param reduce_overdraw: If the triangles should be sorted to reduce overdraw, at some cost to cache hits
+    :param cache_size: Entries in the vertex cache to optimize for
+    :param cluster_factor: See DefaultClusterFactor
+    :return: tuple of (indices, vertex order, report). The new indices reference the vertices reordered with
+             vertex order (new_attribute = attribute[vertex order]). The report has the ACMR/ATVR before and after the
+             triangle reordering steps, and the vertex fetch overfetch before and after the vertex reordering.
+    """
+    vertex_count = len(positions)
+    tri_count = len(indices) // 3
+    report = {CacheSizeKey: cache_size}
+
+    before = _cache_stats(indices, vertex_count, cache_size)
+    cluster_acmr = cluster_factor * vertex_count / float(max(tri_count, 1))
+    tri_order, clusters = _tipsify(indices, vertex_count, cache_size, cluster_acmr)
+    triangles = indices.reshape(-1, 3)[tri_order]
+    after = _cache_stats(triangles.ravel(), vertex_count, cache_size)
+    report[VertexCacheStepKey] = _step_report(before, after)
+
+    if reduce_overdraw:
+        before = after
+        triangles = triangles[_sort_clusters_for_overdraw(triangles, positions, clusters)]
+        after = _cache_stats(triangles.ravel(), vertex_count, cache_size)
+        report[OverdrawStepKey] = _step_report(before, after)
+        report[ClusterCountKey] = len(clusters)
+
+    # Renaming the vertices doesn't change which indices hit the cache, only how far apart the fetches are
+    vertex_order = _first_use_order(triangles.ravel(), vertex_count)
+    remap = np.empty(vertex_count, dtype=np.uint32)
+    remap[vertex_order] = np.arange(vertex_count, dtype=np.uint32)
+    optimized = remap[triangles.ravel()]
+    before = _fetch_stats(triangles.ravel(), vertex_count)
+    after = _fetch_stats(optimized, vertex_count)
+    if after['overfetch'] >= before['overfetch']:
+        # The vertices were already closer together (ex. welded in position order), keep their order
+        vertex_order = np.arange(vertex_count)
+        optimized = triangles.ravel().astype(np.uint32)
+        after = before
+    report[VertexFetchStepKey] = _step_report(before, after)
+
+    return optimized, vertex_order, report
@@ -0,0 +1,506 @@
+import collections
+import json
+import lzma
+import os
+import struct
+import time
+import zipfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .EncodeCache import new_hash
+
+# Member info keys, see ArchiveWriter.members
+MemberCRCKey = 'crc32'
+MemberLengthKey = 'length'
+MemberHashKey = 'hash'
+MemberMethodKey = 'method'  # zip compression method number
+MemberLevelKey = 'level'  # Compression level or preset, None for the default of the method
+
+ManifestName = 'manifest.json'
+ManifestMembersKey = 'members'  # Member info of every member besides the manifest
+ManifestHashTypeKey = 'members_hash'  # Name of the hash used for the member hashes
+
+DefaultLZMAPreset = 6
+
+# Zstandard members need python 3.14+, None when zipfile can't read them
+ZipZstandard = getattr(zipfile, 'ZIP_ZSTANDARD', None)
+
+_LocalHeader = struct.Struct('<IHHHHHIIIHH')
+_LocalHeaderSignature = 0x04034b50
+_CentralHeader = struct.Struct('<IHHHHHHIIIHHHHHII')
+_CentralHeaderSignature = 0x02014b50
+_EndRecord = struct.Struct('<IHHHHIIH')
+_EndRecordSignature = 0x06054b50
+_Zip64EndRecord = struct.Struct('<IQHHIIQQQQ')
+_Zip64EndRecordSignature = 0x06064b50
+_Zip64Locator = struct.Struct('<IIQI')
+_Zip64LocatorSignature = 0x07064b50
+_Zip64ExtraId = 0x0001
+_AlignmentExtraId = 0xD935  # Padding extra field aligning the member data, the same id Android's zipalign uses
+_Zip64Limit = 0xFFFFFFFF
+_Zip64EntryLimit = 0xFFFF
+
+_FlagLZMAEndMarker = 0x02  # The LZMA stream ends with an end of stream marker
+_FlagDataDescriptor = 0x08  # Sizes and CRC follow the member data instead of being in the local header
+_FlagUTF8 = 0x800  # The member name is UTF-8
+
+# Version needed to extract, by method
+_extract_versions = {
+    zipfile.ZIP_STORED: 20,
+    zipfile.ZIP_DEFLATED: 20,
+    zipfile.ZIP_LZMA: 63
+}
+if ZipZstandard is not None:
+    _extract_versions[ZipZstandard] = 63
+_Zip64Version = 45
+
+# LZMA dictionary size of each preset, the zip LZMA header needs the properties of the stream
+_lzma_dict_sizes = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]
+
+
+def content_hash_type():
+    """
+    :return: Name of the hash used for member hashes, archives hashed with a different one can't be compared
+    """
+    return new_hash().name
+
+
+def content_hash(data):
+    """
+    :return: hex digest of the bytes given
+    """
+    hasher = new_hash()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def _compress_lzma(data, preset):
+    """
+    Compresses the data given into the LZMA format zip uses, a raw LZMA1 stream after a header with the stream
+    properties. Same as zipfile's LZMA compressor, but with a selectable preset.
+    """
+    filters = {'id': lzma.FILTER_LZMA1, 'preset': preset, 'dict_size': _lzma_dict_sizes[preset], 'lc': 3, 'lp': 0,
+               'pb': 2}
+    properties = struct.pack('<BI', (filters['pb'] * 5 + filters['lp']) * 9 + filters['lc'], filters['dict_size'])
+    header = struct.pack('<BBH', 9, 4, len(properties)) + properties
+    return header + lzma.compress(data, format=lzma.FORMAT_RAW, filters=[filters])
+
+
+def _decompress_lzma(compressed):
+    properties_size = struct.unpack_from('<H', compressed, 2)[0]
+    properties, dict_size = struct.unpack_from('<BI', compressed, 4)
+    filters = {'id': lzma.FILTER_LZMA1, 'lc': properties % 9, 'lp': properties // 9 % 5, 'pb': properties // 45,
+               'dict_size': dict_size}
+    decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[filters])
+    return decompressor.decompress(compressed[4 + properties_size:])
+
+
+def compress(data, method=zipfile.ZIP_LZMA, level=None):
+    """
+    Compresses the data given for a zip member
+
+    :param data: bytes to compress
+    :param method: zipfile.ZIP_STORED, ZIP_DEFLATED, ZIP_LZMA or ZipZstandard
+    :param level: zlib level for deflate, LZMA preset, or zstd level. None for the default
+    :return: The compressed bytes
+    """
+    if method == zipfile.ZIP_STORED:
+        return bytes(data)
+    elif method == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+    elif method == zipfile.ZIP_LZMA:
+        return _compress_lzma(data, level if level is not None else DefaultLZMAPreset)
+    elif ZipZstandard is not None and method == ZipZstandard:
+        from compression import zstd
+        return zstd.compress(data, level)
+
+    raise RuntimeError('Compression method %s not supported' % str(method))
+
+
+def decompress(compressed, method):
+    """
+    Decompresses the data of a zip member, see compress
+
+    :param compressed: The compressed bytes
+    :param method: The zip compression method of the member
+    :return: The uncompressed bytes
+    """
+    if method == zipfile.ZIP_STORED:
+        return bytes(compressed)
+    elif method == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(compressed, -15)
+    elif method == zipfile.ZIP_LZMA:
+        return _decompress_lzma(compressed)
+    elif ZipZstandard is not None and method == ZipZstandard:
+        from compression import zstd
+        return zstd.decompress(compressed)
+
+    raise RuntimeError('Compression method %s not supported' % str(method))
+
+
+class ArchiveEntry(object):
+    """
+    A compressed member, ready to be written into an archive
+    """
+
+    def __init__(self, name, compressed, crc, length, method, data_hash, flags=0, level=None):
+        """
+        :param name: Name of the member inside of the archive
+        :param compressed: The compressed bytes of the member
+        :param crc: CRC32 of the uncompressed bytes
+        :param length: Length of the uncompressed bytes
+        :param method: zipfile compression method
+        :param data_hash: content_hash of the uncompressed bytes
+        :param flags: zip general purpose flags
+        :param level: Compression level the member was compressed with, see compress
+        """
+        self.name = name
+        self.compressed = compressed
+        self.crc = crc
+        self.length = length
+        self.method = method
+        self.level = level
+        self.content_hash = data_hash
+        self.decode_time = None  # Seconds to decompress the member, if it was measured
+        self.compress_time = None  # Seconds it took to compress the member, None if it was copied
+        self.flags = flags
+        if method == zipfile.ZIP_LZMA:
+            self.flags |= _FlagLZMAEndMarker
+
+    @classmethod
+    def from_bytes(cls, name, data, method=zipfile.ZIP_LZMA, level=None, data_hash=None):
+        """
+        Compresses the bytes given into an entry
+
+        :param data_hash: content_hash of the data if it is already known
+        :return: The ArchiveEntry
+        """
+        return cls(name, compress(data, method, level), zlib.crc32(data) & 0xFFFFFFFF, len(data), method,
+                   data_hash if data_hash is not None else content_hash(data), level=level)
+
+    def measure_decode(self):
+        """
+        Times decompressing the member, into decode_time
+
+        :return: self
+        """
+        start = time.perf_counter()
+        decompress(self.compressed, self.method)
+        self.decode_time = time.perf_counter() - start
+        return self
+
+    def member_info(self):
+        """
+        :return: dict with the CRC32, uncompressed length, content hash and compression of the member
+        """
+        return {MemberCRCKey: self.crc, MemberLengthKey: self.length, MemberHashKey: self.content_hash,
+                MemberMethodKey: self.method, MemberLevelKey: self.level}
+
+
+class PreviousArchive(object):
+    """
+    An archive written by an earlier export, to copy the compressed members that haven't changed from
+    """
+
+    def __init__(self, filepath):
+        """
+        :param filepath: Path of the archive. If it is missing, or has no member info, no members can be reused
+        """
+        self._fp = None
+        self._infos = {}
+        self._members = {}
+        if not os.path.isfile(filepath):
+            return
+
+        try:
+            with zipfile.ZipFile(filepath, 'r') as z:
+                manifest = json.loads(z.read(ManifestName).decode('utf-8'))
+                infos = dict((info.filename, info) for info in z.infolist())
+        except (zipfile.BadZipfile, KeyError, ValueError):
+            print('Could not read %s, compressing every member' % filepath)
+            return
+
+        if manifest.get(ManifestHashTypeKey) != content_hash_type():
+            return
+        self._infos = infos
+        self._members = manifest.get(ManifestMembersKey) or {}
+        self._fp = open(filepath, 'rb')
+
+    def reuse(self, name, data_hash, length, method, level):
+        """
+        :param name: Name of the member
+        :param data_hash: content_hash of the new bytes of the member
+        :param length: Length of the new bytes of the member
+        :param method: Compression method the new member would be compressed with
+        :param level: Compression level the new member would be compressed with
+        :return: ArchiveEntry with the compressed bytes of the previous member, or None if the member changed or was
+                 compressed differently
+        """
+        member = self._members.get(name)
+        info = self._infos.get(name)
+        if member is None or info is None:
+            return None
+        if member[MemberHashKey] != data_hash or member[MemberLengthKey] != length:
+            return None
+        if info.compress_type != method or member.get(MemberLevelKey) != level:
+            return None
+
+        # Skip the local header, its name and extra field lengths can differ from the central directory's
+        self._fp.seek(info.header_offset)
+        header = _LocalHeader.unpack(self._fp.read(_LocalHeader.size))
+        self._fp.seek(header[-2] + header[-1], os.SEEK_CUR)
+        compressed = self._fp.read(info.compress_size)
+        # Sizes and CRC go in the local header, so a data descriptor is never written after the copied data
+        flags = info.flag_bits & ~_FlagDataDescriptor
+        return ArchiveEntry(name, compressed, info.CRC, info.file_size, info.compress_type, data_hash, flags, level)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+def _dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return dos_date, dos_time
+
+
+def _default_policy(name, data):
+    return zipfile.ZIP_LZMA, None
+
+
+def _compress_entry(name, data, method, level, data_hash, measure_decode):
+    start = time.perf_counter()
+    entry = ArchiveEntry.from_bytes(name, data, method, level, data_hash)
+    entry.compress_time = time.perf_counter() - start
+    return entry.measure_decode() if measure_decode else entry
+
+
+class EntryStats(object):
+    """
+    The name, compression, lengths, compress and decode time of an entry, without the compressed bytes
+    """
+
+    def __init__(self, entry):
+        self.name = entry.name
+        self.method = entry.method
+        self.level = entry.level
+        self.length = entry.length
+        self.compressed_length = len(entry.compressed)
+        self.decode_time = entry.decode_time
+        self.compress_time = entry.compress_time
+
+
+class ArchiveWriter(object):
+    """
+    Writes a standard zip archive from precompressed members. The archive is written next to filepath and only replaces
+    it once it is closed, so the previous archive can be read while the new one is written.
+
+    With more than one worker, members are compressed on a thread pool (zlib and lzma release the GIL while they
+    compress) and written in the order they were added as they finish, so the archive is the same for any worker count.
+
+    writestr is compatible with zipfile.ZipFile.writestr, so the manifest code can write into either.
+    """
+
+    def __init__(self, filepath, previous=None, policy=None, workers=1, measure_decode=False):
+        """
+        :param filepath: Where to save the archive
+        :param previous: PreviousArchive to copy unchanged members from, or None to compress every member
+        :param policy: Function of (member name, bytes) -> (zip compression method, level) picking how to compress each
+                       member. None compresses every member with LZMA
+        :param workers: Threads compressing members, None for one per core
+        :param measure_decode: If the time to decompress each new member should be measured, see entries
+        """
+        self.filepath = filepath
+        self.previous = previous
+        self.policy = policy if policy is not None else _default_policy
+        self.measure_decode = measure_decode
+        self.entries = []  # The entries written, without their compressed bytes, for reporting
+        self.reused = 0
+        self.compressed = 0
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._pool = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        self._max_pending = self.workers * 2  # Keeps every worker busy while the oldest entry is written
+        self._pending = collections.deque()  # (entry or future of one, alignment) not written yet, in order
+        self._temp_path = filepath + '.tmp'
+        self._fp = open(self._temp_path, 'wb')
+        self._central = []
+        self._members = {}
+        self._date, self._time = _dos_date_time(time.time())
+
+    def writestr(self, name, data, compress_type=None, compresslevel=None, alignment=1):
+        """
+        Adds a member with the bytes given, copying the previous archive's member instead of compressing when it has
+        the same content
+
+        :param name: Name of the member inside of the archive
+        :param data: bytes of the member
+        :param compress_type: zip compression method for this member, None to use the policy
+        :param compresslevel: Compression level for compress_type
+        :param alignment: Byte alignment of the member data in the file, so stored members can be memory mapped and
+                          read in place
+        """
+        if compress_type is None:
+            method, level = self.policy(name, data)
+        else:
+            method, level = compress_type, compresslevel
+        data_hash = content_hash(data)
+        entry = None
+        if self.previous is not None:
+            entry = self.previous.reuse(name, data_hash, len(data), method, level)
+
+        if entry is not None:
+            self.reused += 1
+        elif self._pool is not None:
+            entry = self._pool.submit(_compress_entry, name, data, method, level, data_hash, self.measure_decode)
+            self.compressed += 1
+        else:
+            entry = _compress_entry(name, data, method, level, data_hash, self.measure_decode)
+            self.compressed += 1
+        self.write_entry(entry, alignment)
+
+    def write_entry(self, entry, alignment=1):
+        """
+        Adds a precompressed member to the archive, it is written after the members added before it
+
+        :param entry: The ArchiveEntry to write, or a Future of one
+        :param alignment: Byte alignment of the member data in the file
+        """
+        self._pending.append((entry, alignment))
+        # Each pending entry holds its bytes, so only a few can wait at a time. Otherwise an export adding members
+        # faster than they compress would keep every buffer of the scene in memory
+        self._write_pending(wait=True, keep=self._max_pending)
+
+    def _write_pending(self, wait, keep=0):
+        """
+        Writes the pending entries in order, stopping at the first one still being compressed. If wait is set, waits for
+        the entries being compressed until at most keep entries are pending.
+        """
+        while self._pending:
+            entry, alignment = self._pending[0]
+            if isinstance(entry, Future):
+                if not entry.done() and (not wait or len(self._pending) <= keep):
+                    return
+                entry = entry.result()
+            self._pending.popleft()
+            self._write_entry(entry, alignment)
+
+    def _write_entry(self, entry, alignment=1):
+        name = entry.name.encode('utf-8')
+        flags = entry.flags
+        if name != entry.name.encode('ascii', 'replace'):
+            flags |= _FlagUTF8
+
+        offset = self._fp.tell()
+        zip64 = max(len(entry.compressed), entry.length) >= _Zip64Limit
+        extra = struct.pack('<HHQQ', _Zip64ExtraId, 16, entry.length, len(entry.compressed)) if zip64 else b''
+        version = max(_extract_versions[entry.method], _Zip64Version if zip64 else 0)
+        compressed_size = _Zip64Limit if zip64 else len(entry.compressed)
+        length = _Zip64Limit if zip64 else entry.length
+
+        # Pad the extra field until the data starts on the alignment, the padding record needs at least its 4 byte
+        # header
+        data_offset = offset + _LocalHeader.size + len(name) + len(extra)
+        if alignment > 1 and data_offset % alignment != 0:
+            padding = (-(data_offset + 4)) % alignment
+            extra += struct.pack('<HH', _AlignmentExtraId, padding) + b'\0' * padding
+
+        self._fp.write(_LocalHeader.pack(_LocalHeaderSignature, version, flags, entry.method, self._time, self._date,
+                                         entry.crc, compressed_size, length, len(name), len(extra)))
+        self._fp.write(name)
+        self._fp.write(extra)
+        self._fp.write(entry.compressed)
+
+        # Only keep what the central directory needs, not the compressed bytes
+        self._central.append((name, flags, entry.method, entry.crc, len(entry.compressed), entry.length, offset))
+        self.entries.append(EntryStats(entry))
+        if entry.name != ManifestName:
+            self._members[entry.name] = entry.member_info()
+
+    def members(self):
+        """
+        Waits for the members still being compressed
+
+        :return: dict of member name -> member info (crc32, length, hash) of every member added so far
+        """
+        self._write_pending(wait=True)
+        return dict(self._members)
+
+    def _write_central_directory(self):
+        start = self._fp.tell()
+        for name, flags, method, crc, compressed_size, length, offset in self._central:
+            fields = []
+            if length >= _Zip64Limit:
+                fields.append(length)
+                length = _Zip64Limit
+            if compressed_size >= _Zip64Limit:
+                fields.append(compressed_size)
+                compressed_size = _Zip64Limit
+            if offset >= _Zip64Limit:
+                fields.append(offset)
+                offset = _Zip64Limit
+            extra = struct.pack('<HH%dQ' % len(fields), _Zip64ExtraId, 8 * len(fields), *fields) if fields else b''
+            version = max(_extract_versions[method], _Zip64Version if fields else 0)
+
+            self._fp.write(_CentralHeader.pack(_CentralHeaderSignature, version, version, flags, method, self._time,
+                                               self._date, crc, compressed_size, length, len(name), len(extra), 0, 0,
+                                               0, 0, offset))
+            self._fp.write(name)
+            self._fp.write(extra)
+
+        end = self._fp.tell()
+        count = len(self._central)
+        size = end - start
+        if count >= _Zip64EntryLimit or size >= _Zip64Limit or start >= _Zip64Limit:
+            self._fp.write(_Zip64EndRecord.pack(_Zip64EndRecordSignature, _Zip64EndRecord.size - 12, _Zip64Version,
+                                                _Zip64Version, 0, 0, count, count, size, start))
+            self._fp.write(_Zip64Locator.pack(_Zip64LocatorSignature, 0, end, 1))
+            count = min(count, _Zip64EntryLimit)
+            size = min(size, _Zip64Limit)
+            start = min(start, _Zip64Limit)
+        self._fp.write(_EndRecord.pack(_EndRecordSignature, 0, 0, count, count, size, start, 0))
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self.previous is not None:
+            self.previous.close()
+
+    def close(self):
+        """
+        Waits for the members still being compressed, writes the central directory and replaces the archive at filepath
+        with the new one
+        """
+        try:
+            self._write_pending(wait=True)
+            self._write_central_directory()
+        finally:
+            self._fp.close()
+            self._shutdown()
+        os.replace(self._temp_path, self.filepath)
+
+    def abort(self):
+        """
+        Deletes the partially written archive, leaving the one at filepath as it was
+        """
+        for entry, _ in self._pending:
+            if isinstance(entry, Future):
+                entry.cancel()
+        self._pending.clear()
+        self._fp.close()
+        self._shutdown()
+        os.remove(self._temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
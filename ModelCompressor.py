@@ -1,9 +1,151 @@
 import json
+import os
 import zipfile
+from collections import OrderedDict
 
-from .MeshExporter import EncodedIndicesKey, EncodedUVsKey, EncodedNormalsKey, EncodedVertsKey
+from . import ExportOptions, ExportProfiler
+from .BufferFilters import apply_filter, pick_filter, shuffle_filter, delta_filter, FilterShuffle, FilterDelta
+from .PackedBuffers import PackedBufferWriter, PackedBufferName, PackedCompressedKey
+from .ModelArchive import ArchiveWriter, ArchiveEntry, EntryStats, PreviousArchive, content_hash, content_hash_type, \
+    ManifestName, ManifestMembersKey, ManifestHashTypeKey, ZipZstandard
+from .MeshExporter import EncodedIndicesKey, EncodedUVsKey, EncodedNormalsKey, EncodedVertsKey, EncodedDedupStatsKey, \
+    EncodedOptimizeStatsKey, EncodedIndexFormatKey, EncodedSubmeshesKey, EncodedVertexFormatsKey, \
+    EncodedInterleavedKey, EncodedVertexFormatKey
+from .VertexFormats import component_dtype, ComponentsKey, EncodingKey, AABBEncoding, RawEncoding
+from .MaterialExporter import TexturesPropKey
+from .TextureExporter import EncodedTextureFormatKey, EncodedTextureWidthKey, EncodedTextureHeightKey, \
+    EncodedTextureSRGBKey, EncodedTextureMipsKey
 from .ModelExporter import MeshTransformsKey, MetadataKey, AnimationDataKey, MaterialDataKey, MeshDataKey, \
-    ExportedMeshesKey
+    ExportedMeshesKey, MeshInstancesKey, ObjectMeshesKey, ObjectMaterialsKey, InstanceObjectsKey, \
+    InstanceTransformsKey, TextureDataKey, MeshUVAtlasKey
+
+
+# Member types, the compression presets pick a compression method and level for each
+JsonMemberType = 'json'
+MeshMemberType = 'mesh'
+InstancesMemberType = 'instances'
+TextureMemberType = 'texture'
+SmallMemberLength = 1024  # Members shorter than this are stored, compressing them saves next to nothing
+
+_compression_presets = {
+    ExportOptions.CompressionStore: {
+        JsonMemberType: (zipfile.ZIP_STORED, None),
+        MeshMemberType: (zipfile.ZIP_STORED, None),
+        InstancesMemberType: (zipfile.ZIP_STORED, None),
+        TextureMemberType: (zipfile.ZIP_STORED, None)
+    },
+    ExportOptions.CompressionFastLoad: {
+        JsonMemberType: (zipfile.ZIP_DEFLATED, 6),
+        MeshMemberType: (zipfile.ZIP_DEFLATED, 6),
+        InstancesMemberType: (zipfile.ZIP_DEFLATED, 6),
+        TextureMemberType: (zipfile.ZIP_DEFLATED, 6)
+    },
+    ExportOptions.CompressionBalanced: {
+        JsonMemberType: (zipfile.ZIP_DEFLATED, 9),
+        MeshMemberType: (zipfile.ZIP_LZMA, 6),
+        InstancesMemberType: (zipfile.ZIP_LZMA, 6),
+        TextureMemberType: (zipfile.ZIP_LZMA, 6)
+    },
+    ExportOptions.CompressionDistribution: {
+        JsonMemberType: (zipfile.ZIP_LZMA, 9),
+        MeshMemberType: (zipfile.ZIP_LZMA, 9),
+        InstancesMemberType: (zipfile.ZIP_LZMA, 9),
+        TextureMemberType: (zipfile.ZIP_LZMA, 9)
+    }
+}
+if ZipZstandard is not None:
+    _compression_presets[ExportOptions.CompressionZstd] = {
+        JsonMemberType: (ZipZstandard, 3),
+        MeshMemberType: (ZipZstandard, 19),
+        InstancesMemberType: (ZipZstandard, 19),
+        TextureMemberType: (ZipZstandard, 19)
+    }
+
+_index_strides = {'u16': 2, 'u32': 4}
+_TransformStride = 64  # 4x4 float32 matrix per instance
+
+_method_names = {
+    zipfile.ZIP_STORED: 'store',
+    zipfile.ZIP_DEFLATED: 'deflate',
+    zipfile.ZIP_LZMA: 'lzma',
+    ZipZstandard: 'zstd'
+}
+
+
+def compression_presets():
+    """
+    :return: The compression presets this python can write, zstd needs python 3.14+
+    """
+    return sorted(_compression_presets)
+
+
+def _member_type(name):
+    if name.endswith('.json'):
+        return JsonMemberType
+    elif name.endswith('.inst.bin'):
+        return InstancesMemberType
+    elif name.endswith('.tex.bin'):
+        return TextureMemberType
+    return MeshMemberType
+
+
+def compression_policy(preset):
+    """
+    :param preset: The compression preset, see ExportOptions.CompressionKey
+    :return: Function of (member name, bytes) -> (zip compression method, level), see ModelArchive.ArchiveWriter
+    """
+    if preset not in _compression_presets:
+        raise RuntimeError("Compression preset '%s' is not supported by this version of python" % str(preset))
+    methods = _compression_presets[preset]
+
+    def policy(name, data):
+        if len(data) < SmallMemberLength:
+            return zipfile.ZIP_STORED, None
+        return methods[_member_type(name)]
+
+    return policy
+
+
+def _print_compression_report(title, entries):
+    """
+    Prints the compressed size and decode time of the entries given, per member type and compression
+    """
+    totals = OrderedDict()
+    for entry in sorted(entries, key=lambda e: (_member_type(e.name), e.method, e.level or 0)):
+        key = (_member_type(entry.name), _method_names[entry.method], entry.level)
+        total = totals.setdefault(key, [0, 0, 0, 0.0])
+        total[0] += 1
+        total[1] += entry.length
+        total[2] += entry.compressed_length
+        total[3] += entry.decode_time or 0.0
+
+    print(title)
+    for (member_type, method, level), (count, length, compressed_length, decode_time) in totals.items():
+        print('  %-9s %-7s level %-4s %4d members %11d -> %11d bytes (%5.1f%%), decode %.4fs' % (
+            member_type, method, level, count, length, compressed_length, 100.0 * compressed_length / max(length, 1),
+            decode_time))
+    length = sum(total[1] for total in totals.values())
+    compressed_length = sum(total[2] for total in totals.values())
+    print('  total %d -> %d bytes (%.1f%%), decode %.4fs' % (length, compressed_length,
+                                                             100.0 * compressed_length / max(length, 1),
+                                                             sum(total[3] for total in totals.values())))
+
+
+def compression_report(filepath):
+    """
+    Compresses the members of the archive given with every compression preset, and prints the size and decode time of
+    each member type, to trade archive size against load time.
+
+    :param filepath: The .model archive to report on
+    """
+    with zipfile.ZipFile(filepath, 'r') as z:
+        members = [(info.filename, z.read(info)) for info in z.infolist()]
+
+    for preset in compression_presets():
+        policy = compression_policy(preset)
+        entries = [EntryStats(ArchiveEntry.from_bytes(name, data, *policy(name, data)).measure_decode())
+                   for name, data in members]
+        _print_compression_report("Compression preset '%s':" % preset, entries)
 
 
 def _generate_mesh_link(encoded_mesh_data, model_name, type):
@@ -12,14 +154,76 @@ def _generate_mesh_link(encoded_mesh_data, model_name, type):
     return link
 
 
-def _save_bytes(bytes, name, zfile):
+def _save_bytes(bytes, name, zfile, buffer_filter=None):
     """
     Save the bytes given into the zfile with the name given
     :param bytes: The bytes to compress and save
     :param name: The name of the file inside of the archive
     :param zfile: The zipfile
+    :param buffer_filter: Filter descriptor to filter the bytes with before they are compressed, see BufferFilters
     """
-    zfile.writestr(name, bytes)
+    zfile.writestr(name, apply_filter(bytes, buffer_filter))
+
+
+def _choose_filter(data, filter_mode, standard, candidates):
+    """
+    :param data: The bytes of the buffer
+    :param filter_mode: See ExportOptions.BufferFilterKey
+    :param standard: The filter the standard mode uses for the buffer, None for none
+    :param candidates: The other filters the auto mode tries on the buffer
+    :return: Filter descriptor, or None to save the buffer unfiltered
+    """
+    if filter_mode == ExportOptions.BufferFilterStandard:
+        if standard is None:
+            return None
+        # Still checked against no filter, a filter that suits most meshes can make a regular one compress worse
+        with ExportProfiler.stage('choose_filter'):
+            return pick_filter(data, [standard])
+    elif filter_mode == ExportOptions.BufferFilterAuto:
+        with ExportProfiler.stage('choose_filter'):
+            return pick_filter(data, [standard] + candidates)
+    return None
+
+
+def _attribute_filter(data, descriptor, filter_mode, raw_filter=FilterShuffle):
+    """
+    Delta for the streams quantized over their bounding box (neighbouring vertices have close positions/uvs), byte
+    planes for octahedral normals, and the raw filter given for float streams
+
+    :param raw_filter: FilterShuffle, FilterDelta or None, the standard filter of the stream if it isn't quantized
+    """
+    size = component_dtype(descriptor).itemsize
+    int_type = 'u%d' % (size * 8)
+    components = descriptor[ComponentsKey]
+    delta = delta_filter(int_type, components)
+    shuffle = shuffle_filter(size) if size > 1 else None
+    if descriptor[EncodingKey] == AABBEncoding:
+        standard = delta
+    elif descriptor[EncodingKey] == RawEncoding:
+        standard = {FilterShuffle: shuffle, FilterDelta: delta, None: None}[raw_filter]
+    else:
+        standard = shuffle
+    return _choose_filter(data, filter_mode, standard, [shuffle, delta, delta_filter(int_type, components, True)])
+
+
+def _index_filter(data, index_format, filter_mode):
+    """
+    Delta+zigzag for index streams, consecutive triangles mostly use nearby vertices
+    """
+    return _choose_filter(data, filter_mode, delta_filter(index_format, zigzag=True), [delta_filter(index_format)])
+
+
+def _vertex_buffer_filter(data, vertex_format, filter_mode):
+    """
+    Byte planes over the whole vertex for interleaved buffers, every attribute is 4 byte aligned
+    """
+    stride = vertex_format['stride']
+    return _choose_filter(data, filter_mode, shuffle_filter(stride),
+                          [delta_filter('u32', stride // 4), delta_filter('u32', stride // 4, True)])
+
+
+def _transforms_filter(data, filter_mode):
+    return _choose_filter(data, filter_mode, shuffle_filter(4), [delta_filter('u32', 16)])
 
 
 def _save_dict_as_json(d, name, zfile):
@@ -32,67 +236,216 @@ def _save_dict_as_json(d, name, zfile):
     zfile.writestr(name, str.encode(json.dumps(d, sort_keys=True, indent=2), 'utf-8'))
 
 
-def _save_model_and_generate_manifest(model_name, transform_data, zfile, material_data=None, mesh_data=None,
-                                      animation_data=None, metadata=None):
+def _attribute_stride(descriptor):
+    return component_dtype(descriptor).itemsize * descriptor[ComponentsKey]
+
+
+def _save_mesh_and_generate_manifest(mesh_name, mesh_data, zfile, filter_mode=ExportOptions.BufferFilterNone,
+                                     packer=None):
     """
-    Generates a manifest for a model and saves the data for the model into the zipfile given
-    :param model_name: The name of the model given
-    :param transform_data: The local transformations made in the scene for the given model
+    Saves the buffers of a mesh datablock into the zipfile given, and generates the manifest linking them
+    :param mesh_name: The name of the mesh datablock
+    :param mesh_data: The encoded mesh data
     :param zfile: the zipfile to save encoded data to
-    :param material_data: The material data of the model
-    :param mesh_data: The mesh data of the model
-    :param animation_data: The animation data of the model
-    :return: Manifest generated from saving the model into the zipfile
+    :param filter_mode: Which filters to run on the buffers before they are compressed, see
+                        ExportOptions.BufferFilterKey
+    :param packer: PackedBufferWriter to pack the buffers into, or None to save each buffer as its own member
+    :return: Manifest generated from saving the mesh into the zipfile
     """
-    mod_manifest = {'name': model_name}
+    # Only set lengths and locations to mesh data that got exported (i.e if only vertices are exported,
+    # only set the vertices link up)
+    mesh_manifest = {}
+    formats = mesh_data[EncodedVertexFormatsKey]
 
-    # This will cause the engine to load a default material set for the game.
-    # TODO: Check for duplicates in the zip archive... (materials)
-    if material_data is None:
-        mod_manifest['material'] = None
+    if mesh_data[EncodedVertsKey] is None:
+        mesh_manifest['verts'] = None
+    elif packer is not None:
+        mesh_manifest['verts'] = packer.add(mesh_data[EncodedVertsKey], 'vert',
+                                            _attribute_stride(formats[EncodedVertsKey]))
     else:
-        mod_manifest['material'] = {}
-        mod_manifest['material']['name'] = material_data['name']
+        buffer_filter = _attribute_filter(mesh_data[EncodedVertsKey], formats[EncodedVertsKey], filter_mode)
+        _save_bytes(mesh_data[EncodedVertsKey], '%s.vert.bin' % mesh_name, zfile, buffer_filter)
+        mesh_manifest['verts'] = _generate_mesh_link(mesh_data[EncodedVertsKey], mesh_name, 'vert')
+        mesh_manifest['verts']['filter'] = buffer_filter
 
-        # If use_engine_mat is set, it will load whatever material in-engine is identified by the 'name' key, or warn
-        # the user and load the default material if no material of name exists in engine
-        if material_data['use_engine_mat']:
-            mod_manifest['material']['location'] = None
-        else:
-            _save_dict_as_json(material_data, '%s.mat.json' % material_data['name'], zfile)
-            mod_manifest['material']['location'] = '%s.mat.json' % material_data['name']
+    if mesh_data[EncodedNormalsKey] is None:
+        mesh_manifest['normals'] = None
+    elif packer is not None:
+        mesh_manifest['normals'] = packer.add(mesh_data[EncodedNormalsKey], 'norm',
+                                              _attribute_stride(formats[EncodedNormalsKey]))
+    else:
+        # Unit vectors repeat their float bytes often, LZMA finds those better in the floats than in byte planes
+        buffer_filter = _attribute_filter(mesh_data[EncodedNormalsKey], formats[EncodedNormalsKey], filter_mode, None)
+        _save_bytes(mesh_data[EncodedNormalsKey], '%s.norm.bin' % mesh_name, zfile, buffer_filter)
+        mesh_manifest['normals'] = _generate_mesh_link(mesh_data[EncodedNormalsKey], mesh_name, 'norm')
+        mesh_manifest['normals']['filter'] = buffer_filter
 
-    # Export Mesh data
-    if MeshDataKey is None:
-        mod_manifest['mesh'] = None
+    if mesh_data[EncodedUVsKey] is None:
+        mesh_manifest['uvs'] = None
+    elif packer is not None:
+        mesh_manifest['uvs'] = packer.add(mesh_data[EncodedUVsKey], 'uv', _attribute_stride(formats[EncodedUVsKey]))
     else:
-        # Only set lengths and locations to mesh data that got exported (i.e if only vertices are exported,
-        # only set the vertices link up)
-        mod_manifest['mesh'] = {}
+        # Neighbouring vertices have close uvs, so their float bits are close too
+        buffer_filter = _attribute_filter(mesh_data[EncodedUVsKey], formats[EncodedUVsKey], filter_mode, FilterDelta)
+        _save_bytes(mesh_data[EncodedUVsKey], '%s.uv.bin' % mesh_name, zfile, buffer_filter)
+        mesh_manifest['uvs'] = _generate_mesh_link(mesh_data[EncodedUVsKey], mesh_name, 'uv')
+        mesh_manifest['uvs']['filter'] = buffer_filter
 
-        if mesh_data[EncodedVertsKey] is None:
-            mod_manifest['mesh']['verts'] = None
-        else:
-            _save_bytes(mesh_data[EncodedVertsKey], '%s.vert.bin' % model_name, zfile)
-            mod_manifest['mesh']['verts'] = _generate_mesh_link(mesh_data[EncodedVertsKey], model_name, 'vert')
+    if mesh_data[EncodedIndicesKey] is None:
+        mesh_manifest['ind'] = None
+    elif packer is not None:
+        mesh_manifest['ind'] = packer.add(mesh_data[EncodedIndicesKey], 'ind',
+                                          _index_strides[mesh_data[EncodedIndexFormatKey]])
+    else:
+        buffer_filter = _index_filter(mesh_data[EncodedIndicesKey], mesh_data[EncodedIndexFormatKey], filter_mode)
+        _save_bytes(mesh_data[EncodedIndicesKey], '%s.ind.bin' % mesh_name, zfile, buffer_filter)
+        mesh_manifest['ind'] = _generate_mesh_link(mesh_data[EncodedIndicesKey], mesh_name, 'ind')
+        mesh_manifest['ind']['filter'] = buffer_filter
 
-        if mesh_data[EncodedNormalsKey] is None:
-            mod_manifest['mesh']['normals'] = None
-        else:
-            _save_bytes(mesh_data[EncodedVertsKey], '%s.norm.bin' % model_name, zfile)
-            mod_manifest['mesh']['normals'] = _generate_mesh_link(mesh_data[EncodedNormalsKey], model_name, 'norm')
+    # Interleaved vertex buffer, the vertex format has the stride and the offset/format of each attribute
+    if mesh_data[EncodedInterleavedKey] is None:
+        mesh_manifest['interleaved'] = None
+    elif packer is not None:
+        mesh_manifest['interleaved'] = packer.add(mesh_data[EncodedInterleavedKey], 'vbuf',
+                                                  mesh_data[EncodedVertexFormatKey]['stride'])
+        mesh_manifest['interleaved']['vertex_format'] = mesh_data[EncodedVertexFormatKey]
+    else:
+        buffer_filter = _vertex_buffer_filter(mesh_data[EncodedInterleavedKey], mesh_data[EncodedVertexFormatKey],
+                                              filter_mode)
+        _save_bytes(mesh_data[EncodedInterleavedKey], '%s.vbuf.bin' % mesh_name, zfile, buffer_filter)
+        mesh_manifest['interleaved'] = _generate_mesh_link(mesh_data[EncodedInterleavedKey], mesh_name, 'vbuf')
+        mesh_manifest['interleaved']['vertex_format'] = mesh_data[EncodedVertexFormatKey]
+        mesh_manifest['interleaved']['filter'] = buffer_filter
 
-        if mesh_data[EncodedUVsKey] is None:
-            mod_manifest['mesh']['uvs'] = None
-        else:
-            _save_bytes(mesh_data[EncodedVertsKey], '%s.uv.bin' % model_name, zfile)
-            mod_manifest['mesh']['uvs'] = _generate_mesh_link(mesh_data[EncodedUVsKey], model_name, 'uv')
+    # How each attribute is stored (component type, count, dequantization scale/offset and max error)
+    for attribute, link_key in ((EncodedVertsKey, 'verts'), (EncodedNormalsKey, 'normals'), (EncodedUVsKey, 'uvs')):
+        if mesh_manifest[link_key] is not None:
+            mesh_manifest[link_key]['format'] = mesh_data[EncodedVertexFormatsKey][attribute]
 
-        if mesh_data[EncodedIndicesKey] is None:
-            mod_manifest['mesh']['ind'] = None
-        else:
-            _save_bytes(mesh_data[EncodedVertsKey], '%s.ind.bin' % model_name, zfile)
-            mod_manifest['mesh']['ind'] = _generate_mesh_link(mesh_data[EncodedIndicesKey], model_name, 'ind')
+    # Index/vertex ranges of each submesh, the submesh indices are relative to their first vertex
+    mesh_manifest['index_format'] = mesh_data[EncodedIndexFormatKey]
+    mesh_manifest['submeshes'] = mesh_data[EncodedSubmeshesKey]
+
+    # How many triangle corners were welded into the vertex buffer
+    mesh_manifest['dedup'] = mesh_data[EncodedDedupStatsKey]
+    # ACMR/ATVR before and after each optimization step, None if the mesh wasn't optimized
+    mesh_manifest['optimization'] = mesh_data[EncodedOptimizeStatsKey]
+
+    return mesh_manifest
+
+
+def _save_instances_and_generate_manifest(mesh_name, instance_data, zfile, filter_mode=ExportOptions.BufferFilterNone,
+                                          packer=None):
+    """
+    Saves the packed transforms of the objects using a mesh datablock, so the engine can draw them as instances
+    :param mesh_name: The name of the mesh datablock
+    :param instance_data: The objects using the mesh and their packed transforms
+    :param zfile: the zipfile to save encoded data to
+    :param filter_mode: Which filter to run on the transforms before they are compressed
+    :param packer: PackedBufferWriter to pack the transforms into, or None to save them as their own member
+    :return: Manifest with the mesh reference, the object of each instance and the transforms link
+    """
+    transforms = instance_data[InstanceTransformsKey]
+    inst_manifest = {'mesh': mesh_name, 'objects': instance_data[InstanceObjectsKey]}
+
+    # 4x4 column-major float32 world matrix per instance, in the same order as objects
+    if packer is not None:
+        inst_manifest['transforms'] = packer.add(transforms, 'inst', _TransformStride)
+    else:
+        buffer_filter = _transforms_filter(transforms, filter_mode)
+        _save_bytes(transforms, '%s.inst.bin' % mesh_name, zfile, buffer_filter)
+        inst_manifest['transforms'] = _generate_mesh_link(transforms, mesh_name, 'inst')
+        inst_manifest['transforms']['filter'] = buffer_filter
+    inst_manifest['transforms']['count'] = len(instance_data[InstanceObjectsKey])
+    return inst_manifest
+
+
+def _save_material_and_generate_manifest(material_id, material_data, zfile, library=None):
+    """
+    Saves a unique material into the zipfile given, and generates the manifest the models using it link to
+
+    :param material_id: The id of the material, see MaterialRegistry
+    :param material_data: The encoded material
+    :param zfile: the zipfile to save encoded data to
+    :param library: Path of the shared material library the material was saved to instead, relative to the .model.
+                    None saves it in the zipfile
+    :return: The material manifest
+    """
+    mat_manifest = {'id': material_id, 'name': material_data['name'], 'library': library, 'atlas_region': None}
+
+    # If use_engine_mat is set, it will load whatever material in-engine is identified by the 'name' key, or warn
+    # the user and load the default material if no material of name exists in engine
+    if material_data['use_engine_mat']:
+        mat_manifest['location'] = None
+        mat_manifest['library'] = None
+    else:
+        mat_manifest['location'] = '%s.mat.json' % material_id
+        if library is None:
+            _save_dict_as_json(material_data, mat_manifest['location'], zfile)
+        # Materials whose texture was packed into an atlas, see TextureAtlas
+        for link in material_data.get(TexturesPropKey) or []:
+            mat_manifest['atlas_region'] = link.get('atlas_region', mat_manifest['atlas_region'])
+    return mat_manifest
+
+
+def _texture_member(texture_id, texture_data):
+    """
+    :param texture_id: The id of the texture, see TextureExporter.TextureRegistry
+    :param texture_data: The encoded texture
+    :return: tuple of (texture manifest, bytes of every mip level one after another, largest first). The rows of each
+             level go from the bottom of the image up, as blender stores them
+    """
+    mips = []
+    offset = 0
+    for width, height, data in texture_data[EncodedTextureMipsKey]:
+        mips.append({'width': width, 'height': height, 'offset': offset, 'bytes_length': len(data)})
+        offset += len(data)
+    tex_manifest = {'id': texture_id, 'location': '%s.tex.bin' % texture_id,
+                    'format': texture_data[EncodedTextureFormatKey], 'width': texture_data[EncodedTextureWidthKey],
+                    'height': texture_data[EncodedTextureHeightKey], 'srgb': texture_data[EncodedTextureSRGBKey],
+                    'origin': 'bottom_left', 'mips': mips}
+    return tex_manifest, b''.join(data for _, _, data in texture_data[EncodedTextureMipsKey])
+
+
+def _save_texture_and_generate_manifest(texture_id, texture_data, zfile, library=None):
+    """
+    Saves a texture into the zipfile given as one member of all its mip levels, and generates the manifest the
+    materials using it link to
+
+    :param texture_id: The id of the texture, see TextureExporter.TextureRegistry
+    :param texture_data: The encoded texture
+    :param zfile: The zipfile
+    :param library: Path of the shared material library the texture was saved to instead, relative to the .model.
+                    None saves it in the zipfile
+    :return: The texture manifest
+    """
+    tex_manifest, data = _texture_member(texture_id, texture_data)
+    tex_manifest['library'] = library
+    if library is None:
+        _save_bytes(data, tex_manifest['location'], zfile)
+    return tex_manifest
+
+
+def _save_model_and_generate_manifest(model_name, transform_data, zfile, material_link=None, mesh_name=None,
+                                      animation_data=None, metadata=None):
+    """
+    Generates a manifest for a model and saves the data for the model into the zipfile given
+    :param model_name: The name of the model given
+    :param transform_data: The local transformations made in the scene for the given model
+    :param zfile: the zipfile to save encoded data to
+    :param material_link: The manifest of the material the model uses, see _save_material_and_generate_manifest
+    :param mesh_name: The name of the mesh datablock the model uses
+    :param animation_data: The animation data of the model
+    :return: Manifest generated from saving the model into the zipfile
+    """
+    mod_manifest = {'name': model_name}
+
+    # This will cause the engine to load a default material set for the game. Materials are stored once per unique
+    # material, see _save_material_and_generate_manifest
+    mod_manifest['material'] = material_link
+
+    # Mesh buffers are stored once per mesh datablock, see _save_mesh_and_generate_manifest
+    mod_manifest['mesh'] = mesh_name
 
     # Export animation data
     if animation_data is None:
@@ -114,44 +467,258 @@ def _save_model_and_generate_manifest(model_name, transform_data, zfile, materia
     return mod_manifest
 
 
-def _save_scene_and_generate_manifest(encoded_data, zfile):
+def _save_scene_and_generate_manifest(encoded_data, zfile, filter_mode=ExportOptions.BufferFilterNone,
+                                      layout=ExportOptions.ArchiveMembers,
+                                      pack_alignment=ExportOptions.PackAlignmentDefault, material_library=None):
     """
     Saves all encoded data into the zipfile given and generates a manifest json file
 
     :param encoded_data: The encoded data to generate a manifest from
-    :param zfile: The zipfile to save into
+    :param zfile: The ArchiveWriter to save into
+    :param filter_mode: Which filters to run on the binary buffers before they are compressed
+    :param layout: If each buffer is its own member, or all of them are packed into one, see
+                   ExportOptions.ArchiveLayoutKey
+    :param pack_alignment: Byte alignment of each buffer in the packed buffer
+    :param material_library: Path of the shared material library the materials were saved to, relative to the .model.
+                             None saves them in the zipfile
     :return: The manifest dict
     """
+    # Packed buffers aren't filtered, the engine points at them in place
+    packer = None
+    if layout != ExportOptions.ArchiveMembers:
+        packer = PackedBufferWriter(pack_alignment)
+
     # Set what the model data is exported in this archive
     manifest = {}
     manifest['contains_mesh_data'] = encoded_data[MeshDataKey] is not None
     manifest['contains_material_data'] = encoded_data[MaterialDataKey] is not None
+    manifest['contains_texture_data'] = encoded_data[TextureDataKey] is not None
     manifest['contains_animation_data'] = encoded_data[AnimationDataKey] is not None
     manifest['contains_metadata'] = encoded_data[MetadataKey] is not None
     manifest['meshes'] = encoded_data[ExportedMeshesKey]
 
-    # TODO: Add CRC checksums and expected lengths for security/integrity (just in case...)
+    # Save each mesh datablock once, with the list of objects (instances) using it
+    if encoded_data[MeshDataKey] is None:
+        manifest['mesh_data'] = None
+        manifest['instances'] = None
+    else:
+        meshes = encoded_data[MeshDataKey]
+        if isinstance(meshes, dict):
+            meshes = sorted(meshes.items())
+
+        # Streamed meshes are encoded as they are iterated, each one is released when the next one replaces it. Buffered
+        # meshes stay in encoded_data, it is the caller's and can be saved again
+        manifest['mesh_data'] = {}
+        for mesh_name, mesh_data in meshes:
+            with ExportProfiler.stage('save_mesh', mesh_name):
+                manifest['mesh_data'][mesh_name] = _save_mesh_and_generate_manifest(mesh_name, mesh_data, zfile,
+                                                                                    filter_mode, packer)
+            # The UVs of meshes using an atlased texture were moved into its region of the atlas
+            manifest['mesh_data'][mesh_name]['uv_atlas'] = encoded_data[MeshUVAtlasKey].get(mesh_name)
+        manifest['instances'] = [_save_instances_and_generate_manifest(mesh_name, instance_data, zfile, filter_mode,
+                                                                       packer)
+                                 for mesh_name, instance_data in encoded_data[MeshInstancesKey].items()]
 
-    # Set what models have been exported, and their transformation data, with material/mesh links
+    # The packed buffer is stored data aligned in the archive, so it can be memory mapped and the buffers in it used in
+    # place. The buffer links got their offsets into it from the packer
+    if packer is None:
+        manifest['packed'] = None
+    else:
+        with ExportProfiler.stage('pack'):
+            packed, manifest['packed'] = packer.finish()
+        if layout == ExportOptions.ArchivePacked:
+            zfile.writestr(PackedBufferName, packed, compress_type=zipfile.ZIP_STORED, alignment=pack_alignment)
+            manifest['packed'][PackedCompressedKey] = False
+        else:
+            zfile.writestr(PackedBufferName, packed)
+            manifest['packed'][PackedCompressedKey] = True
+        del packed
+
+    # Save each unique material once, however many models use it
+    if encoded_data[MaterialDataKey] is None:
+        manifest['material_data'] = None
+    else:
+        manifest['material_data'] = OrderedDict(
+            (material_id, _save_material_and_generate_manifest(material_id, material_data, zfile, material_library))
+            for material_id, material_data in encoded_data[MaterialDataKey].items())
+
+    # Save each image texture once, however many materials use it
+    if encoded_data[TextureDataKey] is None:
+        manifest['texture_data'] = None
+    else:
+        manifest['texture_data'] = OrderedDict()
+        for texture_id, texture_data in encoded_data[TextureDataKey].items():
+            with ExportProfiler.stage('save_texture', texture_id):
+                manifest['texture_data'][texture_id] = _save_texture_and_generate_manifest(
+                    texture_id, texture_data, zfile, material_library)
+
+    # Set what models have been exported, and their transformation data, with material/mesh links. They have a section
+    # of their own, so an object can have any name, even that of another section
+    manifest['objects'] = OrderedDict()
     for model in encoded_data[ExportedMeshesKey]:
-        mesh = encoded_data[MeshDataKey][model] if encoded_data[MeshDataKey] is not None else None
-        mat = encoded_data[MaterialDataKey][model] if encoded_data[MaterialDataKey] is not None else None
+        mesh = encoded_data[ObjectMeshesKey][model] if encoded_data[ObjectMeshesKey] is not None else None
+        mat = None
+        if encoded_data[ObjectMaterialsKey] is not None:
+            mat = manifest['material_data'][encoded_data[ObjectMaterialsKey][model]]
         ani = encoded_data[AnimationDataKey][model] if encoded_data[AnimationDataKey] is not None else None
         trans = encoded_data[MeshTransformsKey][model]
         metadata = encoded_data[MetadataKey][model] if encoded_data[MetadataKey] is not None else None
 
-        manifest['%s_data' % model] = _save_model_and_generate_manifest(model, trans, zfile, mat, mesh, ani, metadata)
+        manifest['objects'][model] = _save_model_and_generate_manifest(model, trans, zfile, mat, mesh, ani, metadata)
+
+    # CRC32, length and content hash of every member, for integrity checks and for updating the archive in place
+    manifest[ManifestMembersKey] = zfile.members()
+    manifest[ManifestHashTypeKey] = content_hash_type()
 
     # Now save the manifest
-    _save_dict_as_json(manifest, 'manifest.json', zfile)
+    _save_dict_as_json(manifest, ManifestName, zfile)
 
 
-def save_model(encoded_data, filepath):
+def _count_compression(archive):
     """
-    Will compress the encoded data, and save to the given filepath
-    :param encoded_data: The encoded scene data to save
-    :param filepath: The path to save the LZMA compressed .model file
+    Adds the compression time and bytes of the archive written to the export profile. Members are compressed on the
+    worker threads, so the compress stage is their summed time and can add up to more than the export took
+    """
+    for entry in archive.entries:
+        if entry.compress_time is not None:
+            ExportProfiler.add_time('compress', entry.compress_time)
+        ExportProfiler.count('bytes_uncompressed', entry.length)
+        ExportProfiler.count('bytes_compressed', entry.compressed_length)
+    ExportProfiler.count('members_compressed', archive.compressed)
+    ExportProfiler.count('members_reused', archive.reused)
+
+
+def _read_material_library(filepath):
+    """
+    :return: tuple of OrderedDicts of material id -> (material manifest, json bytes) and texture id -> (texture
+             manifest, bytes) of the library at filepath, empty if there is no library there yet
+    """
+    materials = OrderedDict()
+    textures = OrderedDict()
+    if not os.path.isfile(filepath):
+        return materials, textures
+    try:
+        with zipfile.ZipFile(filepath, 'r') as z:
+            manifest = json.loads(z.read(ManifestName).decode('utf-8'))
+            for material_id, mat_manifest in manifest['materials'].items():
+                materials[material_id] = (mat_manifest, z.read(mat_manifest['location']))
+            # Libraries saved before textures were exported have none
+            for texture_id, tex_manifest in manifest.get('textures', {}).items():
+                textures[texture_id] = (tex_manifest, z.read(tex_manifest['location']))
+    except (zipfile.BadZipfile, KeyError, ValueError):
+        raise RuntimeError('%s is not a material library' % filepath)
+    return materials, textures
+
+
+def _add_to_library(library, entry_id, manifest, data):
+    """
+    Adds the entry to the materials or textures of a library, replacing the one with the same id
+
+    :return: tuple of (1 if the entry is new, 1 if it replaced an entry with different content)
+    """
+    manifest['hash'] = content_hash(data)
+    added = entry_id not in library
+    changed = not added and library[entry_id][0].get('hash') != manifest['hash']
+    library[entry_id] = (manifest, data)
+    return int(added), int(changed)
+
+
+def save_material_library(materials, filepath, workers=None, compression=ExportOptions.CompressionBalanced,
+                          textures=None):
+    """
+    Adds the materials to the shared material library at filepath, creating it if it is missing. The library is an
+    archive of materials many .model archives link to, so each material is stored and loaded in-engine once. The
+    materials already in the library are kept, the ones with the same id as a material given are replaced. Unchanged
+    members are copied from the previous library instead of compressed again.
+
+    :param materials: OrderedDict of material id -> encoded material, see ModelExporter.MaterialDataKey. Engine
+                      materials are skipped, they are only linked by name
+    :param filepath: Path of the material library, see ExportOptions.MaterialLibraryExt
+    :param workers: Threads compressing members, None for one per core
+    :param compression: The compression preset, see ExportOptions.CompressionKey
+    :param textures: OrderedDict of texture id -> encoded texture the materials link to, see
+                     ModelExporter.TextureDataKey. They are added to the library the same way as the materials
+    """
+    library, library_textures = _read_material_library(filepath)
+    added, changed = 0, 0
+    for material_id, material_data in materials.items():
+        if material_data['use_engine_mat']:
+            continue
+        data = str.encode(json.dumps(material_data, sort_keys=True, indent=2), 'utf-8')
+        mat_manifest = {'id': material_id, 'name': material_data['name'], 'location': '%s.mat.json' % material_id}
+        counts = _add_to_library(library, material_id, mat_manifest, data)
+        added, changed = added + counts[0], changed + counts[1]
+
+    textures_added, textures_changed = 0, 0
+    for texture_id, texture_data in (textures or {}).items():
+        counts = _add_to_library(library_textures, texture_id, *_texture_member(texture_id, texture_data))
+        textures_added, textures_changed = textures_added + counts[0], textures_changed + counts[1]
+
+    with ArchiveWriter(filepath, PreviousArchive(filepath), compression_policy(compression), workers) as z:
+        for entry_manifest, data in list(library.values()) + list(library_textures.values()):
+            z.writestr(entry_manifest['location'], data)
+        manifest = {'materials': OrderedDict((material_id, mat_manifest)
+                                             for material_id, (mat_manifest, _) in library.items()),
+                    'textures': OrderedDict((texture_id, tex_manifest)
+                                            for texture_id, (tex_manifest, _) in library_textures.items())}
+        manifest[ManifestMembersKey] = z.members()
+        manifest[ManifestHashTypeKey] = content_hash_type()
+        _save_dict_as_json(manifest, ManifestName, z)
+    print('Material library %s: %d materials, %d added, %d changed' % (filepath, len(library), added, changed))
+    if textures:
+        print('Material library %s: %d textures, %d added, %d changed' % (filepath, len(library_textures),
+                                                                          textures_added, textures_changed))
 
+
+def _library_link(library_path, filepath):
+    """
+    :return: Path of the material library relative to the directory of the .model at filepath, with / separators
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    try:
+        return os.path.relpath(os.path.abspath(library_path), directory).replace(os.sep, '/')
+    except ValueError:
+        # On another drive on windows, there is no relative path
+        return os.path.abspath(library_path).replace(os.sep, '/')
+
+
+def save_model(encoded_data, filepath, update=False, workers=None, compression=ExportOptions.CompressionBalanced,
+               report=False, buffer_filter=ExportOptions.BufferFilterNone, layout=ExportOptions.ArchiveMembers,
+               pack_alignment=ExportOptions.PackAlignmentDefault, material_library=None):
     """
-    with zipfile.ZipFile(filepath, 'w', compression=zipfile.ZIP_LZMA) as z:
-        _save_scene_and_generate_manifest(encoded_data, z)
+    Will compress the encoded data, and save to the given filepath
+    :param encoded_data: The encoded scene data to save, from ModelExporter.export_model. Streamed mesh data is encoded
+                         while it is saved
+    :param filepath: The path to save the compressed .model file
+    :param update: If the members that didn't change since the .model at filepath was saved should be copied from it,
+                   instead of compressed again
+    :param workers: Threads compressing members, None for one per core
+    :param compression: The compression preset, see ExportOptions.CompressionKey
+    :param report: If the compressed size and decode time of every compression preset should be printed
+    :param buffer_filter: Which filters to run on the binary buffers before they are compressed, see
+                          ExportOptions.BufferFilterKey
+    :param layout: If each buffer is its own member, or all of them are packed into one, see
+                   ExportOptions.ArchiveLayoutKey
+    :param pack_alignment: Byte alignment of each buffer in the packed buffer, see ExportOptions.PackAlignmentKey
+    :param material_library: Path of the shared material library to save the materials and textures to, and link the
+                             models to. None saves them in the .model. See ExportOptions.MaterialLibraryKey
+    """
+    library_link = None
+    if material_library is not None and encoded_data[MaterialDataKey] is not None:
+        with ExportProfiler.stage('save_material_library'):
+            save_material_library(encoded_data[MaterialDataKey], material_library, workers, compression,
+                                  encoded_data[TextureDataKey])
+        library_link = _library_link(material_library, filepath)
+
+    previous = PreviousArchive(filepath) if update else None
+    with ExportProfiler.stage('save_model'):
+        with ArchiveWriter(filepath, previous, compression_policy(compression), workers, measure_decode=report) as z:
+            _save_scene_and_generate_manifest(encoded_data, z, buffer_filter, layout, pack_alignment, library_link)
+    if ExportProfiler.profiling():
+        _count_compression(z)
+
+    if update:
+        print('Updated %s: %d members reused, %d compressed' % (filepath, z.reused, z.compressed))
+    if report:
+        _print_compression_report("Saved with '%s' (reused members have no decode time):" % compression, z.entries)
+        compression_report(filepath)
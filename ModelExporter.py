@@ -1,15 +1,31 @@
+import functools
+from collections import OrderedDict
+
 import bpy
+import numpy as np
 
-from . import ExportOptions
+from . import ExportOptions, ExportProfiler
 from .AnimationExporter import _is_mesh_animation_supported, encode_animation_data
-from .MaterialExporter import encode_material_data
-from .MeshExporter import encode_mesh_data
+from .EncodeCache import EncodeCache
+from .MaterialRegistry import MaterialRegistry
+from .MeshExporter import encode_mesh_data, encode_mesh_arrays, extract_mesh_data, transform_uvs
+from .ParallelEncoder import encode_meshes, encode_processes
+from .TextureAtlas import TextureAtlas, RegionUVScaleKey, RegionUVOffsetKey
+from .TextureExporter import TextureRegistry
 
 MeshDataKey = 'mesh_data'
-MaterialDataKey = 'material_data'
+MaterialDataKey = 'material_data'  # Each unique material once, by material id, see MaterialRegistry
+TextureDataKey = 'texture_data'  # Each image texture of the materials once, by texture id, see TextureRegistry
 AnimationDataKey = 'animation_data'
 MetadataKey = 'metadata'
 ExportedMeshesKey = 'meshes_exported'
+MeshInstancesKey = 'mesh_instances'  # The objects using each mesh datablock, and their packed world transforms
+ObjectMeshesKey = 'object_meshes'  # The name of the mesh datablock each object uses
+ObjectMaterialsKey = 'object_materials'  # The id of the material each object uses
+MeshUVAtlasKey = 'mesh_uv_atlas'  # The atlas region the UVs of each mesh were moved into, see TextureAtlas
+InstanceObjectsKey = 'objects'
+InstanceTransformsKey = 'transforms'
+_TransformFormat = '<f4'  # Instance transforms are 4x4 column-major little-endian float32 matrices
 
 # Metadata keys
 MeshTransformsKey = 'mesh_transforms'  # This stores what each of the local transformations for each of the meshes should be
@@ -65,38 +81,268 @@ def encode_transform_data(obj):
     return trans_mat
 
 
-def export_model(context, config):
+def encode_instance_transforms(objs):
+    """
+    Packs the world matrices of the objects given into one buffer, to upload as per-instance data in-engine.
+
+    :param objs: The objects sharing a mesh
+    :return: bytes of the 4x4 column-major float32 world matrix of each object
+    """
+    # mathutils matrices index by row, so transpose each matrix into column-major
+    matrices = np.array([[list(row) for row in obj.matrix_world] for obj in objs], dtype=np.float64).reshape(-1, 4, 4)
+    return np.ascontiguousarray(matrices.transpose(0, 2, 1), dtype=_TransformFormat).tobytes()
+
+
+def _group_instances(objs):
+    """
+    :param objs: The mesh objects to export
+    :return: OrderedDict of mesh datablock name -> the objects using it, in scene order
+    """
+    instances = OrderedDict()
+    for obj in objs:
+        instances.setdefault(obj.data.name, []).append(obj)
+    return instances
+
+
+def _uv_transform(region):
+    """
+    :return: The transform moving UVs into the atlas region, see MeshExporter.transform_uvs. None if there is no region
+    """
+    return None if region is None else (region[RegionUVScaleKey], region[RegionUVOffsetKey])
+
+
+def _encode_mesh_cached(obj, mesh_opts, cache, uv_transform=None):
+    """
+    Encodes the mesh of the object, reusing the encoded data from the cache when the mesh arrays and options match.
+    Only the mesh extraction and hashing run on a hit.
+
+    :param obj: The object to encode the mesh of
+    :param mesh_opts: tuple of the encode_mesh_data options, starting with the export option
+    :param cache: EncodeCache, or None to always encode
+    :param uv_transform: Affine transform to move the UVs with, see MeshExporter.transform_uvs
+    :return: Dictionary with the encoded mesh data
+    """
+    if cache is None and uv_transform is None:
+        return encode_mesh_data(obj, *mesh_opts)
+
+    print('Exporting %s mesh data' % obj.name)
+    return _encode_arrays_cached(obj.name, extract_mesh_data(obj, mesh_opts[0], uv_transform), mesh_opts, cache)
+
+
+def _encode_arrays_cached(name, arrays, mesh_opts, cache):
+    """
+    Encodes the mesh arrays extracted from an object, reusing the encoded data from the cache when the arrays and
+    options match
+
+    :param name: Name of the object the arrays were extracted from
+    :param arrays: tuple of arrays from MeshExporter.extract_mesh_data
+    :param mesh_opts: tuple of the encode_mesh_data options, starting with the export option
+    :param cache: EncodeCache, or None to always encode
+    :return: Dictionary with the encoded mesh data
+    """
+    if cache is None:
+        return encode_mesh_arrays(name, arrays, *mesh_opts)
+
+    with ExportProfiler.stage('cache_lookup', name):
+        key = cache.key('mesh', arrays, mesh_opts)
+        encoded = cache.get(key)
+    if encoded is None:
+        encoded = encode_mesh_arrays(name, arrays, *mesh_opts)
+        cache.put(key, encoded)
+    return encoded
+
+
+def _encode_meshes(instances, mesh_opts, cache, print_stats, uv_atlas=None):
+    """
+    Encodes the mesh datablocks one at a time, as they are asked for. Only the mesh being encoded and the one being
+    saved are in memory at once when the archive is written while iterating.
+
+    :param instances: OrderedDict of mesh datablock name -> the objects using it
+    :param mesh_opts: tuple of the encode_mesh_data options
+    :param cache: EncodeCache, or None to always encode
+    :param print_stats: If the cache stats should be printed after the last mesh
+    :param uv_atlas: dict of mesh datablock name -> the atlas region to move its UVs into
+    :return: Generator of (mesh datablock name, encoded mesh data)
+    """
+    uv_atlas = uv_atlas or {}
+    for mesh_name, objs in instances.items():
+        with ExportProfiler.stage('encode_mesh', objs[0].name):
+            encoded = _encode_mesh_cached(objs[0], mesh_opts, cache, _uv_transform(uv_atlas.get(mesh_name)))
+        yield mesh_name, encoded
+
+    if print_stats and cache is not None:
+        cache.print_stats()
+
+
+def _encode_extracted_meshes(extracted_meshes, mesh_opts, cache):
+    """
+    Encodes mesh arrays that were extracted from the blender objects beforehand, as they are asked for. Nothing here
+    reads blender data, so it can run off the main thread.
+
+    :param extracted_meshes: Iterable of (mesh datablock name, object name, arrays from extract_mesh_data)
+    :param mesh_opts: tuple of the encode_mesh_data options
+    :param cache: EncodeCache, or None to always encode
+    :return: Generator of (mesh datablock name, encoded mesh data)
+    """
+    for mesh_name, obj_name, arrays in extracted_meshes:
+        with ExportProfiler.stage('encode_mesh', obj_name):
+            encoded = _encode_arrays_cached(obj_name, arrays, mesh_opts, cache)
+        del arrays
+        yield mesh_name, encoded
+
+    if cache is not None:
+        cache.print_stats()
+
+
+def _extract_meshes(instances, export_opt):
+    """
+    Extracts the mesh arrays of each mesh datablock as they are asked for, from the first object using it
+
+    :param instances: OrderedDict of mesh datablock name -> the objects using it
+    :param export_opt: The mesh export option
+    :return: Generator of (mesh datablock name, object name, arrays from extract_mesh_data)
+    """
+    for mesh_name, objs in instances.items():
+        print('Exporting %s mesh data' % objs[0].name)
+        yield mesh_name, objs[0].name, extract_mesh_data(objs[0], export_opt)
+
+
+def _atlas_uvs(extracted_meshes, uv_atlas):
+    """
+    Moves the UVs of the extracted meshes into their atlas regions, as they are asked for
+
+    :param extracted_meshes: Iterable of (mesh datablock name, object name, arrays from extract_mesh_data)
+    :param uv_atlas: dict of mesh datablock name -> the atlas region to move its UVs into
+    :return: Generator of (mesh datablock name, object name, arrays)
+    """
+    for mesh_name, obj_name, arrays in extracted_meshes:
+        yield mesh_name, obj_name, transform_uvs(arrays, _uv_transform(uv_atlas.get(mesh_name)))
+
+
+def _fill_uv_atlas(mesh_uv_atlas, mesh_names, uv_atlas):
+    """
+    :param mesh_uv_atlas: dict to fill with mesh datablock name -> its atlas region, None if its UVs weren't moved
+    :param mesh_names: The mesh datablocks exported
+    :param uv_atlas: dict of mesh datablock name -> the atlas region its UVs go in
+    """
+    mesh_uv_atlas.update((mesh_name, uv_atlas.get(mesh_name)) for mesh_name in mesh_names)
+
+
+def _scene_objects(context, config):
+    if config[ExportOptions.SelectedOnlyKey]:
+        return [obj for obj in context.scene.objects if obj.selected and _is_supported_export(obj)]
+    return [obj for obj in context.scene.objects if _is_supported_export(obj)]
+
+
+def mesh_instances(context, config):
+    """
+    :param context: Blender context
+    :param config: The configuration of the export
+    :return: OrderedDict of mesh datablock name -> the objects using it, for every mesh the export encodes. The first
+             object of each is the one its mesh data is extracted from
+    """
+    if config[ExportOptions.MeshKey] == ExportOptions.MeshNoExport:
+        return OrderedDict()
+    return _group_instances([obj for obj in _scene_objects(context, config) if obj.type == 'MESH'])
+
+
+def export_model(context, config, extracted_meshes=None, instances=None, deferred=None):
     """
     Exports the models in the blender scene with the config given. See the different config
     options to see how to customize an export
 
+    With ExportOptions.StreamExportKey set, the mesh data is a generator of (mesh name, encoded mesh data) that encodes
+    each mesh as the archive asks for it, instead of a dict. It can only be saved once, see ModelCompressor.save_model
+
     :param context: Blender context
     :param config: The configuration of the export
+    :param extracted_meshes: Iterable of (mesh datablock name, object name, arrays from extract_mesh_data) in the order
+                             of mesh_instances, to encode instead of reading the mesh of each object. The mesh data is
+                             always streamed then, and doesn't read any blender data while it is saved
+    :param instances: The mesh_instances of the export, if the caller already has them
+    :param deferred: list to append the encoding that doesn't read blender data to (the textures and atlases), as
+                     functions of no arguments. The caller runs them in order before saving, on any thread. Only with
+                     extracted_meshes, so the meshes are encoded after them. None encodes everything now
     :return: Filepath to exported model
     """
     encoded_data = {}
 
-    if config[ExportOptions.SelectedOnlyKey]:
-        scene_objs = [obj for obj in context.scene.objects if obj.selected and _is_supported_export(obj)]
+    # Reuse the data encoded by earlier exports, when it was encoded from the same data with the same options
+    cache = None
+    if config[ExportOptions.CacheDirKey] is not None:
+        cache = EncodeCache(config[ExportOptions.CacheDirKey], config[ExportOptions.CacheSizeKey])
+
+    scene_objs = _scene_objects(context, config)
+    streamed = config[ExportOptions.StreamExportKey] or extracted_meshes is not None
+
+    # Encode the material data. Materials go first, the meshes using an atlased texture have their UVs moved into it
+    uv_atlas = {}
+    if config[ExportOptions.MaterialKey] == ExportOptions.MaterialNoExport:
+        encoded_data[MaterialDataKey] = None
+        encoded_data[ObjectMaterialsKey] = None
+        encoded_data[TextureDataKey] = None
     else:
-        scene_objs = [obj for obj in context.scene.objects if _is_supported_export(obj)]
+        # Images shared by materials are encoded once, and not again while they are unchanged in the cache
+        textures = None
+        if config[ExportOptions.TextureFormatKey] != ExportOptions.TextureNoExport:
+            atlas = None
+            if config[ExportOptions.AtlasKey] != ExportOptions.AtlasOff:
+                atlas = TextureAtlas(config[ExportOptions.AtlasTextureSizeKey], config[ExportOptions.AtlasSizeKey],
+                                     config[ExportOptions.AtlasPaddingKey])
+            textures = TextureRegistry(config[ExportOptions.TextureFormatKey], config[ExportOptions.TextureMaxSizeKey],
+                                       cache, atlas, deferred is not None)
+        # Objects sharing a material, or a copy of one, link to the same encoded material
+        registry = MaterialRegistry(context, config[ExportOptions.MaterialKey], cache,
+                                    config[ExportOptions.RampEncodingKey], config[ExportOptions.RampToleranceKey],
+                                    textures)
+        encoded_data[ObjectMaterialsKey] = registry.encode_objects([obj for obj in scene_objs if obj.type == 'MESH'],
+                                                                   deferred)
+        encoded_data[MaterialDataKey] = registry.materials
+        encoded_data[TextureDataKey] = textures.textures if textures is not None else None
+        uv_atlas = registry.mesh_regions
 
     # Encode all of the mesh data if we need to
     if config[ExportOptions.MeshKey] == ExportOptions.MeshNoExport:
         encoded_data[MeshDataKey] = None
+        encoded_data[MeshInstancesKey] = None
+        encoded_data[ObjectMeshesKey] = None
+        encoded_data[MeshUVAtlasKey] = None
     else:
-        objs = [obj for obj in scene_objs if obj.type == 'MESH']
-        export_opt = config[ExportOptions.MeshKey]
-        encoded_data[MeshDataKey] = dict([(obj.name, encode_mesh_data(obj, export_opt)) for obj in objs])
-
-    # Encode the material data
-    if config[ExportOptions.MaterialKey] == ExportOptions.MaterialNoExport:
-        encoded_data[MaterialDataKey] = None
-    else:
-        objs = [obj for obj in scene_objs if obj.type == 'MESH']
-        export_opt = config[ExportOptions.MaterialKey]
-        encoded_data[MaterialDataKey] = dict(
-            [(obj.name, encode_material_data(obj, context, export_opt)) for obj in objs])
+        # Objects sharing a mesh datablock are instances of it, so each datablock only gets encoded once
+        if instances is None:
+            instances = mesh_instances(context, config)
+        mesh_opts = (config[ExportOptions.MeshKey], config[ExportOptions.WeldToleranceKey],
+                     config[ExportOptions.OptimizeKey], config[ExportOptions.IndexFormatKey],
+                     config[ExportOptions.PositionFormatKey], config[ExportOptions.NormalFormatKey],
+                     config[ExportOptions.UVFormatKey], config[ExportOptions.LayoutKey])
+        # Encoding on worker processes only needs the arrays, they are extracted on the main thread as they go
+        processes = encode_processes(config[ExportOptions.EncodeProcessesKey])
+        if processes > 1 and extracted_meshes is None:
+            extracted_meshes = _extract_meshes(instances, config[ExportOptions.MeshKey])
+        # Deferred, the atlas is packed after this returns. The regions are looked up as each mesh comes in
+        if extracted_meshes is not None and (uv_atlas or deferred is not None):
+            extracted_meshes = _atlas_uvs(extracted_meshes, uv_atlas)
+        if processes > 1:
+            meshes = encode_meshes(extracted_meshes, mesh_opts, cache, processes, streamed)
+        elif extracted_meshes is not None:
+            meshes = _encode_extracted_meshes(extracted_meshes, mesh_opts, cache)
+        else:
+            meshes = _encode_meshes(instances, mesh_opts, cache, streamed, uv_atlas)
+        encoded_data[MeshDataKey] = meshes if streamed else dict(meshes)
+        with ExportProfiler.stage('instance_transforms'):
+            encoded_data[MeshInstancesKey] = OrderedDict(
+                [(mesh_name, {InstanceObjectsKey: [obj.name for obj in objs],
+                              InstanceTransformsKey: encode_instance_transforms(objs)})
+                 for mesh_name, objs in instances.items()])
+        encoded_data[ObjectMeshesKey] = dict(
+            [(obj.name, mesh_name) for mesh_name, objs in instances.items() for obj in objs])
+        # Deferred, the regions are only known once the atlas is packed, after the textures
+        encoded_data[MeshUVAtlasKey] = {}
+        fill_uv_atlas = functools.partial(_fill_uv_atlas, encoded_data[MeshUVAtlasKey], list(instances), uv_atlas)
+        if deferred is None:
+            fill_uv_atlas()
+        else:
+            deferred.append(fill_uv_atlas)
 
     # Encode animation data
     if config[ExportOptions.AnimationKey] == ExportOptions.AnimationNoExport:
@@ -112,19 +358,52 @@ def export_model(context, config):
         encoded_data[MetadataKey] = None
 
     # Export translation data for each object
-    encoded_data[MeshTransformsKey] = dict(
-        [(obj.name, encode_transform_data(obj)) for obj in scene_objs if obj.type == 'MESH'])
+    with ExportProfiler.stage('transforms'):
+        encoded_data[MeshTransformsKey] = dict(
+            [(obj.name, encode_transform_data(obj)) for obj in scene_objs if obj.type == 'MESH'])
     encoded_data[ExportedMeshesKey] = [obj.name for obj in scene_objs if obj.type == 'MESH']
 
+    # Streamed meshes print the cache stats once they are all encoded
+    if cache is not None and not (streamed and encoded_data[MeshDataKey] is not None):
+        cache.print_stats()
+
     return encoded_data
 
 
 if __name__ == "__main__":
     config = {
         ExportOptions.MeshKey: ExportOptions.MeshAll,
+        ExportOptions.WeldToleranceKey: ExportOptions.WeldToleranceDefault,
+        ExportOptions.OptimizeKey: ExportOptions.OptimizeNone,
+        ExportOptions.IndexFormatKey: ExportOptions.IndexSplit16,
+        ExportOptions.PositionFormatKey: ExportOptions.PositionFloat,
+        ExportOptions.NormalFormatKey: ExportOptions.NormalFloat,
+        ExportOptions.UVFormatKey: ExportOptions.UVFloat,
+        ExportOptions.LayoutKey: ExportOptions.LayoutSeparate,
+        ExportOptions.CacheDirKey: None,
+        ExportOptions.CacheSizeKey: ExportOptions.CacheSizeDefault,
         ExportOptions.MaterialKey: ExportOptions.MaterialAll,
+        ExportOptions.MaterialLibraryKey: None,
+        ExportOptions.RampEncodingKey: ExportOptions.RampAdaptive,
+        ExportOptions.RampToleranceKey: ExportOptions.RampToleranceDefault,
+        ExportOptions.TextureFormatKey: ExportOptions.TextureBC,
+        ExportOptions.TextureMaxSizeKey: ExportOptions.TextureMaxSizeDefault,
+        ExportOptions.AtlasKey: ExportOptions.AtlasSmall,
+        ExportOptions.AtlasTextureSizeKey: ExportOptions.AtlasTextureSizeDefault,
+        ExportOptions.AtlasSizeKey: ExportOptions.AtlasSizeDefault,
+        ExportOptions.AtlasPaddingKey: ExportOptions.AtlasPaddingDefault,
         ExportOptions.AnimationKey: ExportOptions.AnimationKey,
         ExportOptions.FilePathKey: "D:\\Code\\game-dev\\turn-tactics\\Test\\Shaded_Model\\Resource\\Models\\test.model",
+        ExportOptions.UpdateArchiveKey: False,
+        ExportOptions.CompressionWorkersKey: 0,
+        ExportOptions.EncodeProcessesKey: 1,
+        ExportOptions.StreamExportKey: True,
+        ExportOptions.CompressionKey: ExportOptions.CompressionBalanced,
+        ExportOptions.CompressionReportKey: False,
+        ExportOptions.BufferFilterKey: ExportOptions.BufferFilterNone,
+        ExportOptions.ArchiveLayoutKey: ExportOptions.ArchiveMembers,
+        ExportOptions.PackAlignmentKey: ExportOptions.PackAlignmentDefault,
+        ExportOptions.ProfileKey: ExportOptions.ProfileOff,
         ExportOptions.SelectedOnlyKey: False
     }
 
@@ -0,0 +1,355 @@
+import json
+import mmap
+import os
+import struct
+import zipfile
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from .BufferFilters import undo_filter, FilterIdKey
+from .ModelArchive import decompress, content_hash, content_hash_type, ManifestName, ManifestMembersKey, \
+    ManifestHashTypeKey, MemberCRCKey, MemberLengthKey, MemberHashKey
+from .PackedBuffers import PackedBufferName, LinkOffsetKey
+from .VertexFormats import component_dtype, decode_attribute, ComponentsKey
+
+DefaultCacheSizeMB = 64
+
+_LocalHeaderLengths = struct.Struct('<HH')  # Name and extra field length, 26 bytes into a local header
+_LocalHeaderSize = 30
+
+_index_dtypes = {
+    'u16': np.dtype('<u2'),
+    'u32': np.dtype('<u4')
+}
+_TransformDtype = np.dtype('<f4')
+_BlockBytes = {'bc1': 8, 'bc3': 16}  # Bytes of each 4x4 block of the block compressed texture formats
+
+_attribute_links = ('verts', 'normals', 'uvs')  # Mesh manifest links of the vertex attributes
+
+
+class _LRUCache(object):
+    """
+    Decoded members by key, dropping the least recently used ones once they add up to more than max_bytes. The most
+    recent member is always kept, even when it is bigger than max_bytes on its own.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._bytes += len(value)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+
+class ModelReader(object):
+    """
+    Reads a .model archive back, lazily. Only the manifest is parsed when the archive is opened, each member is read
+    when something asks for it. The archive is memory mapped, stored members are returned as views into the mapping
+    and compressed members are decompressed straight from it, with the decoded members kept in an LRU cache.
+
+    Buffers are returned as numpy arrays viewing the decoded (or mapped) bytes, without copying. They are read-only.
+    """
+
+    def __init__(self, filepath, cache_size_mb=DefaultCacheSizeMB):
+        """
+        :param filepath: Path of the .model archive
+        :param cache_size_mb: Most megabytes of decoded members to keep
+        """
+        self.filepath = filepath
+        with zipfile.ZipFile(filepath, 'r') as z:
+            self._infos = dict((info.filename, info) for info in z.infolist())
+        with open(filepath, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        self._cache = _LRUCache(int(cache_size_mb * 1024 * 1024))
+        self._libraries = {}  # Material library link -> ModelReader of the library, opened when a material is read
+        self.manifest = json.loads(bytes(self.member(ManifestName)).decode('utf-8'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Drops the cache and unmaps the archive. Arrays still viewing stored members keep the mapping alive until they
+        are deleted.
+        """
+        self._cache.clear()
+        for library in self._libraries.values():
+            library.close()
+        self._libraries = {}
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # Arrays returned earlier still view the mapping, it is unmapped once they are garbage collected
+            pass
+
+    # -- Members --
+
+    def _compressed_data(self, info):
+        """
+        :return: memoryview of the member's (compressed) data in the mapping
+        """
+        offset = info.header_offset + 26
+        name_length, extra_length = _LocalHeaderLengths.unpack_from(self._mmap, offset)
+        start = info.header_offset + _LocalHeaderSize + name_length + extra_length
+        return self._view[start:start + info.compress_size]
+
+    def member(self, name):
+        """
+        :param name: Name of the member
+        :return: The uncompressed bytes of the member. A memoryview into the mapped archive for stored members
+        """
+        info = self._infos.get(name)
+        if info is None:
+            raise RuntimeError("No member '%s' in %s" % (name, self.filepath))
+        if info.compress_type == zipfile.ZIP_STORED:
+            return self._compressed_data(info)
+
+        data = self._cache.get(name)
+        if data is None:
+            data = decompress(self._compressed_data(info), info.compress_type)
+            self._cache.put(name, data)
+        return data
+
+    def _json_member(self, name):
+        return json.loads(bytes(self.member(name)).decode('utf-8'))
+
+    def verify(self):
+        """
+        Checks the CRC32, length and content hash of every member against the manifest
+
+        :return: list of the names of the members that don't match, or are missing
+        """
+        members = self.manifest.get(ManifestMembersKey) or {}
+        check_hash = self.manifest.get(ManifestHashTypeKey) == content_hash_type()
+        bad = []
+        for name, info in sorted(members.items()):
+            if name not in self._infos:
+                bad.append(name)
+                continue
+            data = self.member(name)
+            if len(data) != info[MemberLengthKey] or zlib.crc32(data) & 0xFFFFFFFF != info[MemberCRCKey]:
+                bad.append(name)
+            elif check_hash and content_hash(data) != info[MemberHashKey]:
+                bad.append(name)
+        return bad
+
+    def cache_stats(self):
+        """
+        :return: tuple of (hits, misses) of the decoded member cache
+        """
+        return self._cache.hits, self._cache.misses
+
+    # -- Buffers --
+
+    def _link_data(self, link):
+        """
+        :param link: Manifest link of a binary buffer
+        :return: The unfiltered bytes of the buffer
+        """
+        # Buffers in the packed buffer are slices of it, never filtered
+        if link['location'] == PackedBufferName:
+            offset = link[LinkOffsetKey]
+            return memoryview(self.member(PackedBufferName))[offset:offset + link['bytes_length']]
+
+        data = self.member(link['location'])
+        if len(data) != link['bytes_length']:
+            raise RuntimeError("Member '%s' is %d bytes long, its link says %d" % (link['location'], len(data),
+                                                                                  link['bytes_length']))
+
+        buffer_filter = link.get('filter')
+        if buffer_filter is None:
+            return data
+
+        key = (link['location'], buffer_filter[FilterIdKey])
+        unfiltered = self._cache.get(key)
+        if unfiltered is None:
+            unfiltered = undo_filter(bytes(data), buffer_filter)
+            self._cache.put(key, unfiltered)
+        return unfiltered
+
+    # -- Scene --
+
+    def objects(self):
+        """
+        :return: Names of the exported objects
+        """
+        return list(self.manifest['meshes'])
+
+    def meshes(self):
+        """
+        :return: Names of the exported mesh datablocks
+        """
+        return sorted(self.manifest.get('mesh_data') or {})
+
+    def object_manifest(self, object_name):
+        """
+        :return: The model manifest of the object, with its mesh, material and transform links
+        """
+        objects = self.manifest.get('objects')
+        if objects is None or object_name not in objects:
+            raise RuntimeError("No object '%s' in %s" % (object_name, self.filepath))
+        return objects[object_name]
+
+    def mesh_manifest(self, mesh_name):
+        """
+        :return: The manifest of the mesh datablock, with its buffer links and formats
+        """
+        mesh_data = self.manifest.get('mesh_data')
+        if mesh_data is None or mesh_name not in mesh_data:
+            raise RuntimeError("No mesh data for '%s' in %s" % (mesh_name, self.filepath))
+        return mesh_data[mesh_name]
+
+    def attribute(self, mesh_name, attribute, decode=False):
+        """
+        :param mesh_name: Name of the mesh datablock
+        :param attribute: 'verts', 'normals' or 'uvs'
+        :param decode: If the attribute should be decoded back into floats, see VertexFormats.decode_attribute.
+                       Decoding copies
+        :return: (verts x components) array of the stored attribute, or None if the attribute wasn't exported
+        """
+        if attribute not in _attribute_links:
+            raise RuntimeError("Unknown vertex attribute '%s'" % str(attribute))
+        link = self.mesh_manifest(mesh_name)[attribute]
+        if link is None:
+            return None
+        descriptor = link['format']
+        encoded = np.frombuffer(self._link_data(link), dtype=component_dtype(descriptor))
+        encoded = encoded.reshape(-1, descriptor[ComponentsKey])
+        return decode_attribute(encoded, descriptor) if decode else encoded
+
+    def indices(self, mesh_name):
+        """
+        :return: Array of the triangle indices of the mesh, each submesh's indices are relative to its first vertex.
+                 None if the indices weren't exported
+        """
+        mesh_manifest = self.mesh_manifest(mesh_name)
+        if mesh_manifest['ind'] is None:
+            return None
+        return np.frombuffer(self._link_data(mesh_manifest['ind']), dtype=_index_dtypes[mesh_manifest['index_format']])
+
+    def interleaved(self, mesh_name):
+        """
+        :return: Structured array of the interleaved vertex buffer, one field per attribute. None if the mesh has no
+                 interleaved buffer
+        """
+        link = self.mesh_manifest(mesh_name)['interleaved']
+        if link is None:
+            return None
+        vertex_format = link['vertex_format']
+        names, formats, offsets = [], [], []
+        for key, descriptor in sorted(vertex_format['attributes'].items(), key=lambda item: item[1]['offset']):
+            names.append(key)
+            formats.append((component_dtype(descriptor), (descriptor[ComponentsKey],)))
+            offsets.append(descriptor['offset'])
+        dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': vertex_format['stride']})
+        return np.frombuffer(self._link_data(link), dtype=dtype)
+
+    def instances(self, mesh_name):
+        """
+        :return: tuple of (names of the objects using the mesh, (objects x 4 x 4) array of their world matrices).
+                 The matrices are stored column-major, so each matrix is the transpose of blender's matrix_world
+        """
+        for instance in self.manifest.get('instances') or []:
+            if instance['mesh'] == mesh_name:
+                transforms = np.frombuffer(self._link_data(instance['transforms']), dtype=_TransformDtype)
+                return instance['objects'], transforms.reshape(-1, 4, 4)
+        raise RuntimeError("No instances of '%s' in %s" % (mesh_name, self.filepath))
+
+    def materials(self):
+        """
+        :return: The ids of the unique materials the objects link to
+        """
+        return list(self.manifest.get('material_data') or [])
+
+    def _library(self, link):
+        """
+        :return: ModelReader of the material library the link points to, relative to this archive
+        """
+        library = self._libraries.get(link)
+        if library is None:
+            filepath = os.path.join(os.path.dirname(os.path.abspath(self.filepath)), link)
+            if not os.path.isfile(filepath):
+                raise RuntimeError("Material library '%s' of %s is missing" % (link, self.filepath))
+            library = self._libraries[link] = ModelReader(filepath)
+        return library
+
+    def material(self, object_name):
+        """
+        :return: The encoded material of the object, None if the object uses the default material. Only the name for
+                 engine materials. Materials saved to a shared material library are read from it
+        """
+        material = self.object_manifest(object_name)['material']
+        if material is None:
+            return None
+        if material['location'] is None:
+            return {'name': material['name'], 'use_engine_mat': True}
+        if material.get('library') is not None:
+            return self._library(material['library'])._json_member(material['location'])
+        return self._json_member(material['location'])
+
+    def textures(self):
+        """
+        :return: The ids of the textures the materials link to
+        """
+        return list(self.manifest.get('texture_data') or [])
+
+    def texture_manifest(self, texture_id):
+        """
+        :return: The manifest of the texture, with its format and the size and offset of each mip level
+        """
+        texture_data = self.manifest.get('texture_data')
+        if texture_data is None or texture_id not in texture_data:
+            raise RuntimeError("No texture data for '%s' in %s" % (texture_id, self.filepath))
+        return texture_data[texture_id]
+
+    def texture(self, texture_id, level=0):
+        """
+        :param texture_id: The id of the texture, see textures
+        :param level: The mip level, 0 is the full size texture
+        :return: (height x width x 4) uint8 array of the mip level for rgba8 textures, from the bottom row up. The
+                 (blocks,) uint8 array of 8 or 16 bytes per 4x4 block for block compressed ones. Textures saved to a
+                 shared material library are read from it
+        """
+        tex_manifest = self.texture_manifest(texture_id)
+        reader = self
+        if tex_manifest.get('library') is not None:
+            reader = self._library(tex_manifest['library'])
+        mip = tex_manifest['mips'][level]
+        data = memoryview(reader.member(tex_manifest['location']))[mip['offset']:mip['offset'] + mip['bytes_length']]
+        if tex_manifest['format'] in _BlockBytes:
+            return np.frombuffer(data, dtype=np.uint8).reshape(-1, _BlockBytes[tex_manifest['format']])
+        return np.frombuffer(data, dtype=np.uint8).reshape(mip['height'], mip['width'], 4)
+
+    def transform(self, object_name):
+        """
+        :return: The encoded local transform of the object, see ModelExporter.encode_transform_data
+        """
+        return self._json_member(self.object_manifest(object_name)['location'])
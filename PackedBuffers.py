@@ -0,0 +1,156 @@
+import mmap
+import struct
+import zipfile
+
+import numpy as np
+
+from . import ExportOptions
+
+PackedBufferName = 'buffers.bin'
+PackedMagic = b'TTPK'
+PackedVersion = 1
+
+# The packed buffer starts with a header, then one entry per buffer, padded to the alignment. Every offset is from
+# the start of the packed buffer, and every buffer starts on the alignment
+_Header = struct.Struct('<4sHHII')  # magic, version, flags (0), alignment, buffer count
+_Entry = struct.Struct('<QQII')  # offset, length, buffer type, stride (bytes per element)
+
+# Buffer type ids in the binary header, by the link type in the manifest
+BufferTypeIds = {
+    'vert': 1,
+    'norm': 2,
+    'uv': 3,
+    'ind': 4,
+    'vbuf': 5,
+    'inst': 6
+}
+
+# Manifest keys of the packed buffer, and of the links to the buffers in it
+PackedLocationKey = 'location'
+PackedAlignmentKey = 'alignment'
+PackedHeaderLengthKey = 'header_length'
+PackedCountKey = 'buffer_count'
+PackedCompressedKey = 'compressed'  # If the packed buffer member is compressed, it can't be memory mapped then
+LinkIndexKey = 'index'  # Index of the buffer's entry in the binary header
+LinkOffsetKey = 'offset'
+LinkStrideKey = 'stride'
+
+
+def _padding(length, alignment):
+    return -length % alignment
+
+
+class PackedBufferWriter(object):
+    """
+    Packs binary buffers one after another into one aligned buffer. The links add returns get their final offsets when
+    the buffer is finished, the header length depends on the number of buffers. The buffers aren't copied until they
+    are joined into the packed buffer, once.
+    """
+
+    def __init__(self, alignment=ExportOptions.PackAlignmentDefault):
+        """
+        :param alignment: Byte alignment of each buffer, a power of 2 of at least 16
+        """
+        if alignment < 16 or alignment & (alignment - 1):
+            raise RuntimeError('Packed buffer alignment must be a power of 2 of at least 16, not %s' % str(alignment))
+        self.alignment = alignment
+        self._parts = []  # The buffers and the padding between them, the header goes in front when finished
+        self._length = 0
+        self._links = []
+
+    def add(self, data, type, stride):
+        """
+        :param data: bytes of the buffer, kept until finish so it must not change
+        :param type: Link type of the buffer, see BufferTypeIds
+        :param stride: Bytes per element (vertex, index, instance) of the buffer
+        :return: Manifest link of the buffer
+        """
+        padding = _padding(self._length, self.alignment)
+        if padding:
+            self._parts.append(b'\0' * padding)
+            self._length += padding
+        link = {'location': PackedBufferName, 'bytes_length': len(data), 'type': type, 'filter': None,
+                LinkIndexKey: len(self._links), LinkOffsetKey: self._length, LinkStrideKey: stride}
+        self._parts.append(data)
+        self._length += len(data)
+        self._links.append(link)
+        return link
+
+    def finish(self):
+        """
+        Puts the binary header in front of the buffers, and moves the offsets of the links add returned past it
+
+        :return: tuple of (bytes of the packed buffer, manifest dict of the packed buffer)
+        """
+        header_length = _Header.size + _Entry.size * len(self._links)
+        header_length += _padding(header_length, self.alignment)
+
+        header = bytearray(_Header.pack(PackedMagic, PackedVersion, 0, self.alignment, len(self._links)))
+        for link in self._links:
+            link[LinkOffsetKey] += header_length
+            header += _Entry.pack(link[LinkOffsetKey], link['bytes_length'], BufferTypeIds[link['type']],
+                                  link[LinkStrideKey])
+        header += b'\0' * _padding(len(header), self.alignment)
+
+        manifest = {PackedLocationKey: PackedBufferName, PackedAlignmentKey: self.alignment,
+                    PackedHeaderLengthKey: header_length, PackedCountKey: len(self._links)}
+        packed = b''.join([header] + self._parts)
+        self._parts = []
+        return packed, manifest
+
+
+def read_header(packed):
+    """
+    :param packed: The packed buffer, or the start of it. Any object supporting the buffer protocol
+    :return: tuple of (alignment, list of (offset, length, buffer type id, stride) of each buffer)
+    """
+    magic, version, _, alignment, count = _Header.unpack_from(packed, 0)
+    if magic != PackedMagic:
+        raise RuntimeError('Not a packed buffer, bad magic %r' % magic)
+    if version > PackedVersion:
+        raise RuntimeError('Packed buffer version %d is newer than this reader (%d)' % (version, PackedVersion))
+    return alignment, [_Entry.unpack_from(packed, _Header.size + _Entry.size * i) for i in range(count)]
+
+
+def member_data_offset(filepath, name):
+    """
+    :param filepath: Path of the zip archive
+    :param name: Name of a stored member
+    :return: Offset of the member's data in the file
+    """
+    with zipfile.ZipFile(filepath, 'r') as z:
+        info = z.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise RuntimeError("Member '%s' is compressed, it can't be read in place" % name)
+
+    with open(filepath, 'rb') as f:
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def map_packed(filepath):
+    """
+    Memory maps the stored packed buffer of a .model archive
+
+    :param filepath: Path of the .model archive
+    :return: tuple of (mmap of the archive, memoryview of the packed buffer in it). Views into it keep the mmap open
+    """
+    offset = member_data_offset(filepath, PackedBufferName)
+    with zipfile.ZipFile(filepath, 'r') as z:
+        length = z.getinfo(PackedBufferName).file_size
+
+    with open(filepath, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapped, memoryview(mapped)[offset:offset + length]
+
+
+def buffer_array(packed, link, dtype):
+    """
+    :param packed: The packed buffer
+    :param link: Manifest link of a buffer in the packed buffer
+    :param dtype: numpy dtype of the buffer's elements
+    :return: numpy array viewing the buffer in place, without copying
+    """
+    dtype = np.dtype(dtype)
+    return np.frombuffer(packed, dtype=dtype, count=link['bytes_length'] // dtype.itemsize, offset=link[LinkOffsetKey])
@@ -0,0 +1,177 @@
+import collections
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import ExportProfiler
+from .MeshExporter import encode_mesh_arrays
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python 3.8+, meshes are always encoded on the main thread without it
+    shared_memory = None
+
+_ArrayAlignment = 64  # Each array in the shared block starts on a cache line
+
+
+def parallel_encoding_supported():
+    """
+    :return: If this python can encode meshes on a process pool, see encode_meshes
+    """
+    return shared_memory is not None
+
+
+def encode_processes(processes):
+    """
+    :param processes: Processes asked for, 0 for one per core
+    :return: The number of processes to encode meshes with, 1 encodes on the main thread
+    """
+    if not parallel_encoding_supported():
+        return 1
+    return processes if processes > 0 else (os.cpu_count() or 1)
+
+
+def _python_executable():
+    """
+    :return: The python interpreter the worker processes are spawned with. Blender before 2.91 runs python embedded in
+             the blender binary, the interpreter it ships is binary_path_python
+    """
+    bpy = sys.modules.get('bpy')
+    executable = getattr(getattr(bpy, 'app', None), 'binary_path_python', None)
+    return executable or sys.executable
+
+
+def _spawn_context():
+    # Forking blender copies its threads and GPU state, spawned workers only import numpy and the encoding modules
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(_python_executable())
+    return context
+
+
+def _share_arrays(arrays):
+    """
+    Copies the arrays into one shared memory block
+
+    :param arrays: tuple of numpy arrays, or None
+    :return: tuple of (SharedMemory, list of (offset, dtype, shape) per array or None)
+    """
+    layout = []
+    length = 0
+    for array in arrays:
+        if array is None:
+            layout.append(None)
+            continue
+        length += -length % _ArrayAlignment
+        layout.append((length, array.dtype.str, array.shape))
+        length += array.nbytes
+
+    shm = shared_memory.SharedMemory(create=True, size=max(length, 1))
+    for array, descriptor in zip(arrays, layout):
+        if descriptor is not None:
+            offset, dtype, shape = descriptor
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = array
+    return shm, layout
+
+
+def _release(shm):
+    shm.close()
+    shm.unlink()
+
+
+def _encode_shared(name, shm_name, layout, mesh_opts):
+    """
+    Encodes mesh arrays shared by the main process, in a worker process. The arrays are read in place from the shared
+    block, only the encoded buffers are sent back.
+
+    :return: tuple of (encoded mesh data, seconds encoding took)
+    """
+    start = time.perf_counter()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        arrays = tuple(None if descriptor is None else
+                       np.ndarray(descriptor[2], dtype=descriptor[1], buffer=shm.buf, offset=descriptor[0])
+                       for descriptor in layout)
+        encoded = encode_mesh_arrays(name, arrays, *mesh_opts)
+        del arrays
+    finally:
+        shm.close()
+    return encoded, time.perf_counter() - start
+
+
+def encode_meshes(extracted_meshes, mesh_opts, cache, processes, print_stats=True):
+    """
+    Encodes the extracted meshes on a pool of worker processes, yielding them in the order they were extracted however
+    the workers finish, so the export is the same for any number of processes. Only a few meshes are encoding at once,
+    so streamed exports still only hold a few meshes in memory.
+
+    The arrays are extracted on the calling (main) thread, as bpy isn't thread safe, and passed to the workers through
+    shared memory. Cache hits are looked up on the calling thread and never sent to a worker.
+
+    :param extracted_meshes: Iterable of (mesh datablock name, object name, arrays from extract_mesh_data)
+    :param mesh_opts: tuple of the encode_mesh_data options, starting with the export option
+    :param cache: EncodeCache, or None to always encode
+    :param processes: Worker processes, see encode_processes
+    :param print_stats: If the cache stats should be printed after the last mesh
+    :return: Generator of (mesh datablock name, encoded mesh data)
+    """
+    # (mesh name, object name, cache key, shared block, future) or (mesh name, object name, None, None, encoded)
+    pending = collections.deque()
+    max_pending = processes * 2
+
+    def finish_oldest():
+        mesh_name, obj_name, key, shm, result = pending.popleft()
+        if shm is None:
+            return mesh_name, result
+        try:
+            encoded, seconds = result.result()
+        finally:
+            _release(shm)
+        ExportProfiler.add_time('encode_mesh', seconds, obj_name)
+        if cache is not None:
+            cache.put(key, encoded)
+        return mesh_name, encoded
+
+    pool = ProcessPoolExecutor(processes, mp_context=_spawn_context())
+    try:
+        for mesh_name, obj_name, arrays in extracted_meshes:
+            key, encoded = None, None
+            if cache is not None:
+                with ExportProfiler.stage('cache_lookup', obj_name):
+                    key = cache.key('mesh', arrays, mesh_opts)
+                    encoded = cache.get(key)
+
+            if encoded is not None:
+                pending.append((mesh_name, obj_name, key, None, encoded))
+            else:
+                with ExportProfiler.stage('share_arrays', obj_name):
+                    shm, layout = _share_arrays(arrays)
+                try:
+                    future = pool.submit(_encode_shared, obj_name, shm.name, layout, mesh_opts)
+                except Exception:
+                    _release(shm)
+                    raise
+                pending.append((mesh_name, obj_name, key, shm, future))
+            del arrays
+
+            # Hand over the meshes that are done in order, and wait for the oldest once enough are in flight
+            while pending and (len(pending) > max_pending or pending[0][3] is None or pending[0][4].done()):
+                yield finish_oldest()
+
+        while pending:
+            yield finish_oldest()
+    finally:
+        for _, _, _, shm, future in pending:
+            if shm is not None:
+                future.cancel()
+        pool.shutdown(wait=True)
+        for _, _, _, shm, _ in pending:
+            if shm is not None:
+                _release(shm)
+
+    if print_stats and cache is not None:
+        cache.print_stats()
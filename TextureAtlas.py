@@ -0,0 +1,234 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from . import ExportProfiler
+from .EncodeCache import new_hash, update_hash
+from .TextureExporter import extract_image, linear_texture, pow2_size
+
+AtlasIdFormat = 'atlas.%s'  # Named by their content, so atlases of different exports sharing a library don't clash
+_AtlasIdLength = 16  # Hex digits of the content hash in an atlas id
+
+# Atlas region keys
+RegionAtlasKey = 'atlas'
+RegionXKey = 'x'
+RegionYKey = 'y'
+RegionWidthKey = 'width'
+RegionHeightKey = 'height'
+RegionUVScaleKey = 'uv_scale'
+RegionUVOffsetKey = 'uv_offset'
+
+_BlockSize = 4  # Regions start on a block of the block compressed formats, so no block mixes two textures
+_UVTolerance = 1e-4  # How far outside 0-1 the UVs of an atlased texture may be, the gutter covers it
+
+
+def atlas_mip_levels(padding):
+    """
+    :param padding: Pixels of gutter around each texture in the atlas
+    :return: Mip levels an atlas keeps, the ones where the gutter is still at least a pixel wide. Smaller levels would
+             filter neighbouring textures into each other
+    """
+    return int(np.log2(padding)) + 1 if padding >= 1 else 1
+
+
+def _skyline_place(skyline, width, height, bin_size):
+    """
+    :param skyline: list of [x, y, width] segments of the top edge of the rectangles placed in a bin, left to right
+    :return: tuple of (x, y) of the lowest spot the rectangle fits, leftmost of the lowest, or None if it doesn't fit
+    """
+    best = None
+    for i in range(len(skyline)):
+        x = skyline[i][0]
+        if x + width > bin_size:
+            break
+        y, covered, j = 0, 0, i
+        while covered < width:
+            y = max(y, skyline[j][1])
+            covered += skyline[j][2]
+            j += 1
+        if y + height <= bin_size and (best is None or y < best[1]):
+            best = (x, y)
+    return best
+
+
+def _skyline_add(skyline, x, y, width, height):
+    """
+    Raises the skyline over the rectangle placed at x, y
+    """
+    right = x + width
+    updated = [[x, y + height, width]]
+    for seg_x, seg_y, seg_width in skyline:
+        seg_right = seg_x + seg_width
+        if seg_right <= x or seg_x >= right:
+            updated.append([seg_x, seg_y, seg_width])
+            continue
+        # Keep the parts of the segment sticking out either side of the rectangle
+        if seg_x < x:
+            updated.append([seg_x, seg_y, x - seg_x])
+        if seg_right > right:
+            updated.append([right, seg_y, seg_right - right])
+    # Merge neighbouring segments of the same height
+    skyline[:] = []
+    for segment in sorted(updated):
+        if skyline and skyline[-1][1] == segment[1] and skyline[-1][0] + skyline[-1][2] == segment[0]:
+            skyline[-1][2] += segment[2]
+        else:
+            skyline.append(segment)
+
+
+def pack_rectangles(sizes, bin_size):
+    """
+    Packs the rectangles into as few square bins as they fit in, with the skyline bottom-left heuristic. Rectangles are
+    placed tallest first, each where its top is lowest along the skyline of the rectangles already in a bin, in the
+    first bin it fits in.
+
+    :param sizes: list of (width, height) of the rectangles, each at most bin_size
+    :param bin_size: Width and height of the bins
+    :return: list of (bin, x, y) of the bottom left corner of each rectangle, in the order of sizes
+    """
+    bins = []
+    placements = [None] * len(sizes)
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0], i))
+    for i in order:
+        width, height = sizes[i]
+        if width > bin_size or height > bin_size:
+            raise RuntimeError('A %dx%d rectangle does not fit in a %dx%d bin' % (width, height, bin_size, bin_size))
+        for index, skyline in enumerate(bins):
+            spot = _skyline_place(skyline, width, height, bin_size)
+            if spot is not None:
+                break
+        else:
+            index, skyline, spot = len(bins), [[0, 0, bin_size]], (0, 0)
+            bins.append(skyline)
+        _skyline_add(skyline, spot[0], spot[1], width, height)
+        placements[i] = (index,) + spot
+    return placements
+
+
+class TextureAtlas(object):
+    """
+    Packs the small image textures of an export into shared atlases, so props that each use a tiny texture can be drawn
+    without switching textures. Each texture is scaled to a power of two, surrounded by a gutter of its own edge
+    pixels, and placed in an atlas with pack_rectangles. sRGB and data (normal map) textures go in separate atlases.
+
+    The meshes using an atlased texture have their UVs moved into its region, see MeshExporter.transform_uvs, so only
+    textures sampled with UVs inside 0-1 can be atlased.
+    """
+
+    def __init__(self, max_texture_size, atlas_size, padding):
+        """
+        :param max_texture_size: Largest width or height of a texture to atlas, see ExportOptions.AtlasTextureSizeKey
+        :param atlas_size: Width and height of the atlases, a power of two, see ExportOptions.AtlasSizeKey
+        :param padding: Pixels of gutter around each texture, see ExportOptions.AtlasPaddingKey
+        """
+        self.max_texture_size = max_texture_size
+        self.atlas_size = atlas_size
+        self.padding = padding
+        self.mip_levels = atlas_mip_levels(padding)
+        # Regions start on a block of the smallest mip level kept
+        self.alignment = _BlockSize << (self.mip_levels - 1)
+        if atlas_size < 1 or atlas_size & (atlas_size - 1):
+            raise RuntimeError('The atlas size has to be a power of two, not %d' % atlas_size)
+        if max_texture_size + 2 * padding > atlas_size:
+            raise RuntimeError('Textures up to %d pixels with %d pixels of padding do not fit in a %d pixel atlas' %
+                               (max_texture_size, padding, atlas_size))
+        self._images = OrderedDict()  # Texture id -> (pixels from extract_image, srgb), in the order they were added
+
+    def fits(self, image):
+        """
+        :return: If the image is small enough to be atlased, once scaled to a power of two
+        """
+        width, height = image.size
+        return 0 < min(width, height) and max(pow2_size(width, np.inf),
+                                               pow2_size(height, np.inf)) <= self.max_texture_size
+
+    def uvs_fit(self, bounds):
+        """
+        :param bounds: tuple of (min uv, max uv) of a mesh using the texture, see MeshExporter.uv_bounds
+        :return: If the UVs stay inside the texture, so moving them into its region of the atlas samples the same
+                 pixels. Tiled (repeating) UVs can't be atlased
+        """
+        if bounds is None:
+            return False
+        return bool(np.all(bounds[0] >= -_UVTolerance) and np.all(bounds[1] <= 1.0 + _UVTolerance))
+
+    def add(self, texture_id, image, srgb):
+        """
+        Adds the image to be packed into an atlas by pack, once. Its pixels are read now, so pack doesn't read blender
+        data and can run off the main thread
+
+        :param texture_id: The id the image would have as a texture of its own, see TextureRegistry.texture_id
+        """
+        if texture_id not in self._images:
+            self._images[texture_id] = (extract_image(image), srgb)
+
+    def __len__(self):
+        return len(self._images)
+
+    def _aligned(self, size):
+        return -(-(size + 2 * self.padding) // self.alignment) * self.alignment
+
+    def pack(self, encode):
+        """
+        Packs the images added into atlases and encodes them
+
+        :param encode: Function of (atlas id, linear pixels, srgb) -> encoded texture, to encode each atlas with. See
+                       TextureRegistry.pack_atlases
+        :return: tuple of (OrderedDict of atlas id -> encoded atlas, dict of texture id -> its region in an atlas)
+        """
+        atlases = OrderedDict()
+        regions = {}
+        for srgb in (True, False):
+            texture_ids = [texture_id for texture_id, (_, image_srgb) in self._images.items() if image_srgb == srgb]
+            if not texture_ids:
+                continue
+            with ExportProfiler.stage('atlas_resize'):
+                pixels = [linear_texture(self._images[texture_id][0], self.max_texture_size, srgb)
+                          for texture_id in texture_ids]
+            with ExportProfiler.stage('atlas_pack'):
+                placements = pack_rectangles([(self._aligned(p.shape[1]), self._aligned(p.shape[0])) for p in pixels],
+                                             self.atlas_size)
+            for index in sorted(set(placement[0] for placement in placements)):
+                members = [(texture_id, p, placement[1:]) for texture_id, p, placement in
+                           zip(texture_ids, pixels, placements) if placement[0] == index]
+                atlas, atlas_regions = self._fill(members)
+                hasher = new_hash()
+                update_hash(hasher, (srgb, atlas))
+                atlas_id = AtlasIdFormat % hasher.hexdigest()[:_AtlasIdLength]
+                atlases[atlas_id] = encode(atlas_id, atlas, srgb)
+                for region in atlas_regions.values():
+                    region[RegionAtlasKey] = atlas_id
+                regions.update(atlas_regions)
+        ExportProfiler.count('atlas_textures', len(regions))
+        print('%d textures packed into %d atlases' % (len(regions), len(atlases)))
+        return atlases, regions
+
+    def _fill(self, members):
+        """
+        Copies the textures into one atlas, each with its gutter. The atlas is cut down to the smallest power of two
+        height that holds them.
+
+        :param members: list of (texture id, linear pixels, (x, y) of its aligned rectangle)
+        :return: tuple of ((height x width x 4) float32 array of the atlas, dict of texture id -> region, without
+                 the atlas id)
+        """
+        top = max(y + self._aligned(p.shape[0]) for _, p, (_, y) in members)
+        height = min(self.atlas_size, 2 ** int(np.ceil(np.log2(top))))
+        # The space between textures is opaque, so an atlas of opaque textures is still stored without alpha
+        atlas = np.zeros((height, self.atlas_size, 4), dtype=np.float32)
+        atlas[..., 3] = 1.0
+        regions = {}
+        for texture_id, pixels, (x, y) in members:
+            h, w = pixels.shape[:2]
+            pad = self.padding
+            atlas[y:y + h + 2 * pad, x:x + w + 2 * pad] = np.pad(pixels, ((pad, pad), (pad, pad), (0, 0)), mode='edge')
+            # Rows go from the bottom of the atlas up, as the textures store them, so v is measured from the bottom too
+            regions[texture_id] = {
+                RegionXKey: x + pad,
+                RegionYKey: y + pad,
+                RegionWidthKey: w,
+                RegionHeightKey: h,
+                RegionUVScaleKey: [w / float(self.atlas_size), h / float(height)],
+                RegionUVOffsetKey: [(x + pad) / float(self.atlas_size), (y + pad) / float(height)]
+            }
+        return atlas, regions
@@ -0,0 +1,446 @@
+import os
+from collections import OrderedDict
+
+import bpy
+import numpy as np
+
+from . import ExportOptions, ExportProfiler
+
+EncodedTextureFormatKey = 'format'
+EncodedTextureWidthKey = 'width'
+EncodedTextureHeightKey = 'height'
+EncodedTextureSRGBKey = 'srgb'
+EncodedTextureMipsKey = 'mips'  # list of (width, height, bytes) of each mip level, largest first
+
+# Formats of the encoded textures
+TextureRGBA8Format = 'rgba8'
+TextureBC1Format = 'bc1'  # DXT1, 8 bytes per 4x4 block, opaque
+TextureBC3Format = 'bc3'  # DXT5, 16 bytes per 4x4 block, BC4 alpha block then a BC1 color block
+
+_BC1Block = np.dtype([('color0', '<u2'), ('color1', '<u2'), ('indices', '<u4')])
+_PowerIterations = 8  # Finds the principal axis of the colors of each block
+_BlocksPerChunk = 16384  # Blocks compressed at once, bounds the memory of the distances to each palette color
+_BC1Indices = np.array([1, 3, 2, 0], dtype=np.uint32)  # Index of the color 0, 1/3, 2/3 and all the way to color0
+
+
+def pow2_size(size, max_size):
+    """
+    :return: The power of two nearest to size, at most the largest power of two under max_size
+    """
+    return 2 ** int(min(round(np.log2(max(size, 1))), np.floor(np.log2(max(max_size, 1)))))
+
+
+def _srgb_to_linear(rgb):
+    return np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+
+
+def _linear_to_srgb(rgb):
+    return np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * np.power(np.maximum(rgb, 0.0031308), 1.0 / 2.4) - 0.055)
+
+
+def _halve(pixels, axis):
+    """
+    Box filters the pixels down to half their size along the axis, dropping the last row or column if it is odd
+    """
+    n = pixels.shape[axis] // 2 * 2
+    even = np.take(pixels, np.arange(0, n, 2), axis=axis)
+    odd = np.take(pixels, np.arange(1, n, 2), axis=axis)
+    return (even + odd) * 0.5
+
+
+def _resample_axis(pixels, size, axis):
+    """
+    Resizes the pixels along the axis, box filtering down by halves while they are over twice the size, then linearly
+    interpolating between pixel centers
+    """
+    while pixels.shape[axis] >= size * 2:
+        pixels = _halve(pixels, axis)
+    n = pixels.shape[axis]
+    if n == size:
+        return pixels
+
+    source = np.clip((np.arange(size) + 0.5) * (float(n) / size) - 0.5, 0.0, n - 1)
+    first = np.floor(source).astype(np.int64)
+    second = np.minimum(first + 1, n - 1)
+    shape = [1] * pixels.ndim
+    shape[axis] = size
+    weight = (source - first).reshape(shape).astype(pixels.dtype)
+    return np.take(pixels, first, axis=axis) * (1.0 - weight) + np.take(pixels, second, axis=axis) * weight
+
+
+def _mip_chain(pixels):
+    """
+    :param pixels: (height x width x 4) float array of a power of two sized image, in linear light
+    :return: list of the mip levels, down to 1x1, each half the size of the last with a 2x2 box filter
+    """
+    mips = [pixels]
+    while pixels.shape[0] > 1 or pixels.shape[1] > 1:
+        if pixels.shape[0] > 1:
+            pixels = _halve(pixels, 0)
+        if pixels.shape[1] > 1:
+            pixels = _halve(pixels, 1)
+        mips.append(pixels)
+    return mips
+
+
+def _to_rgba8(pixels, srgb):
+    """
+    :return: (height x width x 4) uint8 array of the linear pixels, sRGB encoded if srgb is set
+    """
+    if srgb:
+        pixels = np.concatenate([_linear_to_srgb(pixels[..., :3]), pixels[..., 3:]], axis=-1)
+    return np.clip(np.round(pixels * 255.0), 0, 255).astype(np.uint8)
+
+
+# -- Block compression --
+
+def _blocks(rgba8):
+    """
+    :return: (blocks x 16 x 4) uint8 array of the 4x4 blocks of the image, in rows of blocks. Images that aren't a
+             multiple of 4 are padded with their edge pixels
+    """
+    height, width = rgba8.shape[:2]
+    padded = np.pad(rgba8, ((0, -height % 4), (0, -width % 4), (0, 0)), mode='edge')
+    rows, columns = padded.shape[0] // 4, padded.shape[1] // 4
+    return padded.reshape(rows, 4, columns, 4, 4).transpose(0, 2, 1, 3, 4).reshape(-1, 16, 4)
+
+
+def _pack_565(colors):
+    """
+    :return: array of the RGB colors (0-255) rounded to 5:6:5 bit colors
+    """
+    r = np.round(colors[:, 0] * (31.0 / 255.0)).astype(np.uint16)
+    g = np.round(colors[:, 1] * (63.0 / 255.0)).astype(np.uint16)
+    b = np.round(colors[:, 2] * (31.0 / 255.0)).astype(np.uint16)
+    return (r << 11) | (g << 5) | b
+
+
+def _unpack_565(packed):
+    """
+    :return: (n x 3) float array of the 5:6:5 bit colors, expanded back to 0-255 the way GPUs decode them
+    """
+    r = (packed >> 11) & 31
+    g = (packed >> 5) & 63
+    b = packed & 31
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], axis=1).astype(np.float64)
+
+
+def _nearest(values, palette):
+    """
+    :param values: (blocks x 16 x channels) array
+    :param palette: (blocks x entries x channels) array
+    :return: (blocks x 16) array of the index of the palette entry nearest each value
+    """
+    distances = ((values[:, :, np.newaxis, :] - palette[:, np.newaxis, :, :]) ** 2).sum(axis=-1)
+    return np.argmin(distances, axis=-1)
+
+
+def _encode_bc1_colors(blocks):
+    """
+    Encodes the RGB of each block as a BC1 color block. The endpoints are the extremes of the colors along their
+    principal axis, and each pixel picks the nearest of the 4 colors between them. The 4 colors are on a line, so the
+    nearest is found by projecting onto it.
+
+    :param blocks: (blocks x 16 x 4) float array of the blocks, see _blocks
+    :return: array of _BC1Block
+    """
+    colors = blocks[:, :, :3]
+    mean = colors.mean(axis=1)
+    centered = colors - mean[:, np.newaxis, :]
+    covariance = np.matmul(centered.transpose(0, 2, 1), centered)
+    axis = np.ones((len(blocks), 3, 1))
+    for _ in range(_PowerIterations):
+        axis = np.matmul(covariance, axis)
+        axis /= np.maximum(np.abs(axis).max(axis=1, keepdims=True), 1e-12)
+    projections = np.matmul(centered, axis)[:, :, 0]
+    axis = axis[:, :, 0]
+    low = mean + axis * projections.min(axis=1)[:, np.newaxis]
+    high = mean + axis * projections.max(axis=1)[:, np.newaxis]
+
+    color0 = _pack_565(np.clip(high, 0.0, 255.0))
+    color1 = _pack_565(np.clip(low, 0.0, 255.0))
+    # color0 > color1 selects the 4 color mode, single color blocks use index 0 only
+    swap = color0 < color1
+    color0, color1 = np.where(swap, color1, color0), np.where(swap, color0, color1)
+
+    end0, end1 = _unpack_565(color0), _unpack_565(color1)
+    direction = end0 - end1
+    along = np.matmul(colors - end1[:, np.newaxis, :], direction[:, :, np.newaxis])[:, :, 0]
+    along /= np.maximum((direction * direction).sum(axis=1), 1e-12)[:, np.newaxis]
+    indices = _BC1Indices[np.clip(np.rint(along * 3.0), 0, 3).astype(np.intp)]
+    indices[color0 == color1] = 0
+
+    encoded = np.empty(len(blocks), dtype=_BC1Block)
+    encoded['color0'] = color0
+    encoded['color1'] = color1
+    encoded['indices'] = (indices << (2 * np.arange(16, dtype=np.uint32))).sum(axis=1, dtype=np.uint32)
+    return encoded
+
+
+def _encode_bc4_alpha(blocks):
+    """
+    Encodes the alpha of each block as a BC3 (BC4) alpha block, with the 8 value mode between the extremes
+
+    :param blocks: (blocks x 16 x 4) float array of the blocks, see _blocks
+    :return: (blocks x 8) uint8 array
+    """
+    alpha = blocks[:, :, 3]
+    alpha0 = alpha.max(axis=1)
+    alpha1 = alpha.min(axis=1)
+    steps = np.arange(1, 7, dtype=np.float64)
+    palette = np.concatenate([alpha0[:, np.newaxis], alpha1[:, np.newaxis],
+                              ((7.0 - steps) * alpha0[:, np.newaxis] + steps * alpha1[:, np.newaxis]) / 7.0], axis=1)
+    indices = _nearest(alpha[:, :, np.newaxis], np.floor(palette)[:, :, np.newaxis]).astype(np.uint64)
+    indices[alpha0 == alpha1] = 0
+
+    encoded = np.empty((len(blocks), 8), dtype=np.uint8)
+    encoded[:, 0] = alpha0
+    encoded[:, 1] = alpha1
+    bits = (indices << (3 * np.arange(16, dtype=np.uint64))).sum(axis=1, dtype=np.uint64)
+    encoded[:, 2:] = bits.astype('<u8').view(np.uint8).reshape(-1, 8)[:, :6]
+    return encoded
+
+
+def encode_blocks(rgba8, texture_format):
+    """
+    Block compresses the image, for the GPU to sample without decompressing
+
+    :param rgba8: (height x width x 4) uint8 array
+    :param texture_format: TextureBC1Format, or TextureBC3Format to keep the alpha
+    :return: bytes of the blocks, in rows of blocks from the first row of the image
+    """
+    blocks = _blocks(rgba8)
+    chunks = []
+    for start in range(0, len(blocks), _BlocksPerChunk):
+        chunk = blocks[start:start + _BlocksPerChunk].astype(np.float64)
+        colors = _encode_bc1_colors(chunk)
+        if texture_format == TextureBC1Format:
+            chunks.append(colors.tobytes())
+        else:
+            chunks.append(np.concatenate([_encode_bc4_alpha(chunk), colors.view(np.uint8).reshape(-1, 8)],
+                                         axis=1).tobytes())
+    return b''.join(chunks)
+
+
+# -- Images --
+
+def image_fingerprint(image):
+    """
+    :return: tuple identifying what the image holds without reading its pixels, or None if the pixels have to be hashed.
+             Images loaded from a file that weren't edited since are identified by the file's path, size and
+             modification time
+    """
+    if image.is_dirty or image.packed_file is not None:
+        return None
+    if not image.filepath:
+        return None
+    filepath = bpy.path.abspath(image.filepath, library=image.library)
+    if not os.path.isfile(filepath):
+        return None
+    stat = os.stat(filepath)
+    return image.name, tuple(image.size), os.path.abspath(filepath), stat.st_size, stat.st_mtime
+
+
+def extract_image(image):
+    """
+    :param image: Blender image
+    :return: (height x width x 4) float32 array of the RGBA pixels, from the bottom row up as blender stores them
+    """
+    width, height = image.size
+    if width == 0 or height == 0:
+        raise RuntimeError("Image '%s' has no pixels, it may be missing its file" % image.name)
+    with ExportProfiler.stage('extract_image', image.name):
+        pixels = np.empty(width * height * image.channels, dtype=np.float32)
+        if hasattr(image.pixels, 'foreach_get'):
+            image.pixels.foreach_get(pixels)
+        else:
+            pixels[:] = image.pixels[:]
+        pixels = pixels.reshape(height, width, image.channels)
+    if image.channels == 4:
+        return pixels
+    rgba = np.ones((height, width, 4), dtype=np.float32)
+    rgba[..., :min(image.channels, 3)] = pixels[..., :3]
+    if image.channels < 3:
+        rgba[..., 1:3] = pixels[..., :1]  # Grayscale
+    return rgba
+
+
+def linear_texture(pixels, max_size, srgb):
+    """
+    :param pixels: (height x width x 4) float array, from extract_image
+    :param max_size: Largest width or height to keep, see ExportOptions.TextureMaxSizeKey
+    :param srgb: If the color channels are sRGB encoded, they are converted to linear light to be filtered
+    :return: (height x width x 4) float32 array of the pixels in linear light, resized to a power of two
+    """
+    height, width = pixels.shape[:2]
+    pixels = np.asarray(pixels, dtype=np.float32)
+    if srgb:
+        pixels = np.concatenate([_srgb_to_linear(np.clip(pixels[..., :3], 0.0, 1.0)), pixels[..., 3:]], axis=-1)
+    pixels = _resample_axis(pixels, pow2_size(height, max_size), 0)
+    return _resample_axis(pixels, pow2_size(width, max_size), 1)
+
+
+def encode_linear_texture(name, pixels, texture_format, srgb, mip_levels=None):
+    """
+    Generates the mip chain of the image and encodes every level
+
+    :param name: Name of the texture, for the export log
+    :param pixels: (height x width x 4) float array of a power of two sized image in linear light, see linear_texture
+    :param texture_format: ExportOptions.TextureRGBA8 or ExportOptions.TextureBC, BC picks BC1 for opaque images and
+                           BC3 for images with alpha
+    :param srgb: If the color channels are stored sRGB encoded
+    :param mip_levels: Most mip levels to keep, None keeps them all down to 1x1
+    :return: dict of the encoded texture, see the EncodedTexture keys
+    """
+    with ExportProfiler.stage('mips', name):
+        mips = [_to_rgba8(mip, srgb) for mip in _mip_chain(pixels)[:mip_levels]]
+
+    if texture_format == ExportOptions.TextureRGBA8:
+        encoded_format = TextureRGBA8Format
+    else:
+        encoded_format = TextureBC3Format if mips[0][..., 3].min() < 255 else TextureBC1Format
+    encoded_mips = []
+    with ExportProfiler.stage('compress_blocks', name):
+        for mip in mips:
+            data = mip.tobytes() if encoded_format == TextureRGBA8Format else encode_blocks(mip, encoded_format)
+            encoded_mips.append((mip.shape[1], mip.shape[0], data))
+    ExportProfiler.count('texture_bytes', sum(len(data) for _, _, data in encoded_mips))
+
+    return {
+        EncodedTextureFormatKey: encoded_format,
+        EncodedTextureWidthKey: mips[0].shape[1],
+        EncodedTextureHeightKey: mips[0].shape[0],
+        EncodedTextureSRGBKey: srgb,
+        EncodedTextureMipsKey: encoded_mips
+    }
+
+
+def encode_texture(name, pixels, texture_format, max_size, srgb):
+    """
+    Resizes the image to a power of two, generates its mip chain and encodes every level
+
+    :param name: Name of the image
+    :param pixels: (height x width x 4) float array, from extract_image
+    :param texture_format: ExportOptions.TextureRGBA8 or ExportOptions.TextureBC, see encode_linear_texture
+    :param max_size: Largest width or height to keep, see ExportOptions.TextureMaxSizeKey
+    :param srgb: If the color channels are sRGB encoded, they are filtered in linear light
+    :return: dict of the encoded texture, see the EncodedTexture keys
+    """
+    with ExportProfiler.stage('encode_texture', name):
+        with ExportProfiler.stage('resize'):
+            linear = linear_texture(pixels, max_size, srgb)
+        encoded = encode_linear_texture(name, linear, texture_format, srgb)
+
+    print('  %s: %dx%d -> %dx%d %s, %d mips' % (name, pixels.shape[1], pixels.shape[0], linear.shape[1],
+                                               linear.shape[0], encoded[EncodedTextureFormatKey],
+                                               len(encoded[EncodedTextureMipsKey])))
+    return encoded
+
+
+class TextureRegistry(object):
+    """
+    The textures of one export, each image encoded once however many materials use it. The encoded textures are kept in
+    the EncodeCache by the image's content, so images that haven't changed since an earlier export aren't encoded
+    again.
+
+    Deferred, texture_id only reads the images and encode_pending encodes them, so the encoding can run off the main
+    thread. The pixels of every image waiting are held until then.
+    """
+
+    def __init__(self, texture_format, max_size, cache=None, atlas=None, defer=False):
+        """
+        :param texture_format: How to encode the textures, see ExportOptions.TextureFormatKey
+        :param max_size: Largest width or height to keep, see ExportOptions.TextureMaxSizeKey
+        :param cache: EncodeCache, or None to always encode
+        :param atlas: TextureAtlas.TextureAtlas to pack small textures into, None gives every image its own texture
+        :param defer: If the images are encoded by encode_pending, instead of as texture_id reads them
+        """
+        self.texture_format = texture_format
+        self.max_size = max_size
+        self.cache = cache
+        self.atlas = atlas
+        self.defer = defer
+        self.textures = OrderedDict()  # Texture id -> encoded texture, in the order they were first used
+        self._pending = []  # (texture id, image name, pixels, srgb, cache key) of the images read but not encoded yet
+
+    def texture_id(self, image, srgb, atlas=False):
+        """
+        Encodes the image, unless it already was. Call on the main thread, it reads the image
+
+        :param image: Blender image
+        :param srgb: If the image holds sRGB colors, not data like normals
+        :param atlas: If the image may be packed into an atlas instead. Images small enough for it are encoded by
+                      pack_atlases, as part of their atlas
+        :return: The id of the image's texture in textures, or of its region in the atlases
+        """
+        texture_id = image.name if srgb else '%s.linear' % image.name
+        if atlas and self.atlas is not None and self.atlas.fits(image):
+            self.atlas.add(texture_id, image, srgb)
+            return texture_id
+        if texture_id in self.textures:
+            return texture_id
+
+        opts = (self.texture_format, self.max_size, srgb)
+        if self.cache is None:
+            self._encode_later(texture_id, image.name, extract_image(image), srgb, None)
+            return texture_id
+
+        fingerprint = image_fingerprint(image)
+        pixels = None
+        if fingerprint is None:
+            pixels = extract_image(image)
+            fingerprint = (image.name, pixels)
+        with ExportProfiler.stage('cache_lookup', image.name):
+            key = self.cache.key('texture', fingerprint, opts)
+            encoded = self.cache.get(key)
+        if encoded is None:
+            self._encode_later(texture_id, image.name, extract_image(image) if pixels is None else pixels, srgb, key)
+        else:
+            self.textures[texture_id] = encoded
+        return texture_id
+
+    def _encode_later(self, texture_id, name, pixels, srgb, key):
+        # The id goes in now, so the textures stay in the order they were first used
+        self.textures[texture_id] = None
+        self._pending.append((texture_id, name, pixels, srgb, key))
+        if not self.defer:
+            self.encode_pending()
+
+    def encode_pending(self):
+        """
+        Encodes the images texture_id read and didn't encode yet. Doesn't read blender data
+        """
+        while self._pending:
+            texture_id, name, pixels, srgb, key = self._pending.pop(0)
+            encoded = encode_texture(name, pixels, self.texture_format, self.max_size, srgb)
+            if key is not None:
+                self.cache.put(key, encoded)
+            self.textures[texture_id] = encoded
+
+    def pack_atlases(self):
+        """
+        Packs the images added to the atlas into atlases, and adds them to textures
+
+        :return: dict of texture id -> its region in an atlas, see TextureAtlas.pack
+        """
+        if self.atlas is None or len(self.atlas) == 0:
+            return {}
+        atlases, regions = self.atlas.pack(self._encode_atlas)
+        self.textures.update(atlases)
+        return regions
+
+    def _encode_atlas(self, atlas_id, pixels, srgb):
+        opts = (self.texture_format, srgb, self.atlas.mip_levels)
+        with ExportProfiler.stage('encode_texture', atlas_id):
+            if self.cache is None:
+                encoded = encode_linear_texture(atlas_id, pixels, *opts)
+            else:
+                with ExportProfiler.stage('cache_lookup'):
+                    key = self.cache.key('atlas', pixels, opts)
+                    encoded = self.cache.get(key)
+                if encoded is None:
+                    encoded = encode_linear_texture(atlas_id, pixels, *opts)
+                    self.cache.put(key, encoded)
+        print('  %s: %dx%d %s, %d mips' % (atlas_id, pixels.shape[1], pixels.shape[0], encoded[EncodedTextureFormatKey],
+                                           len(encoded[EncodedTextureMipsKey])))
+        return encoded
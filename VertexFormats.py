@@ -0,0 +1,187 @@
+import numpy as np
+
+from . import ExportOptions
+
+# Attribute descriptor keys
+TypeKey = 'type'  # Component type in the buffer, see _component_dtypes
+ComponentsKey = 'components'  # Components stored per vertex
+EncodingKey = 'encoding'  # How the stored components map back to the attribute, see the encodings below
+ScaleKey = 'scale'  # For aabb encodings, value = stored * scale + offset
+OffsetKey = 'offset'
+MaxErrorKey = 'max_error'  # Largest error of the encoding over the exported vertices
+ErrorMetricKey = 'error_metric'  # 'abs' for the largest absolute component error, 'degrees' for the largest angle
+
+# Attribute encodings
+RawEncoding = 'raw'  # Components are stored as they are
+AABBEncoding = 'aabb'  # Components are unorms over the bounding box of the attribute
+OctahedralEncoding = 'octahedral'  # Unit vectors folded onto an octahedron, stored as 2 snorms
+
+_component_dtypes = {
+    'f32': np.dtype('<f4'),
+    'f16': np.dtype('<f2'),
+    'unorm16': np.dtype('<u2'),
+    'snorm16': np.dtype('<i2'),
+    'snorm8': np.dtype('i1')
+}
+
+# Option value -> (component type, encoding), for each attribute
+_position_formats = {
+    ExportOptions.PositionFloat: ('f32', RawEncoding),
+    ExportOptions.PositionUnorm16: ('unorm16', AABBEncoding)
+}
+_normal_formats = {
+    ExportOptions.NormalFloat: ('f32', RawEncoding),
+    ExportOptions.NormalOct16: ('snorm16', OctahedralEncoding),
+    ExportOptions.NormalOct8: ('snorm8', OctahedralEncoding)
+}
+_uv_formats = {
+    ExportOptions.UVFloat: ('f32', RawEncoding),
+    ExportOptions.UVHalf: ('f16', RawEncoding),
+    ExportOptions.UVUnorm16: ('unorm16', AABBEncoding)
+}
+
+
+def component_dtype(descriptor):
+    """
+    :param descriptor: Attribute descriptor from one of the encode functions
+    :return: The little-endian numpy dtype of the components of the attribute
+    """
+    return _component_dtypes[descriptor[TypeKey]]
+
+
+def _snorm_max(component_type):
+    return float(np.iinfo(_component_dtypes[component_type]).max)
+
+
+def _encode_aabb(values, component_type, components):
+    """
+    Quantizes the values to unorms spanning the bounding box of the values, padded out to the number of components
+    given so the attribute stays 4 byte aligned.
+    """
+    unorm_max = float(np.iinfo(_component_dtypes[component_type]).max)
+    if len(values) > 0:
+        low = values.min(axis=0).astype(np.float64)
+        extent = values.max(axis=0) - low
+    else:
+        low = np.zeros(values.shape[1])
+        extent = np.zeros(values.shape[1])
+    extent[extent == 0.0] = 1.0
+    scale = extent / unorm_max
+
+    encoded = np.zeros((len(values), components), dtype=_component_dtypes[component_type])
+    encoded[:, :values.shape[1]] = np.clip(np.rint((values - low) / scale), 0.0, unorm_max)
+    return encoded, scale.tolist(), low.tolist()
+
+
+def _sign_not_zero(values):
+    return np.where(values >= 0.0, 1.0, -1.0)
+
+
+def _encode_octahedral(normals, component_type):
+    """
+    Octahedral normal encoding (Cigolle et al., "A Survey of Efficient Representations for Independent Unit Vectors")
+    """
+    normals = normals.astype(np.float64)
+    lengths = np.abs(normals).sum(axis=1)
+    lengths[lengths == 0.0] = 1.0
+    folded = normals[:, :2] / lengths[:, None]
+
+    # Fold the lower hemisphere over the diagonals
+    lower = normals[:, 2] < 0.0
+    folded[lower] = (1.0 - np.abs(folded[lower][:, ::-1])) * _sign_not_zero(folded[lower])
+
+    snorm_max = _snorm_max(component_type)
+    return np.rint(np.clip(folded, -1.0, 1.0) * snorm_max).astype(_component_dtypes[component_type])
+
+
+def _decode_octahedral(encoded, component_type):
+    folded = np.maximum(encoded.astype(np.float64) / _snorm_max(component_type), -1.0)
+    z = 1.0 - np.abs(folded).sum(axis=1)
+    unfold = np.maximum(-z, 0.0)
+    xy = folded - _sign_not_zero(folded) * unfold[:, None]
+    normals = np.concatenate((xy, z[:, None]), axis=1)
+    return normals / np.linalg.norm(normals, axis=1)[:, None]
+
+
+def decode_attribute(encoded, descriptor):
+    """
+    Turns an encoded attribute back into floats.
+
+    :param encoded: (verts x components) array of the stored attribute
+    :param descriptor: Attribute descriptor from one of the encode functions
+    :return: float64 array (verts x attribute size) of the attribute values
+    """
+    encoding = descriptor[EncodingKey]
+    if encoding == OctahedralEncoding:
+        return _decode_octahedral(encoded[:, :2], descriptor[TypeKey])
+
+    decoded = encoded.astype(np.float64)
+    if encoding == AABBEncoding:
+        size = len(descriptor[ScaleKey])
+        decoded = decoded[:, :size] * descriptor[ScaleKey] + descriptor[OffsetKey]
+    return decoded
+
+
+def _max_error(values, decoded, encoding):
+    if len(values) == 0:
+        return 0.0
+    if encoding == OctahedralEncoding:
+        # Zero length normals have no direction to lose
+        lengths = np.linalg.norm(values, axis=1)
+        valid = lengths > 0.0
+        if not valid.any():
+            return 0.0
+        cosines = np.einsum('ij,ij->i', values[valid] / lengths[valid, None], decoded[valid])
+        return float(np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0))).max())
+    return float(np.abs(decoded - values).max())
+
+
+def _encode_attribute(values, component_type, encoding, components):
+    if encoding == AABBEncoding:
+        encoded, scale, offset = _encode_aabb(values, component_type, components)
+    elif encoding == OctahedralEncoding:
+        encoded, scale, offset = _encode_octahedral(values, component_type), None, None
+    else:
+        encoded, scale, offset = values.astype(_component_dtypes[component_type]), None, None
+
+    descriptor = {
+        TypeKey: component_type,
+        ComponentsKey: encoded.shape[1],
+        EncodingKey: encoding,
+        ScaleKey: scale,
+        OffsetKey: offset,
+        ErrorMetricKey: 'degrees' if encoding == OctahedralEncoding else 'abs'
+    }
+    descriptor[MaxErrorKey] = _max_error(values, decode_attribute(encoded, descriptor), encoding)
+    return encoded, descriptor
+
+
+def encode_positions(positions, position_format):
+    """
+    :param positions: float32 array (verts x 3)
+    :param position_format: See ExportOptions.PositionFormatKey
+    :return: tuple of (encoded array, attribute descriptor)
+    """
+    component_type, encoding = _position_formats[position_format]
+    # 16-bit positions get a 4th padding component, so each position is 8 bytes
+    return _encode_attribute(positions, component_type, encoding, 4)
+
+
+def encode_normals(normals, normal_format):
+    """
+    :param normals: float32 array (verts x 3) of unit normals
+    :param normal_format: See ExportOptions.NormalFormatKey
+    :return: tuple of (encoded array, attribute descriptor)
+    """
+    component_type, encoding = _normal_formats[normal_format]
+    return _encode_attribute(normals, component_type, encoding, 3)
+
+
+def encode_uvs(uvs, uv_format):
+    """
+    :param uvs: float32 array (verts x 2)
+    :param uv_format: See ExportOptions.UVFormatKey
+    :return: tuple of (encoded array, attribute descriptor)
+    """
+    component_type, encoding = _uv_formats[uv_format]
+    return _encode_attribute(uvs, component_type, encoding, 2)
@@ -9,18 +9,23 @@ bl_info = {
     "category": "Import-Export"
 }
 
-import bpy
+try:
+    import bpy
+except ImportError:
+    # Outside of blender, only the modules that don't need bpy can be used (ModelReader, ModelArchive...)
+    bpy = None
 
-from . import operator
+if bpy is not None:
+    from . import operator
+
+    classes = (
+        operator.TTModelExporter,
+    )
 
 
 def menu_opt(self, context):
     self.layout.operator(operator.TTModelExporter.bl_idname, text="Turn Tactics (.model)")
 
-classes = (
-    operator.TTModelExporter,
-)
-
 
 def register():
     bpy.types.INFO_MT_file_export.append(menu_opt)
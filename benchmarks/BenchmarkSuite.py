@@ -0,0 +1,281 @@
+"""
+Times each stage of the export on synthetic scenes, on its own: _convert_bmesh, encode_mesh_data, encode_material_data,
+export_model and save_model, along with the peak memory each one allocates. The scenes are grids with many UV seams and
+UV spheres from 1k vertices up, many objects instancing a few meshes, and objects with color ramp materials.
+
+The results are written as JSON, tagged with the commit they were measured on. Comparing them with the results of
+another commit flags every stage that got slower, or allocates more, than the threshold allows.
+
+Usage: python benchmarks/BenchmarkSuite.py [--profile quick|full] [--repeats N] [--no-memory] [--output results.json]
+                                           [--compare baseline.json] [--threshold 1.25]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import StandIn
+
+ExportOptions = StandIn.import_addon_module('ExportOptions')
+MeshExporter = StandIn.import_addon_module('MeshExporter')
+MaterialExporter = StandIn.import_addon_module('MaterialExporter')
+ModelExporter = StandIn.import_addon_module('ModelExporter')
+ModelCompressor = StandIn.import_addon_module('ModelCompressor')
+
+ResultsVersion = 1
+
+# Vertex counts of the meshes, the instanced objects and the objects with materials of each profile
+_profiles = {
+    'quick': {'verts': (1000, 16000, 128000), 'instances': 256, 'materials': 64},
+    'full': {'verts': (1000, 16000, 128000, 512000, 2000000), 'instances': 4096, 'materials': 512}
+}
+
+# The bmesh stand-in builds python objects for every vertex and loop, past this it takes longer than the rest combined
+_BMeshMaxVerts = 128000
+
+# Timings under this many seconds are too noisy to flag as a regression
+_NoiseSeconds = 0.002
+
+
+def _config(material_opt=ExportOptions.MaterialNoExport):
+    return {
+        ExportOptions.MeshKey: ExportOptions.MeshAll,
+        ExportOptions.WeldToleranceKey: ExportOptions.WeldToleranceDefault,
+        ExportOptions.OptimizeKey: ExportOptions.OptimizeNone,
+        ExportOptions.IndexFormatKey: ExportOptions.IndexSplit16,
+        ExportOptions.PositionFormatKey: ExportOptions.PositionFloat,
+        ExportOptions.NormalFormatKey: ExportOptions.NormalFloat,
+        ExportOptions.UVFormatKey: ExportOptions.UVFloat,
+        ExportOptions.LayoutKey: ExportOptions.LayoutSeparate,
+        ExportOptions.CacheDirKey: None,
+        ExportOptions.CacheSizeKey: ExportOptions.CacheSizeDefault,
+        ExportOptions.EncodeProcessesKey: 1,
+        ExportOptions.MaterialKey: material_opt,
+        ExportOptions.RampEncodingKey: ExportOptions.RampAdaptive,
+        ExportOptions.RampToleranceKey: ExportOptions.RampToleranceDefault,
+        ExportOptions.TextureFormatKey: ExportOptions.TextureNoExport,
+        ExportOptions.TextureMaxSizeKey: ExportOptions.TextureMaxSizeDefault,
+        ExportOptions.AtlasKey: ExportOptions.AtlasOff,
+        ExportOptions.AtlasTextureSizeKey: ExportOptions.AtlasTextureSizeDefault,
+        ExportOptions.AtlasSizeKey: ExportOptions.AtlasSizeDefault,
+        ExportOptions.AtlasPaddingKey: ExportOptions.AtlasPaddingDefault,
+        ExportOptions.AnimationKey: ExportOptions.AnimationNoExport,
+        ExportOptions.EmitMetadataKey: False,
+        ExportOptions.SelectedOnlyKey: False,
+        ExportOptions.StreamExportKey: False
+    }
+
+
+# -- Synthetic scenes --
+
+def _mesh_cases(verts):
+    """
+    :return: list of (case name, stand-in mesh) of a seamed grid and a UV sphere of about the vertex count given
+    """
+    size = max(int(round(np.sqrt(verts))), 2)
+    rings = max(int(round(np.sqrt(verts / 2.0))), 2)
+    return [('grid_%d' % verts, StandIn.make_grid(size, seams=max(size // 16, 1), name='Grid')),
+            ('sphere_%d' % verts, StandIn.make_sphere(rings * 2, rings, name='Sphere'))]
+
+
+def _instanced_scene(count):
+    """
+    :return: Stand-in context with count objects, instancing 8 grids and spheres
+    """
+    meshes = [StandIn.make_grid(64, seams=4, name='Grid.%03d' % i) if i % 2 == 0 else
+              StandIn.make_sphere(64, 32, name='Sphere.%03d' % i) for i in range(8)]
+    objs = []
+    for i in range(count):
+        obj = StandIn.make_object(meshes[i % len(meshes)], name='Instance.%05d' % i)
+        obj.matrix_world = [[1.0, 0.0, 0.0, float(i % 64)], [0.0, 1.0, 0.0, float(i // 64)], [0.0, 0.0, 1.0, 0.0],
+                            [0.0, 0.0, 0.0, 1.0]]
+        objs.append(obj)
+    return StandIn.make_context(objs)
+
+
+def _material_scene(count):
+    """
+    :return: Stand-in context with count small meshes, each with its own material. Every other material has a color
+             ramp, alternating RGB and HSV ramps
+    """
+    objs = []
+    for i in range(count):
+        mesh = StandIn.make_grid(8, name='Mesh.%05d' % i)
+        ramp_elements = 8 if i % 2 == 0 else 0
+        mesh.materials.append(StandIn.make_material('Material.%05d' % i, ramp_elements,
+                                                    'HSV' if i % 4 == 0 else 'RGB'))
+        objs.append(StandIn.make_object(mesh))
+    return StandIn.make_context(objs)
+
+
+def _export_and_save(context, config, filepath):
+    """
+    :return: list of (function name, callable) timing export_model and save_model of the scene
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        encoded_data = ModelExporter.export_model(context, config)
+    return [('export_model', lambda: ModelExporter.export_model(context, config)),
+            ('save_model', lambda: ModelCompressor.save_model(encoded_data, filepath, workers=1))]
+
+
+def _cases(profile, directory):
+    """
+    Builds the scenes of the profile lazily, so only one scene is in memory at a time
+
+    :return: Generator of (case name, vertex count, list of (function name, callable))
+    """
+    filepath = os.path.join(directory, 'scene.model')
+    for verts in _profiles[profile]['verts']:
+        for case, mesh in _mesh_cases(verts):
+            obj = StandIn.make_object(mesh)
+            functions = []
+            if len(mesh.vertices) <= _BMeshMaxVerts:
+                bmesh_obj = MeshExporter._prepare_mesh_for_export(mesh)
+                uv_layer = bmesh_obj.loops.layers.uv.active
+                functions.append(('_convert_bmesh',
+                                  lambda bm=bmesh_obj, layer=uv_layer: MeshExporter._convert_bmesh(bm, True, True,
+                                                                                                   layer)))
+            functions.append(('encode_mesh_data',
+                              lambda obj=obj: MeshExporter.encode_mesh_data(obj, ExportOptions.MeshAll)))
+            functions += _export_and_save(StandIn.make_context([obj]), _config(), filepath)
+            yield case, len(mesh.vertices), functions
+
+    count = _profiles[profile]['instances']
+    context = _instanced_scene(count)
+    yield 'instances_%d' % count, 8 * 64 * 64, _export_and_save(context, _config(), filepath)
+
+    count = _profiles[profile]['materials']
+    context = _material_scene(count)
+    objs = list(context.scene.objects)
+    functions = [('encode_material_data',
+                  lambda: [MaterialExporter.encode_material_data(obj, context, ExportOptions.MaterialAll)
+                           for obj in objs])]
+    functions += _export_and_save(context, _config(ExportOptions.MaterialAll), filepath)
+    yield 'materials_%d' % count, count * 64, functions
+
+
+# -- Measuring --
+
+def _measure(fn, repeats, memory):
+    """
+    :return: tuple of (best seconds of the repeats, peak bytes allocated by one call or None)
+    """
+    best = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            gc.collect()
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        peak = None
+        if memory:
+            gc.collect()
+            tracemalloc.start()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return best, peak
+
+
+def _git(*args):
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return subprocess.check_output(('git',) + args, cwd=repo, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(profile, repeats, memory):
+    """
+    :return: The results document, see ResultsVersion
+    """
+    commit = _git('rev-parse', 'HEAD')
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    results = []
+    print('%s profile, best of %d, commit %s%s' % (profile, repeats, commit and commit[:10],
+                                                  ' (modified)' if status else ''))
+    with tempfile.TemporaryDirectory() as directory:
+        for case, verts, functions in _cases(profile, directory):
+            for function, fn in functions:
+                seconds, peak = _measure(fn, repeats, memory)
+                results.append({'case': case, 'function': function, 'verts': verts, 'seconds': seconds,
+                                'peak_bytes': peak})
+                print('  %-16s %-20s %9.4fs  %s' % (case, function, seconds,
+                                                     'peak %8.1f MB' % (peak / 1048576.0) if memory else ''))
+            del functions
+    return {'version': ResultsVersion, 'commit': commit, 'modified': bool(status), 'profile': profile,
+            'repeats': repeats, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'results': results}
+
+
+def compare(document, baseline, threshold):
+    """
+    Prints every stage measured in both documents, flagging the ones slower, or allocating more, than threshold times
+    the baseline.
+
+    :return: True if nothing regressed
+    """
+    before = dict(((result['case'], result['function']), result) for result in baseline['results'])
+    print('compared with commit %s (%s profile):' % (baseline['commit'] and baseline['commit'][:10],
+                                                     baseline['profile']))
+    ok = True
+    for result in document['results']:
+        old = before.get((result['case'], result['function']))
+        if old is None:
+            continue
+        time_ratio = result['seconds'] / max(old['seconds'], 1e-9)
+        slower = time_ratio > threshold and result['seconds'] - old['seconds'] > _NoiseSeconds
+        line = '  %-16s %-20s time %5.2fx' % (result['case'], result['function'], time_ratio)
+        bigger = False
+        if result['peak_bytes'] is not None and old['peak_bytes'] is not None:
+            memory_ratio = result['peak_bytes'] / float(max(old['peak_bytes'], 1))
+            bigger = memory_ratio > threshold
+            line += '  memory %5.2fx' % memory_ratio
+        if slower or bigger:
+            line += '  REGRESSED'
+        ok = ok and not (slower or bigger)
+        print(line)
+    print('no regressions over %.2fx: %s' % (threshold, ok))
+    return ok
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks the export stages on synthetic scenes')
+    parser.add_argument('--profile', choices=sorted(_profiles), default='quick')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs of each stage, the best is kept')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="Don't measure the peak memory")
+    parser.add_argument('--output', help='Where to write the JSON results, defaults to benchmark-<commit>.json')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Slowdown or memory growth that regresses')
+    args = parser.parse_args(argv)
+
+    document = run(args.profile, args.repeats, args.memory)
+    output = args.output or 'benchmark-%s.json' % ((document['commit'] or 'unknown')[:10])
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+    print('results written to %s' % output)
+
+    if args.compare is None:
+        return True
+    with open(args.compare, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('version') != ResultsVersion:
+        raise RuntimeError('%s has results version %s, not %d' % (args.compare, baseline.get('version'),
+                                                                  ResultsVersion))
+    return compare(document, baseline, args.threshold)
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(sys.argv[1:]) else 1)
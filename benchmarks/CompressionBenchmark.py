@@ -0,0 +1,84 @@
+"""
+Measures the wall time of compressing the members of a synthetic multi-mesh scene into a .model archive against the
+number of compression threads. Also checks every thread count writes the same members in the same order.
+
+Usage: python benchmarks/CompressionBenchmark.py [meshes] [grid size] [max threads]
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import StandIn
+
+ExportOptions = StandIn.import_addon_module('ExportOptions')
+MeshExporter = StandIn.import_addon_module('MeshExporter')
+ModelArchive = StandIn.import_addon_module('ModelArchive')
+
+
+def _scene_members(mesh_count, size):
+    """
+    :return: list of (member name, bytes) of the mesh buffers of a scene of grids and spheres
+    """
+    members = []
+    for i in range(mesh_count):
+        if i % 2 == 0:
+            mesh = StandIn.make_grid(size + i, seams=4, name='Grid.%03d' % i)
+        else:
+            mesh = StandIn.make_sphere(size + i, (size + i) // 2, name='Sphere.%03d' % i)
+        with contextlib.redirect_stdout(io.StringIO()):
+            encoded = MeshExporter.encode_mesh_data(StandIn.make_object(mesh), ExportOptions.MeshAll)
+        for key, ext in ((MeshExporter.EncodedVertsKey, 'vert'), (MeshExporter.EncodedNormalsKey, 'norm'),
+                         (MeshExporter.EncodedUVsKey, 'uv'), (MeshExporter.EncodedIndicesKey, 'ind')):
+            members.append(('%s.%s.bin' % (mesh.name, ext), encoded[key]))
+    return members
+
+
+def _write(members, filepath, workers):
+    start = time.perf_counter()
+    with ModelArchive.ArchiveWriter(filepath, workers=workers) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return time.perf_counter() - start
+
+
+def _contents(filepath):
+    with zipfile.ZipFile(filepath) as z:
+        return [(info.filename, z.read(info)) for info in z.infolist()]
+
+
+def main(mesh_count, size, max_workers):
+    members = _scene_members(mesh_count, size)
+    total = sum(len(data) for _, data in members)
+    print('%d meshes, %d members, %.1f MB uncompressed, %d cores' % (mesh_count, len(members), total / 1048576.0,
+                                                                    os.cpu_count() or 1))
+
+    worker_counts = []
+    workers = 1
+    while workers <= max_workers:
+        worker_counts.append(workers)
+        workers *= 2
+
+    with tempfile.TemporaryDirectory() as directory:
+        reference = None
+        baseline = None
+        same = True
+        for workers in worker_counts:
+            filepath = os.path.join(directory, '%d.model' % workers)
+            elapsed = _write(members, filepath, workers)
+            baseline = baseline or elapsed
+            contents = _contents(filepath)
+            reference = reference or contents
+            same = same and contents == reference
+            print('  %3d threads %8.3fs  speedup %5.2fx  %.1f MB' % (workers, elapsed, baseline / elapsed,
+                                                                       os.path.getsize(filepath) / 1048576.0))
+        print('  same members in the same order: %s' % same)
+    return same
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(int(sys.argv[1]) if len(sys.argv) > 1 else 16, int(sys.argv[2]) if len(sys.argv) > 2 else 120,
+                       int(sys.argv[3]) if len(sys.argv) > 3 else (os.cpu_count() or 1) * 2) else 1)
@@ -0,0 +1,96 @@
+"""
+Measures the compressed size and the decode time (decompress + undo the filter) of the buffers of a synthetic mesh, for
+each buffer filter. Noise is added to the positions so the floats aren't as regular as the stand-in's.
+Also checks every filter round trips.
+
+Usage: python benchmarks/FilterBenchmark.py [sphere segments] [noise]
+"""
+import contextlib
+import io
+import lzma
+import sys
+import time
+import zlib
+
+import numpy as np
+
+import StandIn
+
+ExportOptions = StandIn.import_addon_module('ExportOptions')
+MeshExporter = StandIn.import_addon_module('MeshExporter')
+VertexFormats = StandIn.import_addon_module('VertexFormats')
+BufferFilters = StandIn.import_addon_module('BufferFilters')
+
+_compressors = (
+    ('lzma', lambda data: lzma.compress(data), lzma.decompress),
+    ('deflate', lambda data: zlib.compress(data, 6), zlib.decompress)
+)
+
+
+def _buffers(segments, noise, position_format, uv_format):
+    """
+    :return: list of (name, bytes, attribute descriptor or index format) of the buffers of a noisy sphere
+    """
+    mesh = StandIn.make_sphere(segments, segments // 2, name='Sphere')
+    if noise > 0.0:
+        positions = mesh.vertices._props['co']
+        positions += np.random.RandomState(0).normal(0.0, noise, positions.shape).astype(positions.dtype)
+    with contextlib.redirect_stdout(io.StringIO()):
+        encoded = MeshExporter.encode_mesh_data(StandIn.make_object(mesh), ExportOptions.MeshAll,
+                                                optimize_opt=ExportOptions.OptimizeVertexCache,
+                                                index_opt=ExportOptions.IndexAuto, position_format=position_format,
+                                                uv_format=uv_format)
+    formats = encoded[MeshExporter.EncodedVertexFormatsKey]
+    return [('%s verts' % position_format, encoded[MeshExporter.EncodedVertsKey],
+             formats[MeshExporter.EncodedVertsKey]),
+            ('normals', encoded[MeshExporter.EncodedNormalsKey], formats[MeshExporter.EncodedNormalsKey]),
+            ('%s uvs' % uv_format, encoded[MeshExporter.EncodedUVsKey], formats[MeshExporter.EncodedUVsKey]),
+            ('%s indices' % encoded[MeshExporter.EncodedIndexFormatKey], encoded[MeshExporter.EncodedIndicesKey],
+             encoded[MeshExporter.EncodedIndexFormatKey])]
+
+
+def _filters(descriptor):
+    if not isinstance(descriptor, dict):
+        return [('none', None), ('shuffle', BufferFilters.shuffle_filter(int(descriptor[1:]) // 8)),
+                ('delta', BufferFilters.delta_filter(descriptor)),
+                ('delta_zigzag', BufferFilters.delta_filter(descriptor, zigzag=True))]
+
+    size = VertexFormats.component_dtype(descriptor).itemsize
+    components = descriptor[VertexFormats.ComponentsKey]
+    int_type = 'u%d' % (size * 8)
+    return [('none', None), ('shuffle', BufferFilters.shuffle_filter(size)),
+            ('delta', BufferFilters.delta_filter(int_type, components)),
+            ('delta_zigzag', BufferFilters.delta_filter(int_type, components, True))]
+
+
+def main(segments, noise):
+    ok = True
+    for position_format, uv_format in ((ExportOptions.PositionFloat, ExportOptions.UVFloat),
+                                       (ExportOptions.PositionUnorm16, ExportOptions.UVUnorm16)):
+        for name, data, descriptor in _buffers(segments, noise, position_format, uv_format):
+            print('%s (%d bytes)' % (name, len(data)))
+            filters = _filters(descriptor)
+            picked = BufferFilters.pick_filter(data, [buffer_filter for _, buffer_filter in filters])
+            for filter_name, buffer_filter in filters:
+                start = time.perf_counter()
+                filtered = BufferFilters.apply_filter(data, buffer_filter)
+                filter_time = time.perf_counter() - start
+                ok = ok and BufferFilters.undo_filter(filtered, buffer_filter) == data
+
+                line = '  %-13s filter %.4fs' % (filter_name + ('*' if buffer_filter == picked else ''), filter_time)
+                for compressor_name, compress, decompress in _compressors:
+                    compressed = compress(filtered)
+                    start = time.perf_counter()
+                    BufferFilters.undo_filter(decompress(compressed), buffer_filter)
+                    line += '  %s %8d (%5.1f%%) decode %.4fs' % (compressor_name, len(compressed),
+                                                                100.0 * len(compressed) / max(len(data), 1),
+                                                                time.perf_counter() - start)
+                print(line)
+    print('* picked by the Auto filter mode')
+    print('every filter round trips: %s' % ok)
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(int(sys.argv[1]) if len(sys.argv) > 1 else 256,
+                       float(sys.argv[2]) if len(sys.argv) > 2 else 1e-3) else 1)
@@ -0,0 +1,109 @@
+"""
+Measures the peak memory allocated while exporting and saving a synthetic scene of same-sized meshes, with and without
+the streaming export, for a growing number of meshes. The blender (stand-in) data is created before measuring, so only
+the memory the export itself allocates is counted.
+
+The streaming export peak should stay at the peak of exporting one mesh (its encoding temporaries, buffers and
+compression) whatever the number of meshes, while the peak of the buffered export grows with every mesh's buffers.
+
+Usage: python benchmarks/MemoryBenchmark.py [grid size] [max meshes]
+"""
+import contextlib
+import gc
+import io
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import StandIn
+
+ExportOptions = StandIn.import_addon_module('ExportOptions')
+MeshExporter = StandIn.import_addon_module('MeshExporter')
+ModelExporter = StandIn.import_addon_module('ModelExporter')
+ModelCompressor = StandIn.import_addon_module('ModelCompressor')
+
+# Streaming peak allowed, in multiples of the peak of exporting the scene with a single mesh
+_StreamingBound = 1.25
+
+
+def _config(stream):
+    return {
+        ExportOptions.MeshKey: ExportOptions.MeshAll,
+        ExportOptions.WeldToleranceKey: ExportOptions.WeldToleranceDefault,
+        ExportOptions.OptimizeKey: ExportOptions.OptimizeNone,
+        ExportOptions.IndexFormatKey: ExportOptions.IndexSplit16,
+        ExportOptions.PositionFormatKey: ExportOptions.PositionFloat,
+        ExportOptions.NormalFormatKey: ExportOptions.NormalFloat,
+        ExportOptions.UVFormatKey: ExportOptions.UVFloat,
+        ExportOptions.LayoutKey: ExportOptions.LayoutSeparate,
+        ExportOptions.CacheDirKey: None,
+        ExportOptions.CacheSizeKey: ExportOptions.CacheSizeDefault,
+        ExportOptions.EncodeProcessesKey: 1,
+        ExportOptions.MaterialKey: ExportOptions.MaterialNoExport,
+        ExportOptions.RampEncodingKey: ExportOptions.RampAdaptive,
+        ExportOptions.RampToleranceKey: ExportOptions.RampToleranceDefault,
+        ExportOptions.TextureFormatKey: ExportOptions.TextureNoExport,
+        ExportOptions.TextureMaxSizeKey: ExportOptions.TextureMaxSizeDefault,
+        ExportOptions.AtlasKey: ExportOptions.AtlasOff,
+        ExportOptions.AtlasTextureSizeKey: ExportOptions.AtlasTextureSizeDefault,
+        ExportOptions.AtlasSizeKey: ExportOptions.AtlasSizeDefault,
+        ExportOptions.AtlasPaddingKey: ExportOptions.AtlasPaddingDefault,
+        ExportOptions.AnimationKey: ExportOptions.AnimationNoExport,
+        ExportOptions.EmitMetadataKey: False,
+        ExportOptions.SelectedOnlyKey: False,
+        ExportOptions.StreamExportKey: stream
+    }
+
+
+def _encoded_length(mesh):
+    with contextlib.redirect_stdout(io.StringIO()):
+        encoded = MeshExporter.encode_mesh_data(StandIn.make_object(mesh), ExportOptions.MeshAll)
+    return sum(len(encoded[key]) for key in (MeshExporter.EncodedVertsKey, MeshExporter.EncodedNormalsKey,
+                                             MeshExporter.EncodedUVsKey, MeshExporter.EncodedIndicesKey))
+
+
+def _peak_export(context, filepath, stream):
+    """
+    :return: Peak bytes allocated by export_model and save_model
+    """
+    gc.collect()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        encoded_data = ModelExporter.export_model(context, _config(stream))
+        ModelCompressor.save_model(encoded_data, filepath, workers=1, compression=ExportOptions.CompressionFastLoad)
+    del encoded_data
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main(size, max_meshes):
+    mesh_length = _encoded_length(StandIn.make_grid(size, seams=4))
+    print('grid %dx%d, %.1f MB of buffers per mesh' % (size, size, mesh_length / 1048576.0))
+
+    ok = True
+    single_peak = None
+    mesh_count = 1
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'scene.model')
+        while mesh_count <= max_meshes:
+            objs = [StandIn.make_object(StandIn.make_grid(size, seams=4, name='Grid.%03d' % i))
+                    for i in range(mesh_count)]
+            context = StandIn.make_context(objs)
+            buffered = _peak_export(context, filepath, False)
+            streamed = _peak_export(context, filepath, True)
+            single_peak = single_peak or streamed
+            ok = ok and streamed <= _StreamingBound * single_peak
+            print('  %3d meshes  buffered peak %8.1f MB (%5.1fx mesh)  streaming peak %8.1f MB (%5.1fx mesh)' % (
+                mesh_count, buffered / 1048576.0, buffered / float(mesh_length), streamed / 1048576.0,
+                streamed / float(mesh_length)))
+            mesh_count *= 2
+
+    print('  streaming peak within %.2fx of exporting a single mesh: %s' % (_StreamingBound, ok))
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+                       int(sys.argv[2]) if len(sys.argv) > 2 else 16) else 1)
@@ -0,0 +1,74 @@
+"""
+Compares the bulk array mesh extraction against the bmesh fallback on stand-in meshes, for speed and output.
+
+Usage: python benchmarks/MeshExtraction.py [grid size] [seams]
+"""
+import sys
+import time
+
+import numpy as np
+
+import StandIn
+
+ExportOptions = StandIn.import_addon_module('ExportOptions')
+MeshExporter = StandIn.import_addon_module('MeshExporter')
+
+
+def _convert_mesh(mesh, export_verts, export_norms, export_uvs, weld_tolerance):
+    """
+    Converts the mesh to indexed buffers with the bulk array reads the exporter uses
+    """
+    arrays = MeshExporter._extract_mesh_arrays(mesh, export_norms, export_uvs)
+    return MeshExporter._build_indexed_buffers(*arrays, export_verts=export_verts, weld_tolerance=weld_tolerance)
+
+
+def _convert_mesh_with_bmesh(mesh, export_verts, export_norms, export_uvs, weld_tolerance):
+    """
+    Converts the mesh to indexed buffers through the exporter's triangulated bmesh fallback
+    """
+    arrays = MeshExporter._extract_mesh_arrays_with_bmesh(mesh, export_norms, export_uvs)
+    return MeshExporter._build_indexed_buffers(*arrays, export_verts=export_verts, weld_tolerance=weld_tolerance)
+
+
+def _triangle_soup(converted):
+    """
+    De-indexes the converted mesh into sorted (triangles x 3 corners x 8) position/normal/uv rows, so outputs with
+    different vertex orders can be compared.
+    """
+    index_trans, norms, uvs, verts = converted
+    norms = norms if norms is not None else np.zeros((len(verts), 3), dtype=np.float32)
+    uvs = uvs if uvs is not None else np.zeros((len(verts), 2), dtype=np.float32)
+    corners = np.concatenate((verts, norms, uvs), axis=1)[np.asarray(index_trans, dtype=np.int64)]
+    tris = corners.reshape(-1, 24)
+    return tris[np.lexsort(tris.T[::-1])]
+
+
+def _time(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main(size, seams, tolerance=ExportOptions.WeldToleranceDefault):
+    meshes = (('Grid %dx%d, %d seams' % (size, size, seams), StandIn.make_grid(size, seams)),
+              ('Smooth sphere', StandIn.make_sphere(size, size // 2)),
+              ('Flat sphere', StandIn.make_sphere(size, size // 2, smooth=False)))
+
+    for title, mesh in meshes:
+        print('%s: %d verts, %d loops' % (title, len(mesh.vertices), len(mesh.loops)))
+
+        for export_opt in (ExportOptions.MeshVertsAndNormals, ExportOptions.MeshAll):
+            args = (mesh, MeshExporter._export_verts_lu[export_opt], MeshExporter._export_norms_lu[export_opt],
+                    MeshExporter._export_uvs_lu[export_opt], tolerance)
+            bulk, bulk_time = _time(_convert_mesh, *args)
+            fallback, fallback_time = _time(_convert_mesh_with_bmesh, *args)
+            same = bulk[0].size == fallback[0].size and np.allclose(_triangle_soup(bulk), _triangle_soup(fallback))
+
+            print('  %-16s bulk %8.4fs (%d verts, %d indices)  bmesh %8.4fs (%d verts, %d indices)  '
+                  'speedup %6.1fx  same output: %s' % (export_opt, bulk_time, len(bulk[3]), len(bulk[0]),
+                                                       fallback_time, len(fallback[3]), len(fallback[0]),
+                                                       fallback_time / bulk_time, same))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[2]) if len(sys.argv) > 2 else 4)
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark of the vectorized buffer encoding against the struct.pack_into reference loop. Also checks that both
+produce byte-identical buffers.
+
+Usage: python benchmarks/PackBenchmark.py [grid size]
+"""
+import struct
+import sys
+import time
+
+import StandIn
+
+ExportOptions = StandIn.import_addon_module('ExportOptions')
+MeshExporter = StandIn.import_addon_module('MeshExporter')
+
+
+def _encode_buffers_reference(index_trans, norms, uvs, verts, export_verts, export_norms, export_uvs):
+    """
+    Encodes the converted mesh arrays one element at a time with struct, the way the exporter used to. This is the
+    reference MeshExporter._encode_buffers has to match byte for byte
+
+    :return: tuple of (enc_vert, enc_norm, enc_uv, enc_ind), with None for the data that isn't exported
+    """
+    enc_vert = bytearray(len(verts) * 12) if export_verts else None
+    enc_norm = bytearray(len(norms) * 12) if export_norms else None
+    enc_uv = bytearray(len(uvs) * 8) if export_uvs else None
+    enc_ind = bytearray(len(index_trans) * 4)
+
+    verts, index_trans = verts.tolist(), index_trans.tolist()
+    norms = norms.tolist() if export_norms else None
+    uvs = uvs.tolist() if export_uvs else None
+
+    for i in range(len(verts)):
+        if export_verts:
+            struct.pack_into("<fff", enc_vert, i * 12, verts[i][0], verts[i][1], verts[i][2])
+        if export_norms:
+            struct.pack_into("<fff", enc_norm, i * 12, norms[i][0], norms[i][1], norms[i][2])
+        if export_uvs:
+            struct.pack_into("<ff", enc_uv, i * 8, uvs[i][0], uvs[i][1])
+
+    for i in range(len(index_trans)):
+        struct.pack_into("<I", enc_ind, i * 4, index_trans[i])
+
+    return enc_vert, enc_norm, enc_uv, enc_ind
+
+
+def _best_of(repeats, fn, *args):
+    best, result = None, None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(size):
+    mesh = StandIn.make_grid(size, seams=4)
+    arrays = MeshExporter._extract_mesh_arrays(mesh, True, True)
+    converted = MeshExporter._build_indexed_buffers(*arrays, export_verts=True,
+                                                    weld_tolerance=ExportOptions.WeldToleranceDefault)
+    args = converted + (True, True, True)
+    print('Grid %dx%d: %d verts, %d indices' % (size, size, len(converted[3]), len(converted[0])))
+
+    reference, reference_time = _best_of(1, _encode_buffers_reference, *args)
+    vectorized, vectorized_time = _best_of(5, MeshExporter._encode_buffers, *args)
+
+    vectorized = tuple(vectorized[key] for key in (MeshExporter.EncodedVertsKey, MeshExporter.EncodedNormalsKey,
+                                                   MeshExporter.EncodedUVsKey, MeshExporter.EncodedIndicesKey))
+    identical = all(bytes(ref) == vec for ref, vec in zip(reference, vectorized))
+    print('  struct.pack_into loop %9.4fs' % reference_time)
+    print('  vectorized            %9.4fs  (%.0fx faster)' % (vectorized_time, reference_time / vectorized_time))
+    print('  byte identical: %s' % identical)
+    return identical
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(int(sys.argv[1]) if len(sys.argv) > 1 else 500) else 1)
@@ -0,0 +1,172 @@
+"""
+Exports a synthetic scene of instanced grids and spheres with every archive layout, buffer filter, vertex layout and
+vertex format, reads each archive back with ModelReader, and checks every buffer, transform and manifest link matches
+what was encoded. Also times reading every buffer back, cold and from the reader's cache.
+
+Usage: python benchmarks/RoundTripCheck.py [grid size]
+"""
+import contextlib
+import io
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import StandIn
+
+ExportOptions = StandIn.import_addon_module('ExportOptions')
+MeshExporter = StandIn.import_addon_module('MeshExporter')
+ModelExporter = StandIn.import_addon_module('ModelExporter')
+ModelCompressor = StandIn.import_addon_module('ModelCompressor')
+ModelReader = StandIn.import_addon_module('ModelReader')
+
+_buffers = (
+    ('verts', MeshExporter.EncodedVertsKey),
+    ('normals', MeshExporter.EncodedNormalsKey),
+    ('uvs', MeshExporter.EncodedUVsKey)
+)
+
+
+def _scene(size):
+    objs = []
+    for i in range(3):
+        mesh = StandIn.make_grid(size + i, seams=2, name='Grid.%03d' % i)
+        objs.append(StandIn.make_object(mesh))
+    sphere = StandIn.make_sphere(size, size // 2, name='Sphere')
+    for i in range(3):
+        obj = StandIn.make_object(sphere, name='Sphere.%03d' % i)
+        obj.matrix_world = [[1.0, 0.0, 0.0, float(i)], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0],
+                            [0.0, 0.0, 0.0, 1.0]]
+        objs.append(obj)
+    # Objects are free to have the name of a manifest section
+    section_grid = StandIn.make_grid(size, name='G')
+    for name in ('mesh', 'material', 'texture'):
+        objs.append(StandIn.make_object(section_grid, name=name))
+    return StandIn.make_context(objs)
+
+
+def _config(vertex_layout, position_format):
+    return {
+        ExportOptions.MeshKey: ExportOptions.MeshAll,
+        ExportOptions.WeldToleranceKey: ExportOptions.WeldToleranceDefault,
+        ExportOptions.OptimizeKey: ExportOptions.OptimizeVertexCache,
+        ExportOptions.IndexFormatKey: ExportOptions.IndexAuto,
+        ExportOptions.PositionFormatKey: position_format,
+        ExportOptions.NormalFormatKey: (ExportOptions.NormalFloat if position_format == ExportOptions.PositionFloat
+                                        else ExportOptions.NormalOct16),
+        ExportOptions.UVFormatKey: (ExportOptions.UVFloat if position_format == ExportOptions.PositionFloat
+                                    else ExportOptions.UVUnorm16),
+        ExportOptions.LayoutKey: vertex_layout,
+        ExportOptions.CacheDirKey: None,
+        ExportOptions.CacheSizeKey: ExportOptions.CacheSizeDefault,
+        ExportOptions.EncodeProcessesKey: 1,
+        ExportOptions.MaterialKey: ExportOptions.MaterialNoExport,
+        ExportOptions.RampEncodingKey: ExportOptions.RampAdaptive,
+        ExportOptions.RampToleranceKey: ExportOptions.RampToleranceDefault,
+        ExportOptions.TextureFormatKey: ExportOptions.TextureNoExport,
+        ExportOptions.TextureMaxSizeKey: ExportOptions.TextureMaxSizeDefault,
+        ExportOptions.AtlasKey: ExportOptions.AtlasOff,
+        ExportOptions.AtlasTextureSizeKey: ExportOptions.AtlasTextureSizeDefault,
+        ExportOptions.AtlasSizeKey: ExportOptions.AtlasSizeDefault,
+        ExportOptions.AtlasPaddingKey: ExportOptions.AtlasPaddingDefault,
+        ExportOptions.AnimationKey: ExportOptions.AnimationNoExport,
+        ExportOptions.EmitMetadataKey: False,
+        ExportOptions.SelectedOnlyKey: False,
+        ExportOptions.StreamExportKey: False
+    }
+
+
+def _check(reader, context, encoded_data):
+    """
+    :return: list of what didn't match
+    """
+    errors = ['member %s' % name for name in reader.verify()]
+    for mesh_name, mesh_data in encoded_data[ModelExporter.MeshDataKey].items():
+        for attribute, key in _buffers:
+            array = reader.attribute(mesh_name, attribute)
+            expected = mesh_data[key]
+            if (array is None) != (expected is None) or (array is not None and array.tobytes() != expected):
+                errors.append('%s %s' % (mesh_name, attribute))
+
+        if reader.indices(mesh_name).tobytes() != mesh_data[MeshExporter.EncodedIndicesKey]:
+            errors.append('%s indices' % mesh_name)
+
+        interleaved = reader.interleaved(mesh_name)
+        expected = mesh_data[MeshExporter.EncodedInterleavedKey]
+        if (interleaved is None) != (expected is None) or (interleaved is not None and
+                                                           interleaved.tobytes() != expected):
+            errors.append('%s interleaved' % mesh_name)
+
+        objects, matrices = reader.instances(mesh_name)
+        for obj_name, matrix in zip(objects, matrices):
+            obj = [obj for obj in context.scene.objects if obj.name == obj_name][0]
+            if not np.allclose(matrix.T, np.array(obj.matrix_world, dtype=np.float32)):
+                errors.append('%s transform' % obj_name)
+
+    if reader.meshes() != sorted(encoded_data[ModelExporter.MeshDataKey]):
+        errors.append('meshes')
+    if reader.materials() != list(encoded_data[ModelExporter.MaterialDataKey] or []):
+        errors.append('materials')
+    if reader.textures() != list(encoded_data[ModelExporter.TextureDataKey] or []):
+        errors.append('textures')
+    for obj in context.scene.objects:
+        if reader.object_manifest(obj.name)['mesh'] != encoded_data[ModelExporter.ObjectMeshesKey][obj.name]:
+            errors.append('%s mesh link' % obj.name)
+        if reader.transform(obj.name) != ModelExporter.encode_transform_data(obj):
+            errors.append('%s local transform' % obj.name)
+    return errors
+
+
+def _read_all(reader):
+    for mesh_name in reader.meshes():
+        for attribute, _ in _buffers:
+            reader.attribute(mesh_name, attribute)
+        reader.indices(mesh_name)
+        reader.interleaved(mesh_name)
+        reader.instances(mesh_name)
+
+
+def main(size):
+    context = _scene(size)
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'scene.model')
+        for archive_layout, buffer_filter, vertex_layout, position_format in itertools.product(
+                (ExportOptions.ArchiveMembers, ExportOptions.ArchivePacked, ExportOptions.ArchivePackedCompressed),
+                (ExportOptions.BufferFilterNone, ExportOptions.BufferFilterAuto),
+                (ExportOptions.LayoutSeparate, ExportOptions.LayoutInterleavedPositions),
+                (ExportOptions.PositionFloat, ExportOptions.PositionUnorm16)):
+            if archive_layout != ExportOptions.ArchiveMembers and buffer_filter != ExportOptions.BufferFilterNone:
+                continue  # Packed buffers aren't filtered
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                encoded_data = ModelExporter.export_model(context, _config(vertex_layout, position_format))
+                ModelCompressor.save_model(encoded_data, filepath, workers=1, buffer_filter=buffer_filter,
+                                           layout=archive_layout)
+
+            with ModelReader.ModelReader(filepath) as reader:
+                try:
+                    errors = _check(reader, context, encoded_data)
+                except RuntimeError as e:
+                    errors = [str(e)]
+            with ModelReader.ModelReader(filepath) as reader:
+                start = time.perf_counter()
+                _read_all(reader)
+                cold = time.perf_counter() - start
+                start = time.perf_counter()
+                _read_all(reader)
+                warm = time.perf_counter() - start
+
+            ok = ok and not errors
+            print('  %-17s %-8s %-21s %-7s read %.4fs, cached %.4fs  %s' % (
+                archive_layout, buffer_filter, vertex_layout, position_format, cold, warm,
+                'ok' if not errors else 'MISMATCH: %s' % ', '.join(errors)))
+    print('every archive round trips: %s' % ok)
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(int(sys.argv[1]) if len(sys.argv) > 1 else 64) else 1)
@@ -0,0 +1,484 @@
+"""
+Stand-ins for the blender data the exporter reads, so the export code can be run and timed without blender.
+
+Only the parts of the bpy/bmesh api used by the exporter are implemented.
+"""
+import atexit
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import types
+import zlib
+
+import numpy as np
+
+AddonPackageName = 'turn_tactics_tools'
+
+
+class _Vector(object):
+    """
+    Minimal mathutils.Vector, only supports the component attributes and indexing
+    """
+    __slots__ = ('_co',)
+
+    def __init__(self, co):
+        self._co = tuple(float(c) for c in co)
+
+    x = property(lambda self: self._co[0])
+    y = property(lambda self: self._co[1])
+    z = property(lambda self: self._co[2])
+
+    def __getitem__(self, item):
+        return self._co[item]
+
+    def __len__(self):
+        return len(self._co)
+
+
+class _PropCollection(object):
+    """
+    A bpy_prop_collection that only supports len() and foreach_get of the properties it was created with
+    """
+
+    def __init__(self, length, **props):
+        self._length = length
+        self._props = props
+
+    def __len__(self):
+        return self._length
+
+    def foreach_get(self, attr, seq):
+        np.copyto(seq, self._props[attr].ravel(), casting='unsafe')
+
+
+class _UVLayer(object):
+    def __init__(self, name, loop_uvs):
+        self.name = name
+        self.data = _PropCollection(len(loop_uvs), uv=loop_uvs)
+
+
+class _UVLayers(object):
+    def __init__(self, layers):
+        self._layers = layers
+        self.active = layers[0] if len(layers) > 0 else None
+
+    def __len__(self):
+        return len(self._layers)
+
+
+class StandInMesh(object):
+    """
+    Stand-in for a bpy.types.Mesh built from vertex positions and polygons.
+
+    :param name: Name of the mesh datablock
+    :param positions: (verts x 3) vertex positions
+    :param polygons: list of vertex index sequences one per polygon, or a (polygons x n) array for n-sided polygons
+    :param loop_uvs: (loops x 2) UV of each loop, in polygon order. No UV layer is created if None
+    :param loop_triangles_api: If the mesh should have the loop triangles api (blender 2.80+)
+    :param smooth: If the polygons are smooth shaded. Flat shaded polygons get the polygon normal as split normals
+    """
+
+    def __init__(self, name, positions, polygons, loop_uvs=None, loop_triangles_api=True, smooth=True):
+        self.name = name
+        self.materials = []
+
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        if isinstance(polygons, np.ndarray):
+            loop_totals = np.full(len(polygons), polygons.shape[1], dtype=np.int32)
+            loop_verts = polygons.astype(np.int32).ravel()
+        else:
+            loop_totals = np.array([len(poly) for poly in polygons], dtype=np.int32)
+            loop_verts = np.concatenate([np.asarray(poly, dtype=np.int32) for poly in polygons]) \
+                if len(polygons) > 0 else np.empty(0, dtype=np.int32)
+        loop_starts = np.cumsum(loop_totals, dtype=np.int32) - loop_totals
+
+        self._positions = positions
+        self._loop_verts = loop_verts
+        self._loop_uvs = None if loop_uvs is None else np.asarray(loop_uvs, dtype=np.float32).reshape(-1, 2)
+        self._vert_normals, self._poly_normals = _normals(positions, loop_verts, loop_starts, loop_totals)
+        self._smooth = smooth
+        if smooth:
+            loop_normals = self._vert_normals[loop_verts]
+        else:
+            loop_normals = np.repeat(self._poly_normals, loop_totals, axis=0)
+
+        self.vertices = _PropCollection(len(positions), co=positions, normal=self._vert_normals)
+        self.loops = _PropCollection(len(loop_verts), vertex_index=loop_verts, normal=loop_normals)
+        self.polygons = _PropCollection(len(polygons), loop_start=loop_starts, loop_total=loop_totals,
+                                        use_smooth=np.full(len(polygons), smooth, dtype=bool))
+        self.uv_layers = _UVLayers([] if loop_uvs is None else [_UVLayer('UVMap', self._loop_uvs)])
+
+        # Blender calculates the loop triangles natively, so do the work up front to keep it out of any timings
+        tri_counts = loop_totals - 2
+        firsts = np.repeat(loop_starts, tri_counts)
+        fan = np.arange(firsts.size, dtype=np.int32) - np.repeat(np.cumsum(tri_counts) - tri_counts, tri_counts) + 1
+        self._tri_loops = np.stack((firsts, firsts + fan, firsts + fan + 1), axis=1).astype(np.int32)
+        if loop_triangles_api:
+            self.calc_loop_triangles = self._calc_loop_triangles
+            self.loop_triangles = _PropCollection(0, loops=np.empty(0, dtype=np.int32))
+
+    def _polygon_loops(self):
+        starts, totals = self.polygons._props['loop_start'], self.polygons._props['loop_total']
+        return [range(start, start + total) for start, total in zip(starts.tolist(), totals.tolist())]
+
+    def calc_normals_split(self):
+        pass
+
+    def _calc_loop_triangles(self):
+        self.loop_triangles = _PropCollection(len(self._tri_loops), loops=self._tri_loops)
+
+
+def _normals(positions, loop_verts, loop_starts, loop_totals):
+    """
+    Area weighted vertex normals and the polygon normals, using newell's method for the polygon normals
+    """
+    if len(loop_verts) == 0:
+        return np.zeros_like(positions), np.zeros((0, 3), dtype=np.float32)
+
+    # Newell's method sums over each loop and the next loop around its polygon
+    next_loops = np.arange(1, len(loop_verts) + 1)
+    next_loops[loop_starts + loop_totals - 1] = loop_starts
+    cos = positions[loop_verts].astype(np.float64)
+    nxt = cos[next_loops]
+    terms = np.stack(((cos[:, 1] - nxt[:, 1]) * (cos[:, 2] + nxt[:, 2]),
+                      (cos[:, 2] - nxt[:, 2]) * (cos[:, 0] + nxt[:, 0]),
+                      (cos[:, 0] - nxt[:, 0]) * (cos[:, 1] + nxt[:, 1])), axis=1)
+    face_normals = np.add.reduceat(terms, loop_starts, axis=0)
+
+    normals = np.zeros(positions.shape, dtype=np.float64)
+    np.add.at(normals, loop_verts, np.repeat(face_normals, loop_totals, axis=0))
+    return _normalized(normals), _normalized(face_normals)
+
+
+def _normalized(vectors):
+    lengths = np.linalg.norm(vectors, axis=1)
+    lengths[lengths == 0.0] = 1.0
+    return (vectors / lengths[:, None]).astype(np.float32)
+
+
+# -- bmesh stand-in --
+
+class _BMUVLoop(object):
+    __slots__ = ('uv',)
+
+    def __init__(self, uv):
+        self.uv = uv
+
+
+class _BMVert(object):
+    __slots__ = ('co', 'normal', 'index')
+
+    def __init__(self, co, normal, index):
+        self.co = co
+        self.normal = normal
+        self.index = index
+
+
+class _BMLoop(object):
+    __slots__ = ('vert', '_uv')
+
+    def __init__(self, vert, uv):
+        self.vert = vert
+        self._uv = _BMUVLoop(uv)
+
+    def __getitem__(self, layer):
+        return self._uv
+
+
+class _BMFace(object):
+    __slots__ = ('loops', 'normal', 'smooth')
+
+    def __init__(self, loops, normal, smooth):
+        self.loops = loops
+        self.normal = normal
+        self.smooth = smooth
+
+    @property
+    def verts(self):
+        return [loop.vert for loop in self.loops]
+
+
+class _BMLoopLayers(object):
+    def __init__(self):
+        self.uv = types.SimpleNamespace(active=None)
+
+
+class _BMesh(object):
+    def __init__(self):
+        self.verts = []
+        self.faces = []
+        self.loops = types.SimpleNamespace(layers=_BMLoopLayers())
+
+    def from_mesh(self, mesh):
+        self.verts = [_BMVert(_Vector(co), _Vector(no), i)
+                      for i, (co, no) in enumerate(zip(mesh._positions, mesh._vert_normals))]
+        uvs = mesh._loop_uvs
+        if uvs is not None:
+            self.loops.layers.uv.active = mesh.uv_layers.active
+
+        self.faces = [_BMFace([_BMLoop(self.verts[mesh._loop_verts[i]], _Vector(uvs[i] if uvs is not None else (0, 0)))
+                               for i in loops], _Vector(normal), mesh._smooth)
+                      for loops, normal in zip(mesh._polygon_loops(), mesh._poly_normals)]
+
+    def free(self):
+        self.verts = []
+        self.faces = []
+
+
+def _bm_triangulate(bm, faces):
+    tris = []
+    for face in faces:
+        loops = face.loops
+        tris.extend(_BMFace([loops[0], loops[k], loops[k + 1]], face.normal, face.smooth)
+                    for k in range(1, len(loops) - 1))
+    bm.faces = tris
+    return {'faces': tris}
+
+
+def _make_bmesh_module():
+    module = types.ModuleType('bmesh')
+    module.new = _BMesh
+    module.ops = types.SimpleNamespace(triangulate=_bm_triangulate)
+    return module
+
+
+# -- Synthetic meshes --
+
+def make_grid(size, seams=0, name='Grid', loop_triangles_api=True, smooth=True):
+    """
+    Creates a flat size x size vertex grid of quads, with UVs spanning 0..1.
+
+    :param size: Vertices along each side of the grid
+    :param seams: Number of UV seams to cut across the grid. Each seam splits the vertices along one column
+    :param name: Name of the mesh
+    :param loop_triangles_api: See StandInMesh
+    :param smooth: See StandInMesh
+    :return: StandInMesh
+    """
+    xs, ys = np.meshgrid(np.arange(size, dtype=np.float32), np.arange(size, dtype=np.float32))
+    positions = np.stack((xs.ravel(), ys.ravel(), np.zeros(size * size, dtype=np.float32)), axis=1)
+
+    cells = np.arange(size * size).reshape(size, size)[:-1, :-1].ravel()
+    polygons = np.stack((cells, cells + 1, cells + size + 1, cells + size), axis=1)
+
+    # Offset the UVs of each strip of cells between the seams, so the vertices on the seams get split
+    loop_verts = polygons.ravel()
+    loop_uvs = positions[loop_verts, :2] / float(max(size - 1, 1))
+    if seams > 0:
+        strip = np.repeat(cells % size * (seams + 1) // max(size - 1, 1), 4)
+        loop_uvs[:, 0] += strip * 0.5
+    return StandInMesh(name, positions, polygons, loop_uvs, loop_triangles_api, smooth)
+
+
+def make_sphere(segments, rings, name='Sphere', loop_triangles_api=True, smooth=True):
+    """
+    Creates a UV sphere with a seam where the U coordinate wraps around.
+
+    :param segments: Vertices around each ring
+    :param rings: Number of rings between the poles
+    :param name: Name of the mesh
+    :param loop_triangles_api: See StandInMesh
+    :param smooth: See StandInMesh
+    :return: StandInMesh
+    """
+    theta = np.linspace(0.0, np.pi, rings + 2)[1:-1]
+    phi = np.linspace(0.0, 2.0 * np.pi, segments, endpoint=False)
+    t, p = np.meshgrid(theta, phi, indexing='ij')
+    ring_verts = np.stack((np.sin(t) * np.cos(p), np.sin(t) * np.sin(p), np.cos(t)), axis=-1).reshape(-1, 3)
+    positions = np.concatenate(([[0.0, 0.0, 1.0]], ring_verts, [[0.0, 0.0, -1.0]])).astype(np.float32)
+    south = len(positions) - 1
+
+    def ring_vert(ring, seg):
+        return 1 + ring * segments + seg % segments
+
+    polygons = []
+    loop_uvs = []
+    for seg in range(segments):
+        u0, u1 = seg / float(segments), (seg + 1) / float(segments)
+        polygons.append((0, ring_vert(0, seg), ring_vert(0, seg + 1)))
+        loop_uvs.extend((((u0 + u1) / 2.0, 1.0), (u0, 1.0 - 1.0 / (rings + 1)), (u1, 1.0 - 1.0 / (rings + 1))))
+        for ring in range(rings - 1):
+            v0, v1 = 1.0 - (ring + 1) / float(rings + 1), 1.0 - (ring + 2) / float(rings + 1)
+            polygons.append((ring_vert(ring, seg), ring_vert(ring + 1, seg), ring_vert(ring + 1, seg + 1),
+                             ring_vert(ring, seg + 1)))
+            loop_uvs.extend(((u0, v0), (u0, v1), (u1, v1), (u1, v0)))
+        polygons.append((south, ring_vert(rings - 1, seg + 1), ring_vert(rings - 1, seg)))
+        loop_uvs.extend((((u0 + u1) / 2.0, 0.0), (u1, 1.0 / (rings + 1)), (u0, 1.0 / (rings + 1))))
+    return StandInMesh(name, positions, polygons, loop_uvs, loop_triangles_api, smooth)
+
+
+# -- Synthetic materials --
+
+class _ColorRamp(object):
+    """
+    Stand-in for a bpy.types.ColorRamp, evaluated with linear interpolation between its elements
+    """
+
+    def __init__(self, elements, color_mode='RGB'):
+        self.color_mode = color_mode
+        self.interpolation = 'LINEAR'
+        self.hue_interpolation = 'NEAR'
+        self.elements = [types.SimpleNamespace(position=float(position), color=tuple(color))
+                         for position, color in sorted(elements)]
+        self._positions = np.array([element.position for element in self.elements], dtype=np.float64)
+        self._colors = np.array([element.color for element in self.elements], dtype=np.float64)
+
+    def evaluate(self, position):
+        return tuple(float(np.interp(position, self._positions, self._colors[:, c])) for c in range(4))
+
+
+def make_image(name='Image', width=256, height=256, alpha=False, channels=4):
+    """
+    Creates a generated image, a smooth color gradient with noise over it, that isn't saved to a file
+
+    :param name: Name of the image
+    :param width: Width of the image in pixels
+    :param height: Height of the image in pixels
+    :param alpha: If the alpha channel fades across the image, otherwise it is opaque
+    :param channels: Channels of each pixel, 4 (RGBA), 3 (RGB) or 1 (grayscale)
+    :return: Stand-in image, its pixels are a flat float32 array from the bottom row up like blender's
+    """
+    rng = np.random.RandomState(zlib.crc32(name.encode('utf-8')))
+    v, u = np.meshgrid(np.linspace(0.0, 1.0, height), np.linspace(0.0, 1.0, width), indexing='ij')
+    rgba = np.stack([u, v, 0.5 + 0.5 * np.sin(6.0 * (u + v) + rng.uniform(0.0, 6.0)),
+                     u if alpha else np.ones_like(u)], axis=-1)
+    rgba[..., :3] += rng.uniform(-0.05, 0.05, (height, width, 3))
+    pixels = np.clip(rgba, 0.0, 1.0)[..., :channels] if channels > 1 else rgba[..., :1]
+    return types.SimpleNamespace(name=name, size=(width, height), channels=channels,
+                                 pixels=pixels.astype(np.float32).ravel(), filepath='', library=None, is_dirty=False,
+                                 packed_file=None)
+
+
+def _image_texture_slot(image, normal_map=False):
+    """
+    :return: Stand-in texture slot of an image texture, used for the diffuse color or as a normal map
+    """
+    return types.SimpleNamespace(
+        texture=types.SimpleNamespace(type='IMAGE', image=image), texture_coords='UV', blend_type='MIX',
+        offset=(0.0, 0.0, 0.0), scale=(1.0, 1.0, 1.0), use_map_color_diffuse=not normal_map, use_map_color_spec=False,
+        use_map_normal=normal_map, use_map_alpha=False, diffuse_color_factor=1.0, specular_color_factor=1.0,
+        normal_factor=1.0, alpha_factor=1.0)
+
+
+def make_material(name='Material', ramp_elements=0, color_mode='RGB', image=None, normal_map=None):
+    """
+    Creates a blender internal material, with a diffuse color ramp if ramp_elements is given.
+
+    :param name: Name of the material
+    :param ramp_elements: Number of color stops of the diffuse ramp, 0 for a static diffuse color
+    :param color_mode: Color mode of the ramp, RGB, HSV or HSL
+    :param image: Stand-in image textured onto the diffuse color, see make_image
+    :param normal_map: Stand-in image used as the normal map
+    :return: Stand-in material
+    """
+    rng = np.random.RandomState(zlib.crc32(name.encode('utf-8')))
+    stops = [(i / float(max(ramp_elements - 1, 1)), tuple(rng.uniform(0.0, 1.0, 4))) for i in range(ramp_elements)]
+    ramp = _ColorRamp(stops or [(0.0, (0.0, 0.0, 0.0, 1.0)), (1.0, (1.0, 1.0, 1.0, 1.0))], color_mode)
+    texture_slots = [None] * 18
+    if image is not None:
+        texture_slots[0] = _image_texture_slot(image)
+    if normal_map is not None:
+        texture_slots[1] = _image_texture_slot(normal_map, normal_map=True)
+    return types.SimpleNamespace(
+        name=name, type='SURFACE', diffuse_shader='LAMBERT', specular_shader='COOKTORR',
+        use_diffuse_ramp=ramp_elements > 0, use_specular_ramp=False, diffuse_color=tuple(rng.uniform(0.0, 1.0, 3)),
+        diffuse_intensity=0.8, roughness=0.5, diffuse_toon_size=0.5, diffuse_toon_smooth=0.1, darkness=1.0,
+        diffuse_fresnel=0.1, diffuse_fresnel_factor=0.5, specular_intensity=0.5, specular_hardness=50,
+        specular_ior=4.0, specular_toon_size=0.5, specular_toon_smooth=0.1, specular_slope=0.1,
+        diffuse_ramp=ramp, diffuse_ramp_blend='MIX', diffuse_ramp_factor=1.0, use_cast_shadows=True,
+        use_cast_shadows_only=False, use_cast_buffer_shadows=True, use_shadows=True, use_transparent_shadows=False,
+        use_only_shadow=False, shadow_buffer_bias=0.001, ambient=1.0, texture_slots=texture_slots,
+        use_textures=[True] * 18)
+
+
+def make_object(mesh, name=None):
+    """
+    Wraps the mesh given in a stand-in blender object
+
+    :param mesh: The StandInMesh
+    :param name: Name of the object, defaults to the mesh name
+    :return: Stand-in object
+    """
+    return types.SimpleNamespace(name=name or mesh.name, type='MESH', data=mesh, selected=True,
+                                 matrix_world=[[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0],
+                                               [0.0, 0.0, 0.0, 1.0]],
+                                 location=(0.0, 0.0, 0.0), scale=(1.0, 1.0, 1.0), rotation_mode='XYZ',
+                                 rotation_euler=(0.0, 0.0, 0.0))
+
+
+def make_context(objects):
+    """
+    :param objects: The stand-in objects in the scene
+    :return: Stand-in blender context, with the objects in its scene
+    """
+    return types.SimpleNamespace(scene=types.SimpleNamespace(objects=list(objects)))
+
+
+# -- Loading the addon --
+
+def install():
+    """
+    Installs the stand-in modules into sys.modules, for any that aren't importable
+    """
+    try:
+        import bmesh  # noqa: F401
+    except ImportError:
+        sys.modules['bmesh'] = _make_bmesh_module()
+    try:
+        import bpy  # noqa: F401
+    except ImportError:
+        # The export modules only use bpy through the context and objects passed to them, and bpy.path
+        bpy = sys.modules['bpy'] = types.ModuleType('bpy')
+        bpy.path = types.SimpleNamespace(abspath=_abspath)
+
+
+def _abspath(path, start=None, library=None):
+    """
+    bpy.path.abspath, paths starting with // are relative to the working directory instead of the .blend file
+    """
+    if path.startswith('//'):
+        path = os.path.join(start or os.getcwd(), path[2:])
+    return os.path.abspath(path)
+
+
+def load_addon():
+    """
+    Imports the addon package from this repository without running its blender registration code.
+
+    :return: The addon package module, submodules can be imported with importlib
+    """
+    install()
+    if AddonPackageName not in sys.modules:
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        package = types.ModuleType(AddonPackageName)
+        package.__path__ = [repo]
+        sys.modules[AddonPackageName] = package
+        _add_package_path(repo)
+    return sys.modules[AddonPackageName]
+
+
+def _add_package_path(repo):
+    """
+    Puts a directory linking the package name to this repository on sys.path, so worker processes spawned by the
+    exporter (see ParallelEncoder) can import the addon modules. They import the real package, without bpy.
+    """
+    directory = tempfile.mkdtemp(prefix='standin_')
+    atexit.register(shutil.rmtree, directory, True)
+    try:
+        os.symlink(repo, os.path.join(directory, AddonPackageName), target_is_directory=True)
+    except (OSError, NotImplementedError):
+        return  # Meshes can still be encoded on the main thread
+    sys.path.append(directory)
+
+
+def import_addon_module(name):
+    """
+    Imports a module of the addon, see load_addon
+
+    :param name: Name of the module, ex. MeshExporter
+    :return: The imported module
+    """
+    load_addon()
+    return importlib.import_module('%s.%s' % (AddonPackageName, name))
@@ -4,10 +4,23 @@ import bpy
 from bpy.props import (
     BoolProperty,
     EnumProperty,
+    FloatProperty,
+    IntProperty,
     StringProperty
 )
 
 from . import ExportOptions
+from .ModelArchive import ZipZstandard
+
+BackgroundTimerStep = 0.1  # Seconds between the steps of a background export
+
+
+def _clear_header_text(area):
+    # Blender 2.79 clears the header text with no argument, and raises a TypeError given None. 2.80+ takes None
+    if bpy.app.version < (2, 80, 0):
+        area.header_text_set()
+    else:
+        area.header_text_set(None)
 
 
 class TTModelExporter(bpy.types.Operator):
@@ -33,6 +46,86 @@ class TTModelExporter(bpy.types.Operator):
         (ExportOptions.MeshNoExport, 'None', "Doesn't export any mesh data into .model archive")
     )
 
+    mesh_optimizeOpts = (
+        (ExportOptions.OptimizeNone, 'None', 'Exports the triangles in the order blender stores them'),
+        (ExportOptions.OptimizeVertexCache, 'Vertex Cache',
+         'Reorders the triangles for vertex cache hits, and the vertices in the order they are first used. '
+         'Slow on dense meshes, about 6 seconds per million triangles'),
+        (ExportOptions.OptimizeOverdraw, 'Vertex Cache/Overdraw',
+         'Same as Vertex Cache, but also sorts clusters of triangles to reduce overdraw. Costs some vertex cache hits '
+         'and is slow on dense meshes, about 6 seconds per million triangles')
+    )
+
+    index_formatOpts = (
+        (ExportOptions.IndexSplit16, '16-bit (Split)',
+         'Uses 16-bit indices, meshes with more than 65535 vertices are split into submeshes'),
+        (ExportOptions.IndexAuto, 'Auto',
+         'Uses 16-bit indices for meshes with at most 65535 vertices, 32-bit otherwise'),
+        (ExportOptions.Index32, '32-bit', 'Always uses 32-bit indices')
+    )
+
+    position_formatOpts = (
+        (ExportOptions.PositionFloat, 'Float', 'Stores positions as 3 32-bit floats (12 bytes)'),
+        (ExportOptions.PositionUnorm16, '16-bit',
+         'Stores positions as 16-bit unorms over the bounding box of the mesh (8 bytes)')
+    )
+
+    normal_formatOpts = (
+        (ExportOptions.NormalFloat, 'Float', 'Stores normals as 3 32-bit floats (12 bytes)'),
+        (ExportOptions.NormalOct16, 'Octahedral 16-bit',
+         'Stores normals octahedral encoded as 2 16-bit snorms (4 bytes)'),
+        (ExportOptions.NormalOct8, 'Octahedral 8-bit', 'Stores normals octahedral encoded as 2 8-bit snorms (2 bytes)')
+    )
+
+    uv_formatOpts = (
+        (ExportOptions.UVFloat, 'Float', 'Stores UVs as 2 32-bit floats (8 bytes)'),
+        (ExportOptions.UVHalf, 'Half Float', 'Stores UVs as 2 16-bit floats (4 bytes)'),
+        (ExportOptions.UVUnorm16, '16-bit', 'Stores UVs as 16-bit unorms over the bounding box of the UVs (4 bytes)')
+    )
+
+    vertex_layoutOpts = (
+        (ExportOptions.LayoutSeparate, 'Separate', 'Writes one vertex buffer per attribute'),
+        (ExportOptions.LayoutInterleaved, 'Interleaved',
+         'Writes one vertex buffer with the attributes of each vertex next to each other'),
+        (ExportOptions.LayoutInterleavedPositions, 'Interleaved + Positions',
+         'Writes the interleaved vertex buffer, plus a position buffer for position only passes such as shadows')
+    )
+
+    compression_presetOpts = (
+        (ExportOptions.CompressionStore, 'Store', 'No compression. Fastest export and load, largest archive'),
+        (ExportOptions.CompressionFastLoad, 'Fast Load', 'Deflate. Fast to decompress in-engine, larger archive'),
+        (ExportOptions.CompressionBalanced, 'Balanced', 'LZMA for the buffers, deflate for the json'),
+        (ExportOptions.CompressionDistribution, 'Distribution',
+         'Strongest LZMA for every member. Smallest archive, slowest export')
+    )
+    if ZipZstandard is not None:
+        compression_presetOpts += (
+            (ExportOptions.CompressionZstd, 'Zstandard', 'Zstandard. Close to LZMA in size, decompresses much faster'),
+        )
+
+    buffer_filterOpts = (
+        (ExportOptions.BufferFilterNone, 'None', 'Compresses the buffers as they are'),
+        (ExportOptions.BufferFilterStandard, 'Standard',
+         'Splits float positions into byte planes, delta codes uvs, quantized and index buffers before compressing '
+         'them. Skips a filter that compresses worse than none'),
+        (ExportOptions.BufferFilterAuto, 'Auto',
+         'Tries each filter on every buffer and keeps the one that compresses best. Slower export')
+    )
+
+    archive_layoutOpts = (
+        (ExportOptions.ArchiveMembers, 'Members', 'Saves each buffer as its own compressed member'),
+        (ExportOptions.ArchivePacked, 'Packed',
+         'Packs every buffer into one aligned, uncompressed member the engine can memory map and use in place. Holds '
+         'every buffer in memory until the archive is written'),
+        (ExportOptions.ArchivePackedCompressed, 'Packed (Compressed)',
+         'Packs every buffer into one aligned member, compressed. Smaller, but has to be decompressed to load')
+    )
+
+    pack_alignmentOpts = (
+        ('16', '16 bytes', 'Aligns each packed buffer to 16 bytes, enough for vertex and index buffers'),
+        ('256', '256 bytes', 'Aligns each packed buffer to 256 bytes, enough for any GPU buffer binding')
+    )
+
     material_exportOpts = (
         (ExportOptions.MaterialAll, 'All', 'Exports all of the materials used in the scene'),
         (ExportOptions.MaterialLink, 'Link',
@@ -43,6 +136,39 @@ class TTModelExporter(bpy.types.Operator):
          'Does not export any material data, sets meshes material property to default (Lambert gray).')
     )
 
+    ramp_encodingOpts = (
+        (ExportOptions.RampAdaptive, 'Adaptive',
+         'Stores the fewest colors, with their positions, that stay within the ramp tolerance of the ramp'),
+        (ExportOptions.RampSampled, 'Sampled', 'Stores 100 evenly spaced colors of the ramp')
+    )
+
+    texture_formatOpts = (
+        (ExportOptions.TextureNoExport, 'No Export', 'Does not export the image textures of the materials'),
+        (ExportOptions.TextureBC, 'Block Compressed',
+         'Stores BC1 (DXT1) blocks for opaque images and BC3 (DXT5) blocks for images with alpha, with mip maps. '
+         'Smallest in VRAM and fastest to load'),
+        (ExportOptions.TextureRGBA8, 'RGBA8', 'Stores uncompressed 8-bit RGBA pixels, with mip maps')
+    )
+
+    texture_atlasOpts = (
+        (ExportOptions.AtlasOff, 'Off', 'Every image is a texture of its own'),
+        (ExportOptions.AtlasSmall, 'Small Textures',
+         'Packs the small textures of materials with a single image texture into shared atlases, and moves the UVs '
+         'of the meshes using them into their region of the atlas')
+    )
+
+    profileOpts = (
+        (ExportOptions.ProfileOff, 'Off', 'Does not profile the export'),
+        (ExportOptions.ProfileStages, 'Stages',
+         'Times each stage of the export per object, and counts the vertices, triangles and bytes. Prints a summary '
+         'and writes a .profile.json next to the .model'),
+        (ExportOptions.ProfileMemory, 'Stages and Memory',
+         'Also traces the peak memory of each stage. Slows the export down'),
+        (ExportOptions.ProfileFunctions, 'Stages and Functions',
+         'Also profiles every function call with cProfile, saved as a .prof next to the .model. Slows the export '
+         'down')
+    )
+
     animation_exportOpts = (
         (ExportOptions.AnimationNoExport, 'None', 'WIP. Animation data is not supported yet...'),
         (ExportOptions.AnimationAll, 'All', 'Does not affect export yet. WIP')
@@ -52,15 +178,97 @@ class TTModelExporter(bpy.types.Operator):
     exportMetadata = BoolProperty(name='Export Metadata', default=True, description='Exports the metadata needed to '
                                                                                     'link Meshes/Material/Animations '
                                                                                     ' to a model in-engine.')
+    updateArchive = BoolProperty(name='Update Existing Archive', default=False,
+                                 description='Copies the data that did not change from the existing .model instead of '
+                                             'compressing it again.')
+    compressionPreset = EnumProperty(name='Compression', default=ExportOptions.CompressionBalanced,
+                                     description='How to compress the members of the .model archive.',
+                                     items=compression_presetOpts)
+    bufferFilter = EnumProperty(name='Buffer Filter', default=ExportOptions.BufferFilterNone,
+                                description='Reversible filters that make the mesh buffers compress better. The '
+                                            'loader has to undo them.', items=buffer_filterOpts)
+    compressionReport = BoolProperty(name='Compression Report', default=False,
+                                     description='Prints the size and decode time of the archive with every '
+                                                 'compression preset.')
+    streamExport = BoolProperty(name='Stream Export', default=True,
+                                description='Writes each mesh to the archive as soon as it is encoded, so only a few '
+                                            'meshes are in memory at once.')
+    archiveLayout = EnumProperty(name='Archive Layout', default=ExportOptions.ArchiveMembers,
+                                 description='How to lay out the buffers in the .model archive.',
+                                 items=archive_layoutOpts)
+    packAlignment = EnumProperty(name='Packed Alignment', default=str(ExportOptions.PackAlignmentDefault),
+                                 description='Byte alignment of each buffer in a packed archive.',
+                                 items=pack_alignmentOpts)
+    backgroundExport = BoolProperty(name='Background Export', default=False,
+                                    description='Encodes and compresses the meshes on a worker thread, so blender '
+                                                'stays responsive. Shows the progress in the header, Esc cancels.')
+    profileExport = EnumProperty(name='Profile Export', default=ExportOptions.ProfileOff,
+                                 description='Records where the export spends its time and memory.', items=profileOpts)
+    encodeProcesses = IntProperty(name='Encode Processes', default=1, min=0,
+                                  description='Processes encoding the meshes in parallel, 0 uses one per core. '
+                                              'Needs python 3.8+, 1 encodes on the main thread.')
+    compressionThreads = IntProperty(name='Compression Threads', default=0, min=0,
+                                     description='Threads compressing the .model archive, 0 uses one per core.')
     exportSelectedOnly = BoolProperty(name='Only Export Selected', default=False,
                                       description='Exports only the selected objects in the scene.')
 
     exportMeshData = EnumProperty(name='Export Mesh Data', default='All', description='What mesh data to export.',
                                   items=mesh_exportOpts)
+    weldTolerance = FloatProperty(name='Weld Tolerance', default=ExportOptions.WeldToleranceDefault, min=0.0,
+                                  precision=6, description='Triangle corners whose position, normal and UV are each '
+                                                           'closer together than this share one vertex, instead of '
+                                                           'splitting it. 0 only welds identical corners.')
+    optimizeMeshes = EnumProperty(name='Optimize Meshes', default=ExportOptions.OptimizeNone,
+                                  description='How to reorder the mesh data for rendering in-engine.',
+                                  items=mesh_optimizeOpts)
+    indexFormat = EnumProperty(name='Index Format', default=ExportOptions.IndexSplit16,
+                               description='Size of the indices in the index buffers.', items=index_formatOpts)
+    positionFormat = EnumProperty(name='Position Format', default=ExportOptions.PositionFloat,
+                                  description='How to store the vertex positions.', items=position_formatOpts)
+    normalFormat = EnumProperty(name='Normal Format', default=ExportOptions.NormalFloat,
+                                description='How to store the vertex normals.', items=normal_formatOpts)
+    uvFormat = EnumProperty(name='UV Format', default=ExportOptions.UVFloat, description='How to store the vertex UVs.',
+                            items=uv_formatOpts)
+    vertexLayout = EnumProperty(name='Vertex Layout', default=ExportOptions.LayoutSeparate,
+                                description='How to lay out the vertex buffers.', items=vertex_layoutOpts)
+    useEncodeCache = BoolProperty(name='Use Encode Cache', default=True,
+                                  description='Reuses the meshes and materials encoded by earlier exports when they '
+                                              'have not changed.')
+    cacheDir = StringProperty(name='Cache Directory', default='', subtype='DIR_PATH',
+                              description='Where to keep the encode cache. Uses the user cache directory when empty.')
+    cacheSize = IntProperty(name='Cache Size (MB)', default=ExportOptions.CacheSizeDefault, min=1,
+                            description='Megabytes of encoded data to keep in the cache before the least recently '
+                                        'used entries are deleted.')
     exportMaterialData = EnumProperty(name='Export Material Data', default='All', description='What materials and '
                                                                                               'material metadata to '
                                                                                               'export.',
                                       items=material_exportOpts)
+    materialLibrary = StringProperty(name='Material Library', default='', subtype='FILE_PATH',
+                                     description='Shared .matlib archive to save the materials to, so models using '
+                                                 'the same materials store and load them once. Saves the materials in '
+                                                 'the .model when empty.')
+    rampEncoding = EnumProperty(name='Color Ramps', default=ExportOptions.RampAdaptive,
+                                description='How to store the color ramps of the materials.', items=ramp_encodingOpts)
+    rampTolerance = FloatProperty(name='Ramp Tolerance', default=ExportOptions.RampToleranceDefault,
+                                  min=ExportOptions.RampToleranceMin,
+                                  max=1.0, precision=4, description='Most any color channel of an adaptive ramp may '
+                                                                    'differ from the blender ramp')
+    textureFormat = EnumProperty(name='Textures', default=ExportOptions.TextureNoExport,
+                                 description='How to store the image textures of the materials.',
+                                 items=texture_formatOpts)
+    textureMaxSize = IntProperty(name='Max Texture Size', default=ExportOptions.TextureMaxSizeDefault, min=1,
+                                 max=16384, description='Largest width or height of an exported texture, textures '
+                                                        'are scaled to a power of two no larger than this')
+    textureAtlas = EnumProperty(name='Texture Atlas', default=ExportOptions.AtlasOff,
+                                description='If small textures are packed into shared atlases.',
+                                items=texture_atlasOpts)
+    atlasTextureSize = IntProperty(name='Atlas Texture Size', default=ExportOptions.AtlasTextureSizeDefault, min=1,
+                                   max=4096, description='Largest width or height of a texture to pack into an atlas')
+    atlasSize = IntProperty(name='Atlas Size', default=ExportOptions.AtlasSizeDefault, min=16, max=16384,
+                            description='Width and height of each atlas, a power of two')
+    atlasPadding = IntProperty(name='Atlas Padding', default=ExportOptions.AtlasPaddingDefault, min=0, max=64,
+                               description='Pixels of gutter around each texture in an atlas. Atlases keep the mip '
+                                           'levels where the gutter is still a pixel wide')
     exportAnimationData = EnumProperty(name='Export Animation Data', default='No_Export', description='What '
                                                                                                       'animations and'
                                                                                                       ' animation '
@@ -71,10 +279,48 @@ class TTModelExporter(bpy.types.Operator):
     def execute(self, context):
         start = time.time()
         filePath = bpy.path.ensure_ext(self.filepath, '.model')
+
+        from .EncodeCache import DefaultCacheDir
+        cacheDir = None
+        if self.useEncodeCache:
+            cacheDir = bpy.path.abspath(self.cacheDir) if self.cacheDir else DefaultCacheDir
+        materialLibrary = None
+        if self.materialLibrary:
+            materialLibrary = bpy.path.ensure_ext(bpy.path.abspath(self.materialLibrary),
+                                                  ExportOptions.MaterialLibraryExt)
+
         config = {
             ExportOptions.FilePathKey: filePath,
+            ExportOptions.UpdateArchiveKey: self.updateArchive,
+            ExportOptions.CompressionWorkersKey: self.compressionThreads,
+            ExportOptions.EncodeProcessesKey: self.encodeProcesses,
+            ExportOptions.StreamExportKey: self.streamExport,
+            ExportOptions.CompressionKey: self.compressionPreset,
+            ExportOptions.CompressionReportKey: self.compressionReport,
+            ExportOptions.BufferFilterKey: self.bufferFilter,
+            ExportOptions.ArchiveLayoutKey: self.archiveLayout,
+            ExportOptions.PackAlignmentKey: int(self.packAlignment),
+            ExportOptions.ProfileKey: self.profileExport,
             ExportOptions.MeshKey: self.exportMeshData,
+            ExportOptions.WeldToleranceKey: self.weldTolerance,
+            ExportOptions.OptimizeKey: self.optimizeMeshes,
+            ExportOptions.IndexFormatKey: self.indexFormat,
+            ExportOptions.PositionFormatKey: self.positionFormat,
+            ExportOptions.NormalFormatKey: self.normalFormat,
+            ExportOptions.UVFormatKey: self.uvFormat,
+            ExportOptions.LayoutKey: self.vertexLayout,
+            ExportOptions.CacheDirKey: cacheDir,
+            ExportOptions.CacheSizeKey: self.cacheSize,
             ExportOptions.MaterialKey: self.exportMaterialData,
+            ExportOptions.MaterialLibraryKey: materialLibrary,
+            ExportOptions.RampEncodingKey: self.rampEncoding,
+            ExportOptions.RampToleranceKey: self.rampTolerance,
+            ExportOptions.TextureFormatKey: self.textureFormat,
+            ExportOptions.TextureMaxSizeKey: self.textureMaxSize,
+            ExportOptions.AtlasKey: self.textureAtlas,
+            ExportOptions.AtlasTextureSizeKey: self.atlasTextureSize,
+            ExportOptions.AtlasSizeKey: self.atlasSize,
+            ExportOptions.AtlasPaddingKey: self.atlasPadding,
             ExportOptions.AnimationKey: self.exportAnimationData,
             ExportOptions.EmitMetadataKey: self.exportMetadata,
             ExportOptions.SelectedOnlyKey: self.exportSelectedOnly
@@ -82,10 +328,87 @@ class TTModelExporter(bpy.types.Operator):
 
         from .ModelExporter import export_model
         from .ModelCompressor import save_model
-        encoded_data = export_model(context, config)
-        save_model(encoded_data, filePath)
+        from .ExportProfiler import start_profiling, stop_profiling, stage
+        start_profiling(config[ExportOptions.ProfileKey])
+        if self.backgroundExport:
+            return self._start_background(context, config, start)
+        try:
+            with stage('export_model'):
+                encoded_data = export_model(context, config)
+            save_model(encoded_data, filePath, config[ExportOptions.UpdateArchiveKey],
+                       config[ExportOptions.CompressionWorkersKey] or None, config[ExportOptions.CompressionKey],
+                       config[ExportOptions.CompressionReportKey], config[ExportOptions.BufferFilterKey],
+                       config[ExportOptions.ArchiveLayoutKey], config[ExportOptions.PackAlignmentKey],
+                       config[ExportOptions.MaterialLibraryKey])
+        finally:
+            profiler = stop_profiling()
+
+        self._print_finished(start, profiler, filePath)
+        return {'FINISHED'}
 
+    def _print_finished(self, start, profiler, filePath):
         print("Export finished in %.4f seconds" % (time.time() - start))
+        if profiler is not None:
+            profiler.print_summary()
+            print('Profile written to %s' % profiler.write_report(filePath))
+
+    # -- Background export --
+
+    def _start_background(self, context, config, start):
+        """
+        Snapshots the scene and starts encoding it on a worker thread, then keeps extracting meshes and showing the
+        progress on a timer, see modal
+        """
+        from .BackgroundExport import BackgroundExport
+        from .ExportProfiler import stop_profiling, stage
+        try:
+            with stage('export_model'):
+                self._job = BackgroundExport(context, config)
+        except Exception:
+            stop_profiling()
+            raise
+
+        self._start = start
+        WindowManager = context.window_manager
+        self._timer = WindowManager.event_timer_add(BackgroundTimerStep, window=context.window)
+        WindowManager.progress_begin(0, 100)
+        WindowManager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        job = self._job
+        if event.type == 'ESC':
+            job.cancel()
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        job.step()
+        fraction, text = job.progress()
+        context.window_manager.progress_update(int(fraction * 100))
+        if context.area is not None:
+            context.area.header_text_set(text)
+        if not job.finished():
+            return {'PASS_THROUGH'}
+        return self._finish_background(context)
+
+    def _finish_background(self, context):
+        from .ExportProfiler import stop_profiling
+        WindowManager = context.window_manager
+        WindowManager.event_timer_remove(self._timer)
+        WindowManager.progress_end()
+        if context.area is not None:
+            _clear_header_text(context.area)
+        profiler = stop_profiling()
+
+        job = self._job
+        if job.error is not None:
+            self.report({'ERROR'}, 'Export failed: %s' % str(job.error))
+            return {'CANCELLED'}
+        if job.cancelled:
+            self.report({'WARNING'}, 'Export cancelled, %s was not changed' % job.config[ExportOptions.FilePathKey])
+            return {'CANCELLED'}
+        self._print_finished(self._start, profiler, job.config[ExportOptions.FilePathKey])
         return {'FINISHED'}
 
     def invoke(self, context, event):